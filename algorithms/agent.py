@@ -17,7 +17,7 @@ from utils.gifs import encode_gif
 from utils.params import Params
 from utils.plot import HEATMAP_FIGURE_ID
 from utils.tensorboard import visualize_matplotlib_figure_tensorboard
-from utils.utils import log, model_dir, summaries_dir, memory_consumption_mb, numpy_all_the_way
+from utils.utils import log, model_dir, summaries_dir, memory_consumption_mb
 
 
 class TrainStatus:
@@ -203,7 +203,7 @@ class AgentLearner(Agent):
         num_envs = self.params.gif_summary_num_envs
 
         trajectories = [
-            numpy_all_the_way(t.obs)[:, :, :, -3:] for t in trajectory_buffer.complete_trajectories[:num_envs]
+            t.obs[:, :, :, -3:] for t in trajectory_buffer.complete_trajectories[:num_envs]
         ]
         self._write_gif_summaries(tag='obs_trajectories', gif_images=trajectories, step=env_steps)
         log.info('Took %.3f seconds to write gif summaries', time.time() - start_gif_summaries)
@@ -1,4 +1,3 @@
-import copy
 import random
 import time
 
@@ -18,19 +17,15 @@ from utils.utils import log
 
 
 class CuriousPPOBuffer(PPOBuffer):
-    def __init__(self):
-        super(CuriousPPOBuffer, self).__init__()
-        self.next_obs = None
-
-    def reset(self):
-        super(CuriousPPOBuffer, self).reset()
-        self.next_obs = []
+    data_keys = PPOBuffer.data_keys + ('next_obs', )
 
     # noinspection PyMethodOverriding
     def add(self, obs, next_obs, actions, action_probs, rewards, dones, values, goals=None):
         """Append one-step data to the current batch of observations."""
-        args = copy.copy(locals())
-        super(CuriousPPOBuffer, self)._add_args(args)
+        self._add_step(
+            obs=obs, next_obs=next_obs, actions=actions, action_probs=action_probs, rewards=rewards, dones=dones,
+            values=values, goals=goals,
+        )
 
 
 class AgentCuriousPPO(AgentPPO):
@@ -132,7 +127,7 @@ class AgentCuriousPPO(AgentPPO):
         env_obs = multi_env.reset()
         obs, goals = main_observation(env_obs), goal_observation(env_obs)
 
-        buffer = CuriousPPOBuffer()
+        buffer = CuriousPPOBuffer(self.params.rollout)
         trajectory_buffer = TrajectoryBuffer(self.params.num_envs)
         self.curiosity.set_trajectory_buffer(trajectory_buffer)
 
@@ -184,7 +179,7 @@ class AgentCuriousPPO(AgentPPO):
 
                 # last step values are required for TD-return calculation
                 _, _, values = self._policy_step(obs, goals)
-                buffer.values.append(values)
+                buffer.add_last_values(values)
 
             env_steps += num_steps
 
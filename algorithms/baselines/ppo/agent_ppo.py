@@ -1,4 +1,3 @@
-import copy
 import math
 import time
 from functools import partial
@@ -103,33 +102,94 @@ class ActorCritic:
 
 
 class PPOBuffer:
-    def __init__(self):
-        self.obs = self.actions = self.action_probs = self.rewards = self.dones = self.values = None
-        self.advantages = self.returns = self.goals = None
+    """
+    Rollout data in [rollout, num_envs, ...] arrays. Arrays are allocated on the first step (and grown if the rollout
+    is longer than expected), reused for all subsequent rollouts, and every step is written into them in place.
+    After finalize_batch() data attributes are zero-copy [rollout * num_envs, ...] views of the same memory.
+    """
+
+    data_keys = ('obs', 'actions', 'action_probs', 'rewards', 'dones', 'values', 'goals', 'advantages', 'returns')
+
+    def __init__(self, rollout=0):
+        for key in self.data_keys:
+            setattr(self, key, None)
+
+        self._arrays = {}
+        self._rollout_capacity = rollout
+        self._step = 0
+        self._num_values = 0  # values have one extra last step, see add_last_values()
+
+        self.num_copies = 0  # times a whole array was copied after it was written (growth, shuffle)
 
     def reset(self):
-        self.obs, self.actions, self.action_probs, self.rewards, self.dones, self.values = [], [], [], [], [], []
-        self.goals = []
-        self.advantages, self.returns = [], []
+        for key in self.data_keys:
+            setattr(self, key, None)
+        self._step = self._num_values = 0
 
-    def _add_args(self, args):
-        for arg_name, arg_value in args.items():
-            if arg_name in self.__dict__ and arg_value is not None:
-                self.__dict__[arg_name].append(arg_value)
+    @staticmethod
+    def _dtype(value):
+        if isinstance(value, np.ndarray):
+            return value.dtype
+        if np.ndim(value[0]) == 0:
+            return np.asarray(value).dtype  # e.g. rewards can be a mix of ints and floats
+        return np.asarray(value[0]).dtype
+
+    def _array(self, key, value, num_steps):
+        """Preallocated array for the key, large enough for num_steps and able to hold the value."""
+        arr = self._arrays.get(key)
+        value_shape = (len(value), ) + np.shape(value[0])
+        dtype = self._dtype(value)
+        if arr is not None and arr.shape[1:] == value_shape:
+            if len(arr) >= num_steps and np.can_cast(dtype, arr.dtype):
+                return arr
+            dtype = np.promote_types(dtype, arr.dtype)
+
+        capacity = max(num_steps, self._rollout_capacity + 1)  # extra step for the last values
+        if arr is not None:
+            capacity = max(capacity, len(arr))
+            if len(arr) < num_steps:
+                capacity = max(capacity, 2 * len(arr))
+
+        new_arr = np.empty((capacity, ) + value_shape, dtype=dtype)
+        if arr is not None and arr.shape[1:] == value_shape and self._step > 0:
+            new_arr[:self._step] = arr[:self._step]
+            self.num_copies += 1
+        self._arrays[key] = new_arr
+        return new_arr
 
-    def add(self, obs, actions, action_probs, rewards, dones, values, goals=None):
-        args = copy.copy(locals())
-        self._add_args(args)
+    @staticmethod
+    def _write(arr, step, value):
+        if isinstance(value, np.ndarray):
+            arr[step] = value
+        else:
+            # don't let numpy build a temporary array out of a list of observations
+            for env_i, v in enumerate(value):
+                arr[step, env_i] = v
 
-    def to_numpy(self):
-        """Convert everything in the buffer into numpy arrays."""
-        for item, x in self.__dict__.items():
-            if x is None:
+    def _add_step(self, **kwargs):
+        for key, value in kwargs.items():
+            if value is None:
                 continue
-            self.__dict__[item] = np.asarray(x)  # preserve existing array type (e.g. uint8 for images)
+            self._write(self._array(key, value, self._step + 1), self._step, value)
+
+        self._step += 1
+        self._num_values = self._step
+
+    def add(self, obs, actions, action_probs, rewards, dones, values, goals=None):
+        self._add_step(
+            obs=obs, actions=actions, action_probs=action_probs, rewards=rewards, dones=dones, values=values,
+            goals=goals,
+        )
+
+    def add_last_values(self, values):
+        """Value estimates after the last step of the rollout, required for TD-return calculation."""
+        self._write(self._array('values', values, self._step + 1), self._step, values)
+        self._num_values = self._step + 1
 
     def finalize_batch(self, gamma, gae_lambda):
-        self.to_numpy()
+        for key, arr in self._arrays.items():
+            num_steps = self._num_values if key == 'values' else self._step
+            setattr(self, key, arr[:num_steps])
 
         # calculate discounted returns and GAE
         self.advantages, self.returns = calculate_gae(self.rewards, self.dones, self.values, gamma, gae_lambda)
@@ -139,27 +199,29 @@ class PPOBuffer:
         assert self.values.shape == self.advantages.shape
 
         num_transitions = self.obs.shape[0] * self.obs.shape[1]
-        for item, x in self.__dict__.items():
+        for key in self.data_keys:
+            x = getattr(self, key)
             if x is None or x.size == 0:
                 continue
 
-            data_shape = x.shape[2:]
-            # collapse [num_batches, batch_size] into one dimension
-            self.__dict__[item] = x.reshape((num_transitions,) + data_shape)
+            # collapse [num_batches, batch_size] into one dimension, this is a view because arrays are contiguous
+            setattr(self, key, x.reshape((num_transitions, ) + x.shape[2:]))
 
     def shuffle(self):
         """Shuffle all buffers in-place with the same random seed."""
         rng_state = np.random.get_state()
 
-        for x in self.__dict__.values():
+        for key in self.data_keys:
+            x = getattr(self, key)
             if x is None or x.size == 0:
                 continue
 
             np.random.set_state(rng_state)
             np.random.shuffle(x)
+            self.num_copies += 1
 
     def __len__(self):
-        return len(self.obs)
+        return 0 if self.obs is None else len(self.obs)
 
 
 class AgentPPO(AgentLearner):
@@ -476,7 +538,7 @@ class AgentPPO(AgentLearner):
 
         env_obs = multi_env.reset()
         observations, goals = main_observation(env_obs), goal_observation(env_obs)
-        buffer = PPOBuffer()
+        buffer = PPOBuffer(self.params.rollout)
 
         def end_of_training(s, es):
             return s >= self.params.train_for_steps or es > self.params.train_for_env_steps
@@ -507,7 +569,7 @@ class AgentPPO(AgentLearner):
 
                 # last step values are required for TD-return calculation
                 _, _, values = self.actor_critic.invoke(self.session, observations, goals=goals)
-                buffer.values.append(values)
+                buffer.add_last_values(values)
 
             env_steps += num_steps
 
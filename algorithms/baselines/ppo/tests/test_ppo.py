@@ -54,13 +54,13 @@ class TestPPO(TestCase):
         obs_size, num_envs, rollout, batch_size = 16, 10, 100, 50
 
         buff = PPOBuffer()
+        buff.reset()
 
         # fill buffer with fake data
-        for item in buff.__dict__.keys():
-            buff.__dict__[item] = np.ones((rollout, num_envs))
-        buff.obs = np.ones((rollout, num_envs, obs_size))
-        buff.dones = np.zeros_like(buff.dones)
-        buff.values = np.append(buff.values, np.ones((1, num_envs)), axis=0)
+        ones = np.ones(num_envs)
+        for _ in range(rollout):
+            buff.add(np.ones((num_envs, obs_size)), ones, ones, ones, np.zeros(num_envs), ones, goals=ones)
+        buff.add_last_values(ones)
 
         buff.finalize_batch(0.999, 0.99)
         buff.shuffle()
@@ -68,6 +68,53 @@ class TestPPO(TestCase):
         self.assertEqual(buff.obs.shape, (rollout * num_envs, obs_size))
         self.assertEqual(buff.rewards.shape, (rollout * num_envs, ))
 
+    def test_buffer_preallocated(self):
+        obs_size, num_envs, rollout = 16, 10, 8
+
+        buff = PPOBuffer(rollout)
+
+        def add_step(obs_value, action, reward):
+            obs = [np.full(obs_size, obs_value, dtype=np.uint8) for _ in range(num_envs)]
+            zeros = [0] * num_envs
+            buff.add(obs, [action] * num_envs, np.ones(num_envs), [reward] * num_envs, zeros, [0.5] * num_envs)
+
+        def finalize():
+            buff.add_last_values([0.5] * num_envs)
+            buff.finalize_batch(0.99, 0.95)
+
+        for rollout_idx in range(3):
+            buff.reset()
+            for step in range(rollout):
+                add_step(rollout_idx * rollout + step, step, 0)
+            finalize()
+
+            self.assertEqual(len(buff), rollout * num_envs)
+            self.assertEqual(buff.obs.dtype, np.uint8)
+            self.assertEqual(buff.obs[-1, 0], (rollout_idx + 1) * rollout - 1)
+            self.assertEqual(buff.actions[num_envs + 3], 1)
+
+            # training data is a view of the preallocated arrays, not a copy
+            self.assertTrue(np.shares_memory(buff.obs, buff._arrays['obs']))
+            self.assertTrue(np.shares_memory(buff.values, buff._arrays['values']))
+
+        self.assertEqual(buff.num_copies, 0)
+
+        # int rewards became float in the middle of the rollout, we have to copy rewards collected so far
+        buff.reset()
+        add_step(0, 0, 0)
+        add_step(0, 0, 0.5)
+        finalize()
+        self.assertEqual(list(buff.rewards[num_envs - 1:num_envs + 1]), [0, 0.5])
+        self.assertEqual(buff.num_copies, 1)
+
+        # longer rollout than expected
+        buff.reset()
+        for step in range(2 * rollout):
+            add_step(0, step, 0)
+        finalize()
+        self.assertEqual(len(buff), 2 * rollout * num_envs)
+        self.assertEqual(buff.actions[-1], 2 * rollout - 1)
+
 
 class TestPPOPerformance(TestCase):
     @staticmethod
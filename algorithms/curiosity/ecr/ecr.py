@@ -60,6 +60,7 @@ class ECRModule(CuriosityModule):
             distance_net_saver.restore(
                 session, tf.train.latest_checkpoint(self.params.distance_network_checkpoint),
             )
+            self.distance.reset_numpy_head()
             self.initialized = True
             log.debug('Done loading distance network from checkpoint!')
 
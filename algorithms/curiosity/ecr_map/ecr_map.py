@@ -39,6 +39,12 @@ class ECRMapModule(CuriosityModule):
 
             self.oracle_distance = False  # debug mode, using ground truth coordinates from the env.
 
+            # if coordinates are available, only consider non-neighbor landmarks within this radius (world units)
+            self.localization_prefilter_radius = None
+
+            # if mean absolute pixel difference from the previous frame is below this, reuse previous localization
+            self.localization_skip_pixel_diff = None
+
     def __init__(self, env, params):
         self.params = params
 
@@ -52,6 +58,9 @@ class ECRMapModule(CuriosityModule):
         self.trajectory_buffer = None
         self.distance_buffer = DistanceBuffer(self.params)
 
+        # distance net is not trained while this is set, e.g. when the maps are built in a background thread
+        self.distance_training_paused = False
+
         self.episodic_maps = [None] * params.num_envs
         self.current_episode_bonus = np.zeros(self.params.num_envs)
         self.episode_bonuses = deque([])
@@ -73,6 +82,11 @@ class ECRMapModule(CuriosityModule):
         self._last_trained = 0
         self._last_map_summary = 0
 
+        # frame-difference gating of localization
+        self._prev_obs = [None] * self.params.num_envs  # last localized observation
+        self._prev_distance_to_memory = [None] * self.params.num_envs
+        self.frames_skipped = self.frames_localized = 0
+
     def initialize(self, session):
         # restore only distance network if we have checkpoint for it
         if self.params.distance_network_checkpoint is not None:
@@ -83,9 +97,27 @@ class ECRMapModule(CuriosityModule):
             distance_net_saver.restore(
                 session, tf.train.latest_checkpoint(self.params.distance_network_checkpoint),
             )
+            self.distance.reset_numpy_head()
             self.initialized = True
             log.debug('Done loading distance network from checkpoint!')
 
+    def _skip_localization(self, env_i, m, obs, done):
+        """
+        Whether the observation is too similar to the last localized one to change the localization result.
+        We compare against the last localized frame rather than the previous frame, so slow drift is not ignored.
+        """
+        threshold = self.params.localization_skip_pixel_diff
+        prev_obs = self._prev_obs[env_i]
+        if threshold is None or done or prev_obs is None:
+            return False
+
+        if m.new_landmark_candidate_frames > 0 or m.loop_closure_candidate_frames > 0:
+            # localization is not settled, every frame counts towards a new landmark or a new edge
+            return False
+
+        pixel_diff = np.mean(np.abs(obs.astype(np.int16) - prev_obs.astype(np.int16)))
+        return pixel_diff < threshold
+
     def generate_bonus_rewards(self, session, obs, next_obs, actions, dones, infos, mask=None):
         if self.explored_region_map is None:
             self.explored_region_map = TopologicalMap(obs[0], directed_graph=False, initial_info=infos[0])
@@ -138,12 +170,33 @@ class ECRMapModule(CuriosityModule):
             else:
                 maps = [self.episodic_maps[i] if mask[i] else None for i in range(len(mask))]
 
+            skipped = [False] * self.params.num_envs
+            for env_i, m in enumerate(maps):
+                if m is not None:
+                    skipped[env_i] = self._skip_localization(env_i, m, next_obs[env_i], dones[env_i])
+
+            localize_maps = [None if skip else m for m, skip in zip(maps, skipped)]
+            self.frames_skipped += sum(skipped)
+            self.frames_localized += sum(m is not None for m in localize_maps)
+
             self.localizer.new_landmark_threshold = self.new_landmark_threshold
             self.localizer.loop_closure_threshold = self.loop_closure_threshold
             distances_to_memory = self.localizer.localize(
-                session, next_obs, infos, maps, self.distance, frames=frames, on_new_landmark=on_new_landmark,
+                session, next_obs, infos, localize_maps, self.distance, frames=frames, on_new_landmark=on_new_landmark,
             )
 
+            for env_i, m in enumerate(maps):
+                if skipped[env_i]:
+                    # the agent is still at the same landmark, reuse the previous result
+                    distances_to_memory[env_i] = self._prev_distance_to_memory[env_i]
+                    if len(m.closest_landmarks) > 0:
+                        m.closest_landmarks.append(m.closest_landmarks[-1])  # keep per-frame localization history
+                elif m is not None:
+                    self._prev_obs[env_i] = next_obs[env_i]
+                    self._prev_distance_to_memory[env_i] = distances_to_memory[env_i]
+                else:
+                    self._prev_obs[env_i] = None
+
             if frames is not None:
                 for env_i, m in enumerate(maps):
                     if m is None:
@@ -269,7 +322,9 @@ class ECRMapModule(CuriosityModule):
             self.distance_buffer.extract_data(self.trajectory_buffer.complete_trajectories)
 
             if env_steps - self._last_trained > self.params.distance_train_interval:
-                if self.distance_buffer.has_enough_data():
+                if self.distance_training_paused:
+                    log.debug('Distance net training postponed')
+                elif self.distance_buffer.has_enough_data():
                     self.distance.train(self.distance_buffer.buffer, env_steps, agent)
                     self._last_trained = env_steps
 
@@ -316,6 +371,17 @@ class ECRMapModule(CuriosityModule):
         curiosity_summary('new_landmark_threshold', self.new_landmark_threshold)
         curiosity_summary('loop_closure_threshold', self.loop_closure_threshold)
 
+        # per-step number of (landmark, observation) pairs before and after deduplication
+        curiosity_summary('localization_pairs_requested', self.localizer.num_pairs_requested)
+        curiosity_summary('localization_pairs_evaluated', self.localizer.num_pairs_evaluated)
+
+        if self.params.localization_skip_pixel_diff is not None:
+            # compare avg_landmarks with and without gating to see how skipping affects the map
+            total_frames = self.frames_skipped + self.frames_localized
+            if total_frames > 0:
+                curiosity_summary('localization_skipped_frames', self.frames_skipped / total_frames)
+            self.frames_skipped = self.frames_localized = 0
+
         summary_writer.add_summary(summary, env_steps)
 
         time_since_last = time.time() - self._last_map_summary
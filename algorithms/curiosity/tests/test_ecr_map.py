@@ -0,0 +1,57 @@
+from unittest import TestCase, mock
+
+import numpy as np
+
+from algorithms.curiosity.ecr_map.ecr_map import ECRMapModule
+from algorithms.distance.distance_backend import CosineDistanceBackend
+
+
+class TestECRMap(TestCase):
+    @staticmethod
+    def _run_episode(localization_skip_pixel_diff, frames):
+        """Feed [num_steps, num_envs, ...] frames to the module, returns the module and its episodic maps."""
+        params = ECRMapModule.Params()
+        params.num_envs = frames.shape[1]
+        params.new_landmark_threshold = 0.3
+        params.loop_closure_threshold = 0.1
+        params.localization_skip_pixel_diff = localization_skip_pixel_diff
+
+        with mock.patch('algorithms.curiosity.ecr_map.ecr_map.DistanceNetwork', lambda env, p: CosineDistanceBackend()):
+            ecr_map = ECRMapModule(None, params)
+        ecr_map.initialized = True
+
+        infos = [{}] * params.num_envs
+        dones = [False] * params.num_envs
+        for step in range(1, len(frames)):
+            ecr_map.generate_bonus_rewards(None, frames[step - 1], frames[step], None, dones, infos)
+
+        return ecr_map, ecr_map.episodic_maps
+
+    def test_localization_skip(self):
+        num_envs, num_scenes, frames_per_scene = 2, 5, 8
+        rng = np.random.RandomState(0)
+
+        # agents stand still for a while in front of every scene, frames differ only by small noise
+        frames = []
+        for scene in range(num_scenes):
+            scene_obs = rng.randint(0, 254, size=(num_envs, 84, 84, 3)).astype(np.uint8)
+            for _ in range(frames_per_scene):
+                noise = rng.randint(0, 2, size=scene_obs.shape).astype(np.uint8)
+                frames.append(scene_obs + noise)
+        frames = np.stack(frames)
+        num_steps = len(frames) - 1
+
+        baseline, baseline_maps = self._run_episode(None, frames)
+        self.assertEqual(baseline.frames_skipped, 0)
+        self.assertEqual(baseline.frames_localized, num_steps * num_envs)
+
+        gated, gated_maps = self._run_episode(2.0, frames)
+        self.assertGreater(gated.frames_skipped, 0)
+        self.assertEqual(gated.frames_skipped + gated.frames_localized, num_steps * num_envs)
+
+        for baseline_map, gated_map in zip(baseline_maps, gated_maps):
+            self.assertGreater(baseline_map.num_landmarks(), 1)
+            self.assertEqual(baseline_map.num_landmarks(), gated_map.num_landmarks())
+            self.assertEqual(baseline_map.curr_landmark_idx, gated_map.curr_landmark_idx)
+            # skipped frames are still recorded in the localization history
+            self.assertEqual(len(baseline_map.closest_landmarks), len(gated_map.closest_landmarks))
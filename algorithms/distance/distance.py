@@ -1,5 +1,4 @@
 import os
-import random
 import shutil
 import time
 from collections import deque
@@ -10,12 +9,14 @@ import cv2
 import numpy as np
 import tensorflow as tf
 
+from algorithms.distance.distance_backend import DistanceBackend
+from algorithms.distance.distance_head import NumpyDistanceHead
 from algorithms.tmax.tmax_utils import TmaxTrajectory, TmaxMode
-from algorithms.topological_maps.topological_map import hash_observation
-from algorithms.utils.buffer import Buffer
+from algorithms.utils.buffer import PairBuffer
 from algorithms.utils.encoders import make_encoder, EncoderParams
 from algorithms.utils.env_wrappers import main_observation_space
 from algorithms.utils.observation_encoder import ObservationEncoder
+from algorithms.utils.prefetch import prefetch_batches
 from algorithms.utils.tf_utils import dense, placeholders_from_spaces, merge_summaries
 from utils.timing import Timing
 from utils.utils import log, vis_dir, ensure_dir_exists
@@ -31,6 +32,12 @@ class DistanceNetworkParams:
         self.distance_bootstrap = 4000000
         self.distance_train_interval = 1000000
         self.distance_symmetric = True  # useful in 3D environments like Doom and DMLab
+        # keep training pairs in memory-mapped files in this directory instead of RAM (for memory-constrained nodes)
+        self.distance_buffer_scratch_dir = None
+        # train_distance.py: train on trajectories saved in this experiment dir instead of collecting new ones
+        self.distance_offline_experiment_dir = None
+        # training minibatches are gathered this many steps ahead in a background thread (0 - no prefetching)
+        self.distance_prefetch_batches = 2
 
         self.distance_encoder = 'resnet'
         self.distance_use_batch_norm = True
@@ -39,9 +46,15 @@ class DistanceNetworkParams:
 
         self.distance_network_checkpoint = None
 
+        # evaluate the fully-connected head in numpy for batches up to this size (TF dispatch overhead dominates)
+        self.distance_numpy_head = False
+        self.distance_numpy_head_max_batch = 256
 
-class DistanceNetwork:
+
+class DistanceNetwork(DistanceBackend):
     def __init__(self, env, params):
+        self.params = params
+
         obs_space = main_observation_space(env)
         self.ph_obs_first, self.ph_obs_second = placeholders_from_spaces(obs_space, obs_space)
         self.ph_labels = tf.placeholder(dtype=tf.int32, shape=(None,))
@@ -77,14 +90,24 @@ class DistanceNetwork:
 
             observations_encoded = tf.concat([self.first_encoded, self.second_encoded], axis=1)
 
+            # variables of every head layer, to be able to export the head to numpy
+            self._head_variables = []
+
+            def new_variables(variables_before):
+                return {v.op.name.split('/')[-1]: v for v in tf.global_variables() if v not in variables_before}
+
             fc_layers = [params.distance_fc_size] * params.distance_fc_num
             x = observations_encoded
             for fc_layer_size in fc_layers:
+                existing_variables = set(tf.global_variables())
                 x = dense(
                     x, fc_layer_size, reg, batch_norm=params.distance_use_batch_norm, is_training=self.ph_is_training,
                 )
+                self._head_variables.append(new_variables(existing_variables))
 
+            existing_variables = set(tf.global_variables())
             logits = tf.contrib.layers.fully_connected(x, 2, activation_fn=None)
+            self._head_variables.append(new_variables(existing_variables))
             self.probabilities = tf.nn.softmax(logits)
             self.correct = tf.reduce_mean(
                 tf.to_float(tf.equal(self.ph_labels, tf.cast(tf.argmax(logits, axis=1), tf.int32))),
@@ -113,6 +136,7 @@ class DistanceNetwork:
 
         # other stuff not related to computation graph
         self.obs_encoder = ObservationEncoder(encode_func=self.encode_observation)
+        self.numpy_head = None  # exported lazily, see get_probabilities
 
     def _add_summaries(self, collections):
         with tf.name_scope('distance'):
@@ -122,11 +146,31 @@ class DistanceNetwork:
             distance_scalar('dist_correct', self.correct)
             distance_scalar('dist_reg_loss', self.reg_loss)
 
+    def export_numpy_head(self, session):
+        layer_variables = session.run(self._head_variables)
+        self.numpy_head = NumpyDistanceHead.from_variables(layer_variables)
+        return self.numpy_head
+
+    def snapshot(self, session):
+        """Numpy head of the snapshot is exported right away, so it is not affected by further training."""
+        backend = super().snapshot(session)
+        backend.export_numpy_head(session)
+        return backend
+
+    def reset_numpy_head(self):
+        """Should be called whenever the weights change (e.g. after training or loading a checkpoint)."""
+        self.numpy_head = None
+
     def get_probabilities(self, session, obs_first_encoded, obs_second_encoded):
         assert len(obs_first_encoded) == len(obs_second_encoded)
         if len(obs_first_encoded) <= 0:
             return []
 
+        if self.params.distance_numpy_head and len(obs_first_encoded) <= self.params.distance_numpy_head_max_batch:
+            if self.numpy_head is None:
+                self.export_numpy_head(session)
+            return self.numpy_head.probabilities(obs_first_encoded, obs_second_encoded)
+
         probabilities = session.run(
             self.probabilities,
             feed_dict={
@@ -141,22 +185,13 @@ class DistanceNetwork:
         probs = self.get_probabilities(session, obs_first_encoded, obs_second_encoded)
         return [p[1] for p in probs]
 
-    def distances_from_obs(self, session, obs_first, obs_second, hashes_first=None, hashes_second=None, **kwargs):
-        """Use encoder to get embedding vectors first."""
-        obs_encoder = self.obs_encoder
+    def distances_matrix(self, session, obs_first_encoded, obs_second_encoded, **kwargs):
+        if not self.params.distance_numpy_head or len(obs_first_encoded) <= 0 or len(obs_second_encoded) <= 0:
+            return super().distances_matrix(session, obs_first_encoded, obs_second_encoded, **kwargs)
 
-        if hashes_first is None:
-            hashes_first = [hash_observation(obs) for obs in obs_first]
-        if hashes_second is None:
-            hashes_second = [hash_observation(obs) for obs in obs_second]
-
-        obs_encoder.encode(session, obs_first + obs_second, hashes_first + hashes_second)
-
-        obs_first_encoded = [obs_encoder.encoded_obs[h] for h in hashes_first]
-        obs_second_encoded = [obs_encoder.encoded_obs[h] for h in hashes_second]
-
-        d = self.distances(session, obs_first_encoded, obs_second_encoded)
-        return d
+        if self.numpy_head is None:
+            self.export_numpy_head(session)
+        return self.numpy_head.distances_matrix(obs_first_encoded, obs_second_encoded)
 
     def encode_observation(self, session, obs):
         return session.run(
@@ -182,28 +217,24 @@ class DistanceNetwork:
             for epoch in range(num_epochs):
                 losses = []
 
-                with timing.add_time('shuffle'):
-                    buffer.shuffle_data()
-
-                obs_first, obs_second, labels = buffer.obs_first, buffer.obs_second, buffer.labels
+                feed_dicts = (
+                    {
+                        self.ph_obs_first: batch.obs_first,
+                        self.ph_obs_second: batch.obs_second,
+                        self.ph_labels: batch.labels,
+                        self.ph_is_training: True,
+                    }
+                    for batch in buffer.minibatches(batch_size)
+                )
+                feed_dicts = prefetch_batches(feed_dicts, params.distance_prefetch_batches, timing, key_prefix='dist_')
 
-                with timing.add_time('batch'):
-                    for i in range(0, len(obs_first) - 1, batch_size):
+                with timing.timeit('dist_epoch'), timing.add_time('batch'):
+                    for feed_dict in feed_dicts:
                         # noinspection PyProtectedMember
                         with_summaries = agent._should_write_summaries(dist_step) and summary is None
                         summaries = [self.summaries] if with_summaries else []
 
-                        start, end = i, i + batch_size
-
-                        result = agent.session.run(
-                            [self.loss, self.train_op] + summaries,
-                            feed_dict={
-                                self.ph_obs_first: obs_first[start:end],
-                                self.ph_obs_second: obs_second[start:end],
-                                self.ph_labels: labels[start:end],
-                                self.ph_is_training: True,
-                            }
-                        )
+                        result = agent.session.run([self.loss, self.train_op] + summaries, feed_dict=feed_dict)
 
                         dist_step += 1
                         # noinspection PyProtectedMember
@@ -214,14 +245,20 @@ class DistanceNetwork:
                             summary = result[-1]
                             agent.summary_writer.add_summary(summary, global_step=env_steps)
 
-                    # check loss improvement at the end of each epoch, early stop if necessary
-                    avg_loss = np.mean(losses)
-                    if avg_loss >= prev_loss:
-                        log.info('Early stopping after %d epochs because distance net did not improve', epoch + 1)
-                        log.info('Was %.4f now %.4f, ratio %.3f', prev_loss, avg_loss, avg_loss / prev_loss)
-                        break
-                    prev_loss = avg_loss
+                log.info(
+                    'Distance net epoch %d took %.3f s (total feed %.3f s, compute %.3f s)',
+                    epoch + 1, timing.dist_epoch, timing.dist_feed, timing.dist_compute,
+                )
 
+                # check loss improvement at the end of each epoch, early stop if necessary
+                avg_loss = np.mean(losses)
+                if avg_loss >= prev_loss:
+                    log.info('Early stopping after %d epochs because distance net did not improve', epoch + 1)
+                    log.info('Was %.4f now %.4f, ratio %.3f', prev_loss, avg_loss, avg_loss / prev_loss)
+                    break
+                prev_loss = avg_loss
+
+        self.reset_numpy_head()
         return dist_step
 
     def calc_test_error(self, buffer, env_steps, agent, timing=None):
@@ -236,17 +273,13 @@ class DistanceNetwork:
 
         with timing.timeit('dist_test_error'):
             losses = []
-            obs_first, obs_second, labels = buffer.obs_first, buffer.obs_second, buffer.labels
-
-            for i in range(0, len(obs_first) - 1, batch_size):
-                start, end = i, i + batch_size
-
+            for batch in buffer.minibatches(batch_size, shuffle=False):
                 loss = agent.session.run(
                     self.loss,
                     feed_dict={
-                        self.ph_obs_first: obs_first[start:end],
-                        self.ph_obs_second: obs_second[start:end],
-                        self.ph_labels: labels[start:end],
+                        self.ph_obs_first: batch.obs_first,
+                        self.ph_obs_second: batch.obs_second,
+                        self.ph_labels: batch.labels,
                         self.ph_is_training: False,
                     }
                 )
@@ -273,8 +306,10 @@ class DistanceBuffer:
     """Training data for the distance network (observation pairs and labels)."""
 
     def __init__(self, params):
-        self.buffer = Buffer()
-        self.close_buff, self.far_buff = Buffer(), Buffer()
+        # memory-mapped files are sparse, so we can reserve the whole capacity up front
+        scratch_dir = params.distance_buffer_scratch_dir
+        capacity = 0 if scratch_dir is None else params.distance_target_buffer_size + 1
+        self.buffer = PairBuffer(capacity=capacity, scratch_dir=scratch_dir)
         self.batch_num = 0
 
         self._vis_dirs = deque([])
@@ -298,69 +333,20 @@ class DistanceBuffer:
 
         with timing.timeit('trajectories'):
             for trajectory in trajectories:
-                check_tmax = isinstance(trajectory, TmaxTrajectory)
-
-                obs = trajectory.obs
-
-                indices = list(range(len(trajectory)))
-                np.random.shuffle(indices)
-
-                for i in indices:
-                    if len(self.buffer) > self.params.distance_target_buffer_size // 2:
-                        if data_added > self.params.distance_target_buffer_size // 4:  # to limit memory usage
-                            break
-
-                    if len(self.buffer) > self.params.distance_target_buffer_size:
-                        break
-
-                    close_i = min(i + close, len(trajectory))
-                    far_i = min(i + far, len(trajectory))
-
-                    # sample close observation pair
-                    first_idx = i
-                    second_idx = np.random.randint(i, close_i)
-
-                    # in TMAX we do some additional checks
-                    add_close = True
-                    if check_tmax:
-                        both_frames_random = trajectory.is_random[first_idx] and trajectory.is_random[second_idx]
-                        first_exploration = trajectory.mode[first_idx] == TmaxMode.EXPLORATION
-                        second_exploration = trajectory.mode[second_idx] == TmaxMode.EXPLORATION
-                        if both_frames_random or (first_exploration and second_exploration):
-                            add_close = True
-                        else:
-                            add_close = False
-
-                    if add_close:
-                        if self.params.distance_symmetric and random.random() < 0.5:
-                            first_idx, second_idx = second_idx, first_idx
-
-                        self.buffer.add(obs_first=obs[first_idx], obs_second=obs[second_idx], labels=0)
-                        data_added += 1
-                        num_close += 1
-
-                    # sample far observation pair
-                    if far_i < len(trajectory):
-                        first_idx = i
-                        second_idx = np.random.randint(far_i, len(trajectory))
-
-                        add_far = True
-                        if check_tmax:
-                            both_frames_random = trajectory.is_random[first_idx] and trajectory.is_random[second_idx]
-                            first_exploration = trajectory.mode[first_idx] == TmaxMode.EXPLORATION
-                            second_exploration = trajectory.mode[second_idx] == TmaxMode.EXPLORATION
-                            if both_frames_random or (first_exploration and second_exploration):
-                                add_far = True
-                            else:
-                                add_far = False
-
-                        if add_far:
-                            if self.params.distance_symmetric and random.random() < 0.5:
-                                first_idx, second_idx = second_idx, first_idx
-
-                            self.buffer.add(obs_first=obs[first_idx], obs_second=obs[second_idx], labels=1)
-                            data_added += 1
-                            num_far += 1
+                max_to_add = self.params.distance_target_buffer_size + 1 - len(self.buffer)
+                if len(self.buffer) > self.params.distance_target_buffer_size // 2:
+                    # to limit memory usage
+                    max_to_add = min(max_to_add, self.params.distance_target_buffer_size // 4 + 1 - data_added)
+                if max_to_add <= 0:
+                    break
+
+                first, second, labels = self._sample_pairs(trajectory, close, far)
+                first, second, labels = first[:max_to_add], second[:max_to_add], labels[:max_to_add]
+
+                self.buffer.add_pairs(trajectory.obs, first, second, labels)
+                data_added += len(labels)
+                num_far += np.count_nonzero(labels)
+                num_close += len(labels) - np.count_nonzero(labels)
 
         with timing.timeit('finalize'):
             self.buffer.trim_at(self.params.distance_target_buffer_size)
@@ -372,6 +358,41 @@ class DistanceBuffer:
         self.batch_num += 1
         log.info('num close %d, num far %d, distance net timing %s', num_close, num_far, timing)
 
+    def _sample_pairs(self, trajectory, close, far):
+        """
+        For every frame (in random order) sample one close and one far frame from the same trajectory.
+        Returns (first, second, labels) index arrays, close and far pairs of the same frame go one after another.
+        """
+        traj_len = len(trajectory)
+        indices = np.random.permutation(traj_len)
+
+        close_second = np.random.randint(indices, np.minimum(indices + close, traj_len))
+
+        far_start = np.minimum(indices + far, traj_len)
+        has_far = far_start < traj_len
+        far_second = np.random.randint(np.minimum(far_start, traj_len - 1), traj_len)
+
+        first = np.stack([indices, indices], axis=1)
+        second = np.stack([close_second, far_second], axis=1)
+        labels = np.stack([np.zeros(traj_len, dtype=np.int32), np.ones(traj_len, dtype=np.int32)], axis=1)
+        valid = np.stack([np.ones(traj_len, dtype=bool), has_far], axis=1)
+
+        if isinstance(trajectory, TmaxTrajectory):
+            # in TMAX we only use pairs of random frames or pairs of exploration frames
+            is_random = np.asarray(trajectory.is_random, dtype=bool)
+            exploration = np.asarray(trajectory.mode) == TmaxMode.EXPLORATION
+            both_random = is_random[first] & is_random[second]
+            both_exploration = exploration[first] & exploration[second]
+            valid &= both_random | both_exploration
+
+        first, second, labels = first[valid], second[valid], labels[valid]
+
+        if self.params.distance_symmetric:
+            swap = np.random.random(len(first)) < 0.5
+            first, second = np.where(swap, second, first), np.where(swap, first, second)
+
+        return first, second, labels
+
     def has_enough_data(self):
         len_data, min_data = len(self.buffer), self.params.distance_target_buffer_size // 3
         if len_data < min_data:
@@ -390,19 +411,16 @@ class DistanceBuffer:
         if len(self.buffer) < min_vis:
             return
 
-        close_examples, far_examples = [], []
         labels = self.buffer.labels
-        obs_first, obs_second = self.buffer.obs_first, self.buffer.obs_second
-
-        for i in range(len(labels)):
-            if labels[i] == 0 and len(close_examples) < min_vis:
-                close_examples.append((obs_first[i], obs_second[i]))
-            elif labels[i] == 1 and len(far_examples) < min_vis:
-                far_examples.append((obs_first[i], obs_second[i]))
-
-        if len(close_examples) < min_vis or len(far_examples) < min_vis:
+        close_indices, far_indices = np.nonzero(labels == 0)[0][:min_vis], np.nonzero(labels == 1)[0][:min_vis]
+        if len(close_indices) < min_vis or len(far_indices) < min_vis:
             return
 
+        # noinspection PyProtectedMember
+        close, far = self.buffer._gather(close_indices), self.buffer._gather(far_indices)
+        close_examples = list(zip(close.obs_first, close.obs_second))
+        far_examples = list(zip(far.obs_first, far.obs_second))
+
         img_folder = vis_dir(self.params.experiment_dir())
         img_folder = ensure_dir_exists(join(img_folder, 'dist'))
         img_folder = ensure_dir_exists(join(img_folder, f'dist_{time.time()}'))
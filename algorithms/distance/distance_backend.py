@@ -0,0 +1,132 @@
+import copy
+
+import numpy as np
+
+from algorithms.topological_maps.topological_map import hash_observation
+from algorithms.utils.observation_encoder import ObservationEncoder
+
+
+class DistanceBackend:
+    """
+    Everything the landmark/navigation code (Localizer, Navigator, MapBuilder) needs from a distance function.
+    Implemented by the TF distance network, the coordinate-based oracle and the numpy backend below.
+    Session argument is passed through as is, backends that don't need TF just ignore it.
+    """
+
+    # True if distance can be calculated purely from the coordinates in info dicts (see DistanceOracle)
+    uses_coordinates = False
+
+    obs_encoder = None
+
+    def encode_observation(self, session, obs):
+        """Embedding vectors for a batch of observations, without caching."""
+        raise NotImplementedError
+
+    def distances(self, session, obs_first_encoded, obs_second_encoded, **kwargs):
+        """Pairwise distances between embedding vectors, in [0, 1]."""
+        raise NotImplementedError
+
+    def distances_matrix(self, session, obs_first_encoded, obs_second_encoded, batch_size=4096):
+        """Distances between every pair of first and second embeddings, as [N1, N2] matrix."""
+        first, second = np.asarray(obs_first_encoded), np.asarray(obs_second_encoded)
+        distances = np.empty([len(first), len(second)], dtype=np.float32)
+        if distances.size <= 0:
+            return distances
+
+        rows_per_batch = max(1, batch_size // len(second))
+        for row in range(0, len(first), rows_per_batch):
+            rows = first[row:row + rows_per_batch]
+            d = self.distances(session, np.repeat(rows, len(second), axis=0), np.tile(second, (len(rows), 1)))
+            distances[row:row + rows_per_batch] = np.reshape(d, (len(rows), len(second)))
+
+        return distances
+
+    def snapshot(self, session):
+        """
+        Shallow copy of the backend with its own embedding cache, for use from a background thread.
+        Shared cache can be reset by the main thread at any time (size limit, distance net training).
+        """
+        backend = copy.copy(self)
+        backend.obs_encoder = ObservationEncoder(encode_func=backend.encode_observation)
+        return backend
+
+    def encode(self, session, obs, hashes=None):
+        """Embedding vectors for a list of observations, cached by observation hash."""
+        if hashes is None:
+            hashes = [hash_observation(o) for o in obs]
+
+        self.obs_encoder.encode(session, obs, hashes)
+        return [self.obs_encoder.encoded_obs[h] for h in hashes]
+
+    def distances_from_obs(self, session, obs_first, obs_second, hashes_first=None, hashes_second=None, **kwargs):
+        """Use encoder to get embedding vectors first."""
+        if hashes_first is None:
+            hashes_first = [hash_observation(obs) for obs in obs_first]
+        if hashes_second is None:
+            hashes_second = [hash_observation(obs) for obs in obs_second]
+
+        self.obs_encoder.encode(session, obs_first + obs_second, hashes_first + hashes_second)
+
+        obs_first_encoded = [self.obs_encoder.encoded_obs[h] for h in hashes_first]
+        obs_second_encoded = [self.obs_encoder.encoded_obs[h] for h in hashes_second]
+
+        return self.distances(session, obs_first_encoded, obs_second_encoded)
+
+    def distances_one_to_many(
+            self, session, obs, obs_many, hash_=None, hashes_many=None, info=None, infos_many=None,
+    ):
+        """Distances from a single observation to every observation in the list."""
+        if len(obs_many) <= 0:
+            return []
+
+        if hash_ is None:
+            hash_ = hash_observation(obs)
+
+        return self.distances_from_obs(
+            session,
+            obs_first=[obs] * len(obs_many), obs_second=list(obs_many),
+            hashes_first=[hash_] * len(obs_many), hashes_second=hashes_many,
+            infos_first=None if info is None else [info] * len(obs_many), infos_second=infos_many,
+        )
+
+
+class CosineDistanceBackend(DistanceBackend):
+    """
+    Pure-numpy backend that does not need a TF graph or session: embedding is a fixed random projection of the
+    pixels, distance is the cosine distance between embeddings.
+    Distances are not meaningful in any sense, this is only for benchmarking and profiling the landmark and
+    navigation code on machines without TF/GPU.
+    """
+
+    def __init__(self, embedding_size=128, seed=0):
+        self.embedding_size = embedding_size
+        self.seed = seed
+        self._projection = None  # created when we see the first observation
+        self.obs_encoder = ObservationEncoder(encode_func=self.encode_observation)
+
+    def encode_observation(self, session, obs):
+        obs = np.asarray(obs, dtype=np.float32).reshape((len(obs), -1)) / 255.0 - 0.5
+
+        if self._projection is None:
+            rng = np.random.RandomState(self.seed)
+            self._projection = rng.randn(obs.shape[1], self.embedding_size).astype(np.float32)
+
+        encoded = obs @ self._projection
+        encoded /= np.linalg.norm(encoded, axis=1, keepdims=True) + 1e-8
+        return encoded
+
+    def distances(self, session, obs_first_encoded, obs_second_encoded, **kwargs):
+        assert len(obs_first_encoded) == len(obs_second_encoded)
+        if len(obs_first_encoded) <= 0:
+            return []
+
+        cosine = np.sum(np.asarray(obs_first_encoded) * np.asarray(obs_second_encoded), axis=1)
+        return list(np.clip((1.0 - cosine) / 2.0, 0.0, 1.0))
+
+    def distances_matrix(self, session, obs_first_encoded, obs_second_encoded, **kwargs):
+        first, second = np.asarray(obs_first_encoded), np.asarray(obs_second_encoded)
+        if first.size <= 0 or second.size <= 0:
+            return np.empty([len(first), len(second)], dtype=np.float32)
+
+        cosine = first @ second.T
+        return np.clip((1.0 - cosine) / 2.0, 0.0, 1.0)
@@ -0,0 +1,82 @@
+import numpy as np
+
+# default epsilon of tf.contrib.layers.batch_norm
+BATCH_NORM_EPSILON = 0.001
+
+
+class NumpyDistanceHead:
+    """
+    Numpy copy of the fully-connected part of the distance network (everything after the siamese encoder).
+    Batch norm is folded into the weights, so inference is just a few matrix multiplications.
+    For small batches this is much faster than session.run, because we don't pay the TF dispatch overhead.
+    """
+
+    def __init__(self, layers):
+        self.layers = layers  # list of (weights, biases), ReLU after every layer except the last one
+
+    @staticmethod
+    def fold_layer(variables, epsilon=BATCH_NORM_EPSILON):
+        """
+        Turn values of the layer variables (dict from variable name to value) into a single affine transformation.
+        Batch norm in inference mode is gamma * (x - mean) / sqrt(var + eps) + beta, i.e. also affine.
+        """
+        weights = variables['weights'].astype(np.float32)
+        biases = variables.get('biases', np.zeros(weights.shape[1], dtype=np.float32)).astype(np.float32)
+
+        if 'moving_mean' in variables:
+            scale = 1.0 / np.sqrt(variables['moving_variance'] + epsilon)
+            if 'gamma' in variables:
+                scale = scale * variables['gamma']
+
+            weights = weights * scale
+            biases = (biases - variables['moving_mean']) * scale
+            if 'beta' in variables:
+                biases = biases + variables['beta']
+
+        return weights.astype(np.float32), biases.astype(np.float32)
+
+    @staticmethod
+    def from_variables(layer_variables, epsilon=BATCH_NORM_EPSILON):
+        return NumpyDistanceHead([NumpyDistanceHead.fold_layer(v, epsilon) for v in layer_variables])
+
+    def _forward(self, x, first_layer=0):
+        """Apply layers starting from first_layer to x (first layer expects pre-activations of the previous one)."""
+        for i in range(first_layer, len(self.layers)):
+            if i > 0:
+                np.maximum(x, 0, out=x)
+            weights, biases = self.layers[i]
+            x = x @ weights + biases
+
+        x -= x.max(axis=-1, keepdims=True)
+        np.exp(x, out=x)
+        x /= x.sum(axis=-1, keepdims=True)
+        return x
+
+    def probabilities(self, obs_first_encoded, obs_second_encoded):
+        x = np.concatenate(
+            [np.asarray(obs_first_encoded, dtype=np.float32), np.asarray(obs_second_encoded, dtype=np.float32)],
+            axis=1,
+        )
+        return self._forward(x)
+
+    def distances_matrix(self, obs_first_encoded, obs_second_encoded, max_elements=2 ** 24):
+        """
+        Distances between every pair of first and second embeddings, as [N1, N2] matrix.
+        The first layer is linear in the concatenated input, so we apply it to both sets of embeddings separately,
+        and only pay for the [N1, N2] broadcast starting from the second layer.
+        """
+        first = np.asarray(obs_first_encoded, dtype=np.float32)
+        second = np.asarray(obs_second_encoded, dtype=np.float32)
+
+        weights, biases = self.layers[0]
+        emb_size = first.shape[1]
+        first_preactivations = first @ weights[:emb_size] + biases
+        second_preactivations = second @ weights[emb_size:]
+
+        distances = np.empty([len(first), len(second)], dtype=np.float32)
+        rows_per_chunk = max(1, max_elements // max(1, len(second) * weights.shape[1]))
+        for row in range(0, len(first), rows_per_chunk):
+            x = first_preactivations[row:row + rows_per_chunk, None, :] + second_preactivations[None, :, :]
+            distances[row:row + rows_per_chunk] = self._forward(x, first_layer=1)[:, :, 1]
+
+        return distances
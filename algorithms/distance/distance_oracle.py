@@ -1,16 +1,38 @@
-import math
+import numpy as np
 
 from algorithms.distance.distance import DistanceNetwork
 from utils.utils import log
 
 
 class DistanceOracle(DistanceNetwork):
+    # oracle distance is a monotonic function of the distance in world coordinates
+    uses_coordinates = True
+
+    # distance in world coordinates that corresponds to normalized distance of 1.0
+    far_distance = 250.0
+
     def __init__(self, env, params):
         super().__init__(env, params)
 
     @staticmethod
-    def _default_pos():
-        return {'agent_x': 0.0, 'agent_y': 0.0}
+    def _positions(infos):
+        """Coordinates as [N, 2] array, plus a mask of infos where coordinates are missing."""
+        positions = np.zeros((len(infos), 2), dtype=np.float64)
+        missing = np.zeros(len(infos), dtype=bool)
+        for i, info in enumerate(infos):
+            try:
+                pos = info['pos']
+                positions[i] = pos['agent_x'], pos['agent_y']
+            except (KeyError, TypeError):
+                missing[i] = True
+        return positions, missing
+
+    def normalize(self, ground_truth_distance):
+        # linear interpolation
+        # 0 == 0.0
+        # >=far_distance == 1.0
+        ground_truth_distance = np.maximum(0.0, ground_truth_distance)  # just in case, to avoid numerical issues
+        return np.minimum(ground_truth_distance / self.far_distance, 1.0)
 
     def distances(self, session, obs_first_encoded, obs_second_encoded, infos_first=None, infos_second=None):
         if len(obs_first_encoded) <= 0:
@@ -22,29 +44,17 @@ class DistanceOracle(DistanceNetwork):
 
         assert len(infos_first) == len(infos_second)
 
-        far_distance = 250.0
-
-        d = []
-        for i in range(len(infos_first)):
-            try:
-                pos1, pos2 = infos_first[i]['pos'], infos_second[i]['pos']
-            except (KeyError, TypeError):
-                log.warning('No coordinate information provided!')
-                pos1 = pos2 = self._default_pos()
-
-            x1, y1 = pos1['agent_x'], pos1['agent_y']
-            x2, y2 = pos2['agent_x'], pos2['agent_y']
+        pos_first, missing_first = self._positions(infos_first)
+        pos_second, missing_second = self._positions(infos_second)
 
-            ground_truth_distance = math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
-            ground_truth_distance = max(0.0, ground_truth_distance)  # just in case, to avoid numerical issues
+        ground_truth_distance = np.hypot(*(pos_first - pos_second).T)
 
-            # linear interpolation
-            # 0 == 0.0
-            # >=300 == 1.0
-            distance_normalized = min(ground_truth_distance / far_distance, 1.0)
-            d.append(distance_normalized)
+        missing = missing_first | missing_second
+        if np.any(missing):
+            log.warning('No coordinate information provided!')
+            ground_truth_distance[missing] = 0.0  # same as if both positions were at default (0, 0)
 
-        return d
+        return list(self.normalize(ground_truth_distance))
 
     def distances_from_obs(
             self, session, obs_first, obs_second, hashes_first=None, hashes_second=None,
@@ -4,9 +4,12 @@ from unittest import TestCase
 
 import numpy as np
 
+from algorithms.distance.distance import DistanceBuffer, DistanceNetworkParams
+from algorithms.distance.distance_head import NumpyDistanceHead, BATCH_NORM_EPSILON
 from algorithms.tests.test_wrappers import TEST_ENV_NAME
 from algorithms.tmax.agent_tmax import AgentTMAX
 from algorithms.utils.buffer import Buffer
+from algorithms.utils.trajectory import Trajectory
 from utils.envs.doom.doom_utils import doom_env_by_name, make_doom_env
 from utils.timing import Timing
 from utils.utils import log
@@ -63,3 +66,117 @@ class TestDistance(TestCase):
 
         log.info('Timing: %s', t)
         shutil.rmtree(params.experiment_dir())
+
+
+class TestDistanceBuffer(TestCase):
+    def test_extract_data(self):
+        params = DistanceNetworkParams()
+        params.distance_target_buffer_size = 2000
+
+        trajectories = []
+        for traj_i in range(5):
+            trajectory = Trajectory(0)
+            for i in range(300):
+                # frame index is encoded in the observation
+                trajectory.add(np.full([4, 4, 2], [i // 256, i % 256], dtype=np.uint8), 0, {})
+            trajectories.append(trajectory)
+
+        buffer = DistanceBuffer(params)
+        buffer.batch_num = 1  # skip visualization
+
+        t = Timing()
+        with t.timeit('extract'):
+            buffer.extract_data(trajectories)
+
+        self.assertGreater(len(buffer.buffer), params.distance_target_buffer_size // 3)
+        self.assertLessEqual(len(buffer.buffer), params.distance_target_buffer_size)
+        # every frame is stored only once, even though it participates in several pairs
+        self.assertLess(buffer.buffer.frame_store.num_frames(), len(buffer.buffer))
+
+        def frame_idx(o):
+            return o[:, 0, 0, 0].astype(np.int64) * 256 + o[:, 0, 0, 1]
+
+        for batch in buffer.buffer.minibatches(256):
+            diff = np.abs(frame_idx(batch.obs_first) - frame_idx(batch.obs_second))
+            close = batch.labels == 0
+            self.assertTrue(np.all(diff[close] < params.close_threshold))
+            self.assertTrue(np.all(diff[~close] >= params.far_threshold))
+
+        log.debug('Buffer size %d, %d bytes, timing %s', len(buffer.buffer), buffer.buffer.nbytes(), t)
+
+
+class TestNumpyDistanceHead(TestCase):
+    def test_batch_norm_folding(self):
+        rng = np.random.RandomState(0)
+        emb_size, fc_size = 16, 8
+
+        layer_variables = [
+            dict(
+                weights=rng.randn(2 * emb_size, fc_size), biases=rng.randn(fc_size), beta=rng.randn(fc_size),
+                moving_mean=rng.randn(fc_size), moving_variance=rng.uniform(0.5, 2.0, fc_size),
+            ),
+            dict(weights=rng.randn(fc_size, 2), biases=rng.randn(2)),
+        ]
+        head = NumpyDistanceHead.from_variables(layer_variables)
+
+        first, second = rng.randn(10, emb_size), rng.randn(10, emb_size)
+
+        # reference implementation without folding
+        v = layer_variables[0]
+        x = np.concatenate([first, second], axis=1) @ v['weights'] + v['biases']
+        x = (x - v['moving_mean']) / np.sqrt(v['moving_variance'] + BATCH_NORM_EPSILON) + v['beta']
+        x = np.maximum(x, 0)
+        logits = x @ layer_variables[1]['weights'] + layer_variables[1]['biases']
+        expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+
+        self.assertTrue(np.allclose(head.probabilities(first, second), expected, atol=1e-5))
+
+    def test_distances_matrix(self):
+        rng = np.random.RandomState(0)
+        emb_size, fc_size = 16, 8
+
+        layer_variables = [
+            dict(weights=rng.randn(2 * emb_size, fc_size), biases=rng.randn(fc_size)),
+            dict(weights=rng.randn(fc_size, fc_size), biases=rng.randn(fc_size)),
+            dict(weights=rng.randn(fc_size, 2), biases=rng.randn(2)),
+        ]
+        head = NumpyDistanceHead.from_variables(layer_variables)
+
+        first, second = rng.randn(7, emb_size), rng.randn(5, emb_size)
+        distances = head.distances_matrix(first, second, max_elements=50)  # small chunks
+
+        for i in range(len(first)):
+            expected = head.probabilities([first[i]] * len(second), second)[:, 1]
+            self.assertTrue(np.allclose(distances[i], expected, atol=1e-5))
+
+    def test_crossover(self):
+        """Compare numpy head with session.run for different batch sizes."""
+        def make_env():
+            return make_doom_env(doom_env_by_name(TEST_ENV_NAME))
+
+        params = AgentTMAX.Params('__test_numpy_head__')
+        agent = AgentTMAX(make_env, params)
+        agent.initialize()
+
+        distance = agent.distance
+        emb_size = distance.first_encoded.shape.as_list()[-1]
+        numpy_head = distance.export_numpy_head(agent.session)
+
+        params.distance_numpy_head = False
+        for batch_size in [1, 8, 32, 128, 512, 2048]:
+            first = np.random.randn(batch_size, emb_size).astype(np.float32)
+            second = np.random.randn(batch_size, emb_size).astype(np.float32)
+
+            t = Timing()
+            with t.timeit('tf'):
+                for _ in range(20):
+                    tf_probs = distance.get_probabilities(agent.session, first, second)
+            with t.timeit('numpy'):
+                for _ in range(20):
+                    np_probs = numpy_head.probabilities(first, second)
+
+            self.assertTrue(np.allclose(tf_probs, np_probs, atol=1e-4))
+            log.debug('Batch size %d, timing %s', batch_size, t)
+
+        agent.finalize()
+        shutil.rmtree(params.experiment_dir())
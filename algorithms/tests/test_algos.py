@@ -1,5 +1,10 @@
 import gc
+import os
 import shutil
+import tempfile
+import threading
+import time
+from collections import deque
 
 import numpy as np
 import tensorflow as tf
@@ -8,10 +13,12 @@ from unittest import TestCase
 
 from algorithms.agent import AgentLearner, AgentRandom
 from algorithms.utils.algo_utils import RunningMeanStd, extract_keys, choice_weighted, softmax
-from algorithms.utils.buffer import Buffer
+from algorithms.utils.algo_utils import calculate_discounted_sum, calculate_gae
+from algorithms.utils.buffer import Buffer, PairBuffer, StackedFrameStore
 from algorithms.utils.encoders import is_normalized, tf_normalize
 from algorithms.utils.env_wrappers import TimeLimitWrapper, main_observation_space
 from algorithms.utils.exploit import run_policy_loop
+from algorithms.utils.prefetch import prefetch_batches
 from algorithms.tests.test_wrappers import TEST_ENV_NAME
 from algorithms.utils.tf_utils import placeholder_from_space
 from utils.envs.doom.doom_utils import make_doom_env, doom_env_by_name
@@ -92,6 +99,58 @@ class TestAlgoUtils(TestCase):
 
         log.debug('Sampled values: %r', values)
 
+    @staticmethod
+    def _discounted_sum_loop(x, dones, discount, x_last=None):
+        """Reference implementation."""
+        cumulative = np.zeros_like(x[0]) if x_last is None else np.array(x_last, dtype=x.dtype)
+        discounted_sum = np.zeros_like(x)
+        for i in reversed(range(len(x))):
+            cumulative = x[i] + discount * cumulative * (1 - dones[i])
+            discounted_sum[i] = cumulative
+        return discounted_sum
+
+    def test_discounted_sum(self):
+        x = np.array([[1.0], [1.0], [1.0], [1.0]])
+        dones = np.array([[0], [1], [0], [0]])
+        self.assertTrue(np.allclose(calculate_discounted_sum(x, dones, 0.5), [[1.5], [1.0], [1.5], [1.0]]))
+        self.assertTrue(np.allclose(calculate_discounted_sum(x, dones, 0.5, [2.0]), [[1.5], [1.0], [2.0], [2.0]]))
+
+        rng = np.random.RandomState(0)
+        for num_steps, num_envs in [(1, 1), (32, 16), (300, 3), (1000, 2), (20, 200)]:
+            x = rng.randn(num_steps, num_envs)
+            dones = rng.rand(num_steps, num_envs) < 0.05
+            x_last = rng.randn(num_envs)
+            for discount in [0.0, 0.5, 0.99 * 0.95, 0.999, 1.0]:
+                for block_size in [1, 7, 256]:
+                    expected = self._discounted_sum_loop(x, dones, discount, x_last)
+                    result = calculate_discounted_sum(x, dones, discount, x_last, block_size=block_size)
+                    self.assertEqual(result.shape, expected.shape)
+                    self.assertTrue(np.allclose(result, expected, rtol=1e-9, atol=1e-9))
+
+        rewards, values = rng.randn(64, 8), rng.randn(65, 8)
+        dones = rng.rand(64, 8) < 0.1
+        advantages, returns = calculate_gae(rewards, dones, values, 0.99, 0.95)
+        deltas = rewards + (1 - dones) * (0.99 * values[1:]) - values[:-1]
+        self.assertTrue(np.allclose(advantages, self._discounted_sum_loop(deltas, dones, 0.99 * 0.95)))
+        self.assertTrue(np.allclose(returns, self._discounted_sum_loop(rewards, dones, 0.99, values[-1])))
+
+    def test_discounted_sum_performance(self):
+        rng = np.random.RandomState(0)
+        for num_steps in [32, 128, 2048]:
+            for num_envs in [1, 16, 192]:
+                x = rng.randn(num_steps, num_envs)
+                dones = rng.rand(num_steps, num_envs) < 0.01
+
+                t = Timing()
+                with t.timeit('loop'):
+                    for _ in range(10):
+                        self._discounted_sum_loop(x, dones, 0.99)
+                with t.timeit('vectorized'):
+                    for _ in range(10):
+                        calculate_discounted_sum(x, dones, 0.99)
+
+                log.debug('Rollout %d, num envs %d, timing: %s', num_steps, num_envs, t)
+
 
 class TestEncoders(TestCase):
     def test_normalize(self):
@@ -211,3 +270,183 @@ class TestBuffer(TestCase):
         for i in range(5):
             self.assertTrue(np.array_equal(b.a, b.b))
             b.shuffle_data()
+
+    def test_buffer_minibatches(self):
+        b = Buffer()
+        b.add_many(a=np.arange(1001), b=np.arange(1001) * 2)
+
+        seen = []
+        for batch in b.minibatches(100):
+            self.assertTrue(np.array_equal(batch.a * 2, batch.b))
+            seen.extend(batch.a)
+
+        self.assertEqual(len(seen), 1000)  # last batch of size 1 is skipped
+        self.assertEqual(len(set(seen)), 1000)
+        self.assertTrue(np.array_equal(b.a, np.arange(1001)))  # data did not move
+
+        batches = list(b.minibatches(500, keys=['a'], shuffle=False))
+        self.assertEqual(list(batches[0].keys()), ['a'])
+        self.assertTrue(np.array_equal(batches[1].a, np.arange(500, 1000)))
+
+        sample = b.sample(64)
+        self.assertEqual(len(sample.a), 64)
+        self.assertTrue(np.array_equal(sample.a * 2, sample.b))
+
+    def test_pair_buffer(self):
+        obs = np.arange(10)[:, None, None] * np.ones([10, 4, 4], dtype=np.uint8)
+
+        b = PairBuffer()
+        b.add_pairs(obs, first=np.array([0, 1, 2]), second=np.array([1, 2, 9]), labels=[0, 0, 1])
+        self.assertEqual(len(b), 3)
+        self.assertEqual(b.frame_store.num_frames(), 4)  # frames 1 and 2 are shared
+
+        batch = list(b.minibatches(3, shuffle=False))[0]
+        self.assertTrue(np.array_equal(batch.obs_first[:, 0, 0], [0, 1, 2]))
+        self.assertTrue(np.array_equal(batch.obs_second[:, 0, 0], [1, 2, 9]))
+        self.assertTrue(np.array_equal(batch.labels, [0, 0, 1]))
+
+        b.trim_at(1)
+        self.assertEqual(b.frame_store.num_frames(), 2)  # only frames 0 and 1 are still referenced
+
+        # released slots are reused
+        b.add_pairs(obs, first=np.array([5]), second=np.array([6]), labels=[1])
+        self.assertEqual(b.frame_store.num_frames(), 4)
+        self.assertEqual(b.frame_store._size, 4)
+        self.assertTrue(np.array_equal(b.obs_first[:, 0, 0], [0, 5]))
+        self.assertTrue(np.array_equal(b.obs_second[:, 0, 0], [1, 6]))
+
+        b.clear()
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.frame_store.num_frames(), 0)
+
+    def test_buffer_memmap(self):
+        scratch_dir = tempfile.mkdtemp()
+
+        b = Buffer(capacity=100, scratch_dir=scratch_dir)
+        b.add(obs=np.full([8, 8, 3], 1, dtype=np.uint8), labels=1)
+        self.assertEqual(b._capacity, 100)
+        self.assertIsInstance(b._data['obs'], np.memmap)
+
+        for i in range(2, 150):  # exceed the reserved capacity
+            b.add(obs=np.full([8, 8, 3], i, dtype=np.uint8), labels=i)
+
+        self.assertEqual(len(b), 149)
+        self.assertIsInstance(b._data['obs'], np.memmap)
+        self.assertTrue(np.array_equal(b.obs[:, 0, 0, 0], np.arange(1, 150)))
+        self.assertTrue(np.array_equal(b.labels, np.arange(1, 150)))
+
+        pairs = PairBuffer(capacity=10, scratch_dir=scratch_dir)
+        pairs.add_pairs(b.obs, first=np.arange(20), second=np.arange(1, 21), labels=np.zeros(20))
+        batch = pairs.sample(5)
+        self.assertTrue(np.array_equal(batch.obs_first[:, 0, 0, 0] + 1, batch.obs_second[:, 0, 0, 0]))
+
+        del b, pairs
+        gc.collect()
+        self.assertEqual(os.listdir(scratch_dir), [])  # temporary files are removed with the buffer
+        shutil.rmtree(scratch_dir)
+
+    def test_stacked_frame_store(self):
+        num_envs, stack, rollout = 4, 4, 64
+        rng = np.random.RandomState(0)
+
+        for frame_shape in [(21, 21), (21, 21, 3), (64, )]:
+            store = StackedFrameStore(stack)
+            envs_frames = [deque([rng.randint(0, 255, frame_shape, dtype=np.uint8)] * stack) for _ in range(num_envs)]
+
+            all_obs, all_ids = [], []
+            for step in range(rollout):
+                for env_idx, frames in enumerate(envs_frames):
+                    if step % 20 == 10 + env_idx:
+                        # episode reset, same as StackFramesWrapper
+                        frames.extend([rng.randint(0, 255, frame_shape, dtype=np.uint8)] * stack)
+                    else:
+                        frames.append(rng.randint(0, 255, frame_shape, dtype=np.uint8))
+                    while len(frames) > stack:
+                        frames.popleft()
+
+                # frames are stacked along the last axis
+                obs = np.stack([np.concatenate([f[..., None] if len(frame_shape) == 2 else f for f in frames], -1)
+                                for frames in envs_frames])
+                all_obs.append(obs)
+                all_ids.append(store.add(obs))
+
+            all_obs, all_ids = np.concatenate(all_obs), np.concatenate(all_ids)
+            self.assertEqual(len(store), num_envs * rollout)
+            self.assertTrue(np.array_equal(store[all_ids], all_obs))
+            self.assertTrue(np.array_equal(store[all_ids[[5, 100, 17]]], all_obs[[5, 100, 17]]))
+
+            # most of the observations share all but one frame with the previous one
+            self.assertLess(store.num_frames(), num_envs * (rollout + 2 * stack))
+            log.debug(
+                'Frame shape %r, %d bytes, %d bytes without dedup', frame_shape, store.nbytes(), store.stacked_nbytes(),
+            )
+            self.assertLess(store.nbytes(), store.stacked_nbytes() / 2)
+
+            store.clear()
+            self.assertEqual(len(store), 0)
+
+    def test_buffer_minibatches_performance(self):
+        num_samples, batch_size = 2000, 256
+        b = Buffer()
+        b.add_many(obs=np.zeros([num_samples, 84, 84, 3], dtype=np.uint8), labels=np.arange(num_samples))
+
+        t = Timing()
+        with t.timeit('shuffle_epoch'):
+            b.shuffle_data()
+            for i in range(0, len(b) - 1, batch_size):
+                _ = b.obs[i:i + batch_size], b.labels[i:i + batch_size]
+
+        labels = []
+        with t.timeit('minibatches_epoch'):
+            for batch in b.minibatches(batch_size):
+                self.assertEqual(batch.obs.shape[1:], (84, 84, 3))
+                self.assertEqual(len(batch.obs), len(batch.labels))
+                self.assertLessEqual(len(batch.labels), batch_size)
+                labels.append(batch.labels)
+
+        # every sample is in exactly one minibatch
+        self.assertEqual(sorted(np.concatenate(labels)), sorted(b.labels))
+
+        log.debug('Timing: %s', t)
+
+
+class TestPrefetch(TestCase):
+    @staticmethod
+    def _batches(num_batches, prepare_time=0.0):
+        for i in range(num_batches):
+            time.sleep(prepare_time)
+            yield np.full(4, i)
+
+    def test_prefetch_batches(self):
+        for num_prefetch in [0, 1, 3]:
+            t = Timing()
+            batches = list(prefetch_batches(self._batches(10), num_prefetch, t, key_prefix='test_'))
+            self.assertEqual([b[0] for b in batches], list(range(10)))
+            for key in ('test_feed', 'test_compute', 'test_prepare'):
+                self.assertIn(key, t)
+
+        # training loop can stop early, background thread should not get stuck
+        threads_before = threading.active_count()
+        for i, batch in enumerate(prefetch_batches(self._batches(100), 2)):
+            if i >= 3:
+                break
+        self.assertEqual(threading.active_count(), threads_before)
+
+        def failing_batches():
+            yield 0
+            raise ValueError('broken batch')
+
+        with self.assertRaises(ValueError):
+            list(prefetch_batches(failing_batches(), 2))
+
+    def test_prefetch_overlap(self):
+        """Batch preparation is hidden behind the (simulated) training step."""
+        num_batches, step_time = 10, 0.02
+
+        t = Timing()
+        for _ in prefetch_batches(self._batches(num_batches, prepare_time=step_time), 2, t):
+            time.sleep(step_time)
+
+        log.debug('Prefetch timing: %s', t)
+        self.assertLess(t.feed, 0.5 * num_batches * step_time)
+        self.assertGreater(t.prepare, 0.9 * num_batches * step_time)
@@ -3,6 +3,7 @@ import math
 import random
 import time
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from os.path import join
 
@@ -18,20 +19,22 @@ from algorithms.multi_env import MultiEnv
 from algorithms.tmax.graph_encoders import make_graph_encoder
 from algorithms.tmax.locomotion import LocomotionNetwork, LocomotionBuffer, LocomotionNetworkParams
 from algorithms.tmax.navigator import Navigator, NavigatorNaive
-from algorithms.tmax.tmax_utils import TmaxMode, TmaxTrajectoryBuffer
+from algorithms.tmax.tmax_utils import TmaxMode, TmaxTrajectoryBuffer, BudgetedScheduler
 from algorithms.topological_maps.map_builder import MapBuilder, MapBuilderParams
 from algorithms.topological_maps.topological_map import TopologicalMap, map_summaries, hash_observation
 from algorithms.utils.algo_utils import EPS, num_env_steps, main_observation, goal_observation, choice_weighted
+from algorithms.utils.buffer import StackedFrameStore
 from algorithms.utils.encoders import make_encoder, make_encoder_with_goal, get_enc_params
 from algorithms.utils.env_wrappers import main_observation_space, is_goal_based_env
 from algorithms.utils.models import make_model
+from algorithms.utils.prefetch import prefetch_batches
 from algorithms.utils.tf_utils import dense, count_total_parameters, placeholder_from_space, placeholders, \
     image_summaries_rgb, summary_avg_min_max, merge_summaries, tf_shape, placeholder
 from utils.distributions import CategoricalProbabilityDistribution
 from utils.envs.generate_env_map import generate_env_map
 from utils.tensorboard import image_summary
 from utils.timing import Timing
-from utils.utils import log, AttrDict, numpy_all_the_way, model_dir, max_with_idx, ensure_dir_exists, min_with_idx
+from utils.utils import log, AttrDict, model_dir, max_with_idx, ensure_dir_exists
 
 
 class ActorCritic:
@@ -163,21 +166,7 @@ class ActorCritic:
 
 
 class TmaxPPOBuffer(PPOBuffer):
-    def __init__(self):
-        super(TmaxPPOBuffer, self).__init__()
-        self.neighbors, self.num_neighbors = None, None
-        self.modes = None
-        self.masks = None
-        self.timer = None
-        self.is_random = None
-
-    def reset(self):
-        super(TmaxPPOBuffer, self).reset()
-        self.neighbors, self.num_neighbors = [], []
-        self.modes = []
-        self.masks = []
-        self.timer = []
-        self.is_random = []
+    data_keys = PPOBuffer.data_keys + ('neighbors', 'num_neighbors', 'modes', 'masks', 'timer', 'is_random')
 
     # noinspection PyMethodOverriding
     def add(
@@ -185,28 +174,23 @@ class TmaxPPOBuffer(PPOBuffer):
             values, neighbors, num_neighbors, modes, masks, timer, is_random,
     ):
         """Append one-step data to the current batch of observations."""
-        args = copy.copy(locals())
-        super(TmaxPPOBuffer, self)._add_args(args)
+        self._add_step(
+            obs=obs, goals=goals, actions=actions, action_probs=action_probs, rewards=rewards, dones=dones,
+            values=values, neighbors=neighbors, num_neighbors=num_neighbors, modes=modes, masks=masks, timer=timer,
+            is_random=is_random,
+        )
 
     def split_by_mode(self):
+        """Separate buffer for every mode, random actions and masked experience are discarded."""
+        valid = np.logical_not(self.is_random) & (self.masks != 0)
+
         buffers = {}
         for mode in TmaxMode.all_modes():
             buffers[mode] = TmaxPPOBuffer()
-            buffers[mode].reset()
-
-        for i in range(len(self)):
-            if self.is_random[i] or self.masks[i] == 0:
-                continue
-
-            mode = self.modes[i]
-            for key, x in self.__dict__.items():
-                if x is None or x.size == 0:
-                    continue
-
-                buffers[mode].__dict__[key].append(x[i])
-
-        for mode in TmaxMode.all_modes():
-            buffers[mode].to_numpy()
+            indices = np.nonzero(valid & (self.modes == mode))[0]
+            for key in self.data_keys:
+                x = getattr(self, key)
+                setattr(buffers[mode], key, np.empty(0) if x is None or x.size == 0 else x[indices])
 
         return buffers
 
@@ -272,6 +256,21 @@ class TmaxManager:
 
         self.locomotion_success = deque([], maxlen=300)
 
+        # persistent maps for the locomotion stage can be built in the background (see async_stage_transition)
+        self._stage_transition_executor = None
+        self._stage_transition = None
+        self._stage_transition_trajectories = []  # exploration trajectories used to build the maps
+        self.stage_transition_stall = 0.0  # how long the rollout was blocked by the last stage transition
+
+        # expensive work at the episode boundaries can be spread over several steps
+        self.scheduler = BudgetedScheduler(self.params.new_episode_time_budget)
+        self._maps_to_update_value_estimates = {}
+
+        # landmark value estimates, only valid for the critic_step at which they were calculated
+        self._value_estimates = {}  # landmark hash -> value estimate
+        self._value_estimates_critic_step = None
+        self.value_estimates_computed = self.value_estimates_reused = 0
+
     def initialize(self, obs, info, env_steps):
         if self.initialized:
             return
@@ -326,6 +325,12 @@ class TmaxManager:
         if len(self.sparse_persistent_maps) > 0:
             self._save_map(self.sparse_persistent_maps[-1], 'sparse', is_sparse=True)
 
+    def finalize(self):
+        """Wait for the background map building (if any), it uses the TF session."""
+        if self._stage_transition_executor is not None:
+            self._stage_transition_executor.shutdown(wait=True)
+            self._stage_transition_executor = None
+
     def _log_verbose(self, s, *args):
         if self._verbose:
             log.debug(s, *args)
@@ -543,58 +548,58 @@ class TmaxManager:
         return best_trajectory_idx, max_landmarks
 
     @staticmethod
-    def _pick_best_exploration_trajectory_avg_distance(agent, trajectories, curr_sparse_map):
-        distance_net = agent.curiosity.distance
+    def _pick_best_exploration_trajectory_avg_distance(agent, trajectories, curr_sparse_map, distance_net=None):
+        if distance_net is None:
+            distance_net = agent.curiosity.distance
+
         map_obs = [curr_sparse_map.get_observation(node) for node in curr_sparse_map.graph.nodes]
         map_obs_hash = [hash_observation(o) for o in map_obs]
 
-        all_tr_obs = []
-        avg_distances = []
         timing = Timing()
-        for t_idx, t in enumerate(trajectories):
-            with timing.timeit('traj_distance'):
-                if hasattr(t, 'mode'):
-                    mode = t.mode
-                else:
-                    mode = [TmaxMode.EXPLORATION] * len(t)
-                    log.warning('Trajectory must have mode')
-
-                tr_obs = [t.obs[i] for i in range(len(t)) if mode[i] == TmaxMode.EXPLORATION]
-                all_tr_obs.append(tr_obs)
-
-                batch_size = 1024
-                batch_size = max(batch_size, len(map_obs))
-
-                distances = []
-                j = 0
-                while j < len(tr_obs):
-                    obs, all_map_obs = [], []
-                    obs_hash, all_map_obs_hash = [], []
-                    while j < len(tr_obs) and len(obs) + len(map_obs) <= batch_size:
-                        tr_obs_hash = hash_observation(tr_obs[j])
-                        obs.extend([tr_obs[j]] * len(map_obs))
-                        obs_hash.extend([tr_obs_hash] * len(map_obs))
-                        all_map_obs.extend(map_obs)
-                        all_map_obs_hash.extend(map_obs_hash)
-                        j += 1
-
-                    d = distance_net.distances_from_obs(
-                        agent.session,
-                        obs_first=all_map_obs, obs_second=obs,
-                        hashes_first=all_map_obs_hash, hashes_second=obs_hash,
-                    )
-                    # distances for individual frames
-                    d = [d[k:k + len(map_obs)] for k in range(0, len(d), len(map_obs))]
 
-                    for obs_distance in d:
-                        min_d, min_d_idx = min_with_idx(obs_distance)
-                        distances.append(min_d)
+        all_tr_obs = []
+        for t in trajectories:
+            if hasattr(t, 'mode'):
+                mode = t.mode
+            else:
+                mode = [TmaxMode.EXPLORATION] * len(t)
+                log.warning('Trajectory must have mode')
+
+            tr_obs = [t.obs[i] for i in range(len(t)) if mode[i] == TmaxMode.EXPLORATION]
+            all_tr_obs.append(tr_obs)
+
+        # encode every frame exactly once, all further computations use embeddings
+        with timing.timeit('encode'):
+            map_embeddings = distance_net.encode(agent.session, map_obs, map_obs_hash)
+            all_tr_embeddings = [distance_net.encode(agent.session, tr_obs) for tr_obs in all_tr_obs]
+
+        def avg_distance_to_map(t_idx):
+            start_time = time.time()
+
+            # distance from the closest landmark in the map to every trajectory frame
+            distances = distance_net.distances_matrix(agent.session, map_embeddings, all_tr_embeddings[t_idx])
+            distances = distances.min(axis=0)
+            assert len(distances) == len(all_tr_obs[t_idx])
+            trajectory_avg_distance = np.mean(distances)
 
-                assert len(distances) == len(tr_obs)
-                trajectory_avg_distance = np.mean(distances)
-                avg_distances.append(trajectory_avg_distance)
+            log.debug(
+                'Trajectory %d has avg_distance of %.3f (took %.3f s)',
+                t_idx, trajectory_avg_distance, time.time() - start_time,
+            )
+            return trajectory_avg_distance
 
-            log.debug('Trajectory %d has avg_distance of %.3f (took %s)', t_idx, trajectory_avg_distance, timing)
+        with timing.timeit('traj_distance'):
+            num_threads = agent.params.trajectory_scoring_threads
+            if num_threads > 1:
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    avg_distances = list(executor.map(avg_distance_to_map, range(len(trajectories))))
+            else:
+                avg_distances = [avg_distance_to_map(t_idx) for t_idx in range(len(trajectories))]
+
+        log.debug(
+            'Avg. distance to map for %d trajectories took %.3f s per trajectory (%s)',
+            len(trajectories), timing.traj_distance / max(1, len(trajectories)), timing,
+        )
 
         distance_threshold = np.percentile(avg_distances, 90)
         trajectory_candidates = []
@@ -612,18 +617,12 @@ class TmaxManager:
         best_avg_dist_to_self = -1
         best_trajectory_idx = 0
         for t_idx in trajectory_candidates:
-            tr_obs = all_tr_obs[t_idx]
-            tr_keyframes = tr_obs[keyframe_distance::keyframe_distance]
-
-            distances_to_self = []
-            for kf_idx, keyframe in enumerate(tr_keyframes):
-                other_keyframes = [tr_keyframes[k] for k in range(len(tr_keyframes)) if k != kf_idx]
-                d = distance_net.distances_from_obs(
-                    agent.session, obs_first=[keyframe] * len(other_keyframes), obs_second=other_keyframes,
-                )
-                # log.debug('Distances to self: %r', d)
-                min_d, min_d_idx = min_with_idx(d)
-                distances_to_self.append(min_d)
+            tr_keyframes = all_tr_embeddings[t_idx][keyframe_distance::keyframe_distance]
+
+            # distance from every keyframe to the closest other keyframe
+            distances_to_self = distance_net.distances_matrix(agent.session, tr_keyframes, tr_keyframes)
+            np.fill_diagonal(distances_to_self, np.inf)
+            distances_to_self = distances_to_self.min(axis=1) if len(tr_keyframes) > 1 else []
 
             avg_distance_to_self = np.mean(distances_to_self)
             log.debug('Avg distance to self for %d is %.3f', t_idx, avg_distance_to_self)
@@ -647,35 +646,31 @@ class TmaxManager:
 
         return best_trajectory_idx, avg_distances[best_trajectory_idx]
 
-    def _prepare_persistent_map_for_locomotion(self):
-        """Pick an exploration trajectory and turn it into a dense persistent map."""
-        log.warning('Prepare persistent map for locomotion!')
-
-        if len(self.exploration_trajectories) <= 0:
-            # we don't have any trajectories yet, need more exploration
-            return False
-
-        # trajectory_rewards = [t[0] for t in self.exploration_trajectories]
-        # log.info('Best trajectories rewards: %r', trajectory_rewards)
-
-        trajectories = [t[1] for t in self.exploration_trajectories]
+    def _build_persistent_maps_for_locomotion(self, trajectories, curr_sparse_map, curr_dense_map, distance_net=None):
+        """
+        Pick an exploration trajectory and add it to the (copies of) persistent maps.
+        Does not modify the state of the manager, so can be called from the background thread, in which case
+        distance_net should be a snapshot with its own embedding cache (see DistanceBackend.snapshot).
+        """
+        t = Timing()
 
         # truncate trajectories
-        for t_idx, t in enumerate(trajectories):
-            first_exploration_frame = len(t)
-            for i in range(len(t)):
-                if t.mode[i] == TmaxMode.EXPLORATION:
+        for t_idx, tr in enumerate(trajectories):
+            first_exploration_frame = len(tr)
+            for i in range(len(tr)):
+                if tr.mode[i] == TmaxMode.EXPLORATION:
                     first_exploration_frame = i
                     break
 
-            t.trim_at(first_exploration_frame + self.params.max_exploration_trajectory)
-            log.info('Trimmed trajectory %d at %d frames (first expl frame %d)', t_idx, len(t), first_exploration_frame)
-
-        curr_sparse_map = copy.deepcopy(self.sparse_persistent_maps[-1])
+            tr.trim_at(first_exploration_frame + self.params.max_exploration_trajectory)
+            log.info(
+                'Trimmed trajectory %d at %d frames (first expl frame %d)', t_idx, len(tr), first_exploration_frame,
+            )
 
-        best_trajectory_idx, best_trajectory_dist = self._pick_best_exploration_trajectory_avg_distance(
-            self.agent, trajectories, curr_sparse_map,
-        )
+        with t.timeit('pick_best_trajectory'):
+            best_trajectory_idx, best_trajectory_dist = self._pick_best_exploration_trajectory_avg_distance(
+                self.agent, trajectories, curr_sparse_map, distance_net,
+            )
 
         # best_trajectory_idx, best_tr_reward = self._pick_best_exploration_trajectory(
         #     self.agent, trajectories, trajectory_rewards, curr_sparse_map,
@@ -684,35 +679,81 @@ class TmaxManager:
         best_trajectory = trajectories[best_trajectory_idx]
         best_trajectory.save(self.params.experiment_dir())
 
-        map_builder = MapBuilder(self.agent)
+        map_builder = MapBuilder(self.agent, distance_net)
 
         # best_trajectory = map_builder.sparsify_trajectory(best_trajectory)
 
-        # reset exploration trajectories
-        self.exploration_trajectories.clear()
+        with t.timeit('build_maps'):
+            is_frame_a_landmark = map_builder.add_trajectory_to_sparse_map_fixed_landmarks(
+                curr_sparse_map, best_trajectory,
+            )
+            landmark_frames = np.nonzero(is_frame_a_landmark)[0]
+            log.debug('Added best trajectory to sparse map, landmark frames: %r', landmark_frames)
 
-        curr_dense_map = copy.deepcopy(self.dense_persistent_maps[-1])
-        curr_sparse_map = copy.deepcopy(self.sparse_persistent_maps[-1])
+            new_dense_map = map_builder.add_trajectory_to_dense_map(curr_dense_map, best_trajectory)
+            map_builder.calc_distances_to_landmarks(curr_sparse_map, new_dense_map)
+
+        # just in case
+        new_dense_map.new_episode()
+        curr_sparse_map.new_episode()
+
+        with t.timeit('save'):
+            log.info('Saving new persistent maps...')
+            self._save_map(new_dense_map, 'dense', is_sparse=False)
+            self._save_map(curr_sparse_map, 'sparse', is_sparse=True)
 
-        is_frame_a_landmark = map_builder.add_trajectory_to_sparse_map_fixed_landmarks(curr_sparse_map, best_trajectory)
-        landmark_frames = np.nonzero(is_frame_a_landmark)[0]
-        log.debug('Added best trajectory to sparse map, landmark frames: %r', landmark_frames)
+        log.debug('Persistent maps for locomotion prepared, timing: %s', t)
+        return curr_sparse_map, new_dense_map
 
-        self.sparse_persistent_maps.append(curr_sparse_map)
-        self.sparse_map_size_before_locomotion = self.sparse_persistent_maps[-1].num_landmarks()
+    def _switch_persistent_maps(self, new_sparse_map, new_dense_map):
+        """Envs will start using new maps at the beginning of the next episode."""
+        self.sparse_persistent_maps.append(new_sparse_map)
+        self.sparse_map_size_before_locomotion = new_sparse_map.num_landmarks()
 
-        new_dense_map = map_builder.add_trajectory_to_dense_map(curr_dense_map, best_trajectory)
         self.dense_persistent_maps.append(new_dense_map)
-        self.dense_map_size_before_locomotion = self.dense_persistent_maps[-1].num_landmarks()
+        self.dense_map_size_before_locomotion = new_dense_map.num_landmarks()
 
-        map_builder.calc_distances_to_landmarks(curr_sparse_map, new_dense_map)
+        # trajectories are discarded only now, so that they can be used again if building the maps failed
+        used = set(id(t) for t in self._stage_transition_trajectories)
+        remaining = [t for t in self.exploration_trajectories if id(t) not in used]
+        self.exploration_trajectories.clear()
+        self.exploration_trajectories.extend(remaining)
+        self._stage_transition_trajectories = []
 
-        # just in case
-        new_dense_map.new_episode()
-        curr_sparse_map.new_episode()
+    def _prepare_persistent_map_for_locomotion(self):
+        """Pick an exploration trajectory and turn it into a dense persistent map."""
+        log.warning('Prepare persistent map for locomotion!')
+
+        if len(self.exploration_trajectories) <= 0:
+            # we don't have any trajectories yet, need more exploration
+            return False
+
+        # trajectory_rewards = [t[0] for t in self.exploration_trajectories]
+        # log.info('Best trajectories rewards: %r', trajectory_rewards)
+
+        self._stage_transition_trajectories = list(self.exploration_trajectories)
+        trajectories = [t[1] for t in self._stage_transition_trajectories]
+
+        # snapshot of the current maps, rollouts continue to modify the originals (e.g. UCB statistics)
+        curr_sparse_map = copy.deepcopy(self.sparse_persistent_maps[-1])
+        curr_dense_map = copy.deepcopy(self.dense_persistent_maps[-1])
+
+        if self.params.async_stage_transition:
+            if self._stage_transition_executor is None:
+                self._stage_transition_executor = ThreadPoolExecutor(max_workers=1)
+
+            # distance net weights must not change until the maps are built, and the worker needs its own cache
+            self.curiosity.distance_training_paused = True
+            distance_net = self.curiosity.distance.snapshot(self.agent.session)
+
+            log.info('Building persistent maps for locomotion in the background...')
+            self._stage_transition = self._stage_transition_executor.submit(
+                self._build_persistent_maps_for_locomotion, trajectories, curr_sparse_map, curr_dense_map, distance_net,
+            )
+        else:
+            new_maps = self._build_persistent_maps_for_locomotion(trajectories, curr_sparse_map, curr_dense_map)
+            self._switch_persistent_maps(*new_maps)
 
-        log.info('Saving new persistent maps...')
-        self.save()
         return True
 
     def _prepare_persistent_map_for_exploration(self):
@@ -734,27 +775,59 @@ class TmaxManager:
         log.debug('Prepared maps for exploration')
 
     def _update_value_estimates(self, m):
+        """Value estimate refreshes requested for multiple maps before they're executed are done in one pass."""
+        self._maps_to_update_value_estimates[id(m)] = m
+        self.scheduler.schedule('value_estimates', self._update_scheduled_value_estimates)
+
+    def _update_scheduled_value_estimates(self):
+        maps = list(self._maps_to_update_value_estimates.values())
+        self._maps_to_update_value_estimates.clear()
+
         t = Timing()
         with t.timeit('value_estimates'):
             if self.global_stage != TmaxMode.EXPLORATION:
                 return
 
-            landmark_observations = [m.get_observation(node) for node in m.graph.nodes]
-            timer = [1.0 for _ in m.graph.nodes]
-
             if self.agent.actor_critic.has_goal:
                 log.warning('Cannot estimate value of the landmark without a goal')
                 return
-            else:
+
+            critic_step = self.agent.critic_step.eval(session=self.agent.session)
+            if critic_step != self._value_estimates_critic_step:
+                # critic has changed, all previous estimates are stale
+                self._value_estimates = {}
+                self._value_estimates_critic_step = critic_step
+
+            landmarks = [(m, node) for m in maps for node in m.graph.nodes]
+
+            # value of the landmark depends only on its observation, so landmarks shared between maps
+            # (e.g. copies of the persistent map) are evaluated once
+            stale = {}
+            for m, node in landmarks:
+                landmark_hash = m.get_hash(node)
+                if landmark_hash not in self._value_estimates:
+                    stale[landmark_hash] = m.get_observation(node)
+
+            stale_hashes, stale_observations = list(stale.keys()), list(stale.values())
+            batch_size = self.params.value_estimates_batch
+            for i in range(0, len(stale_observations), batch_size):
+                observations = stale_observations[i:i + batch_size]
+                timer = [1.0] * len(observations)
                 _, _, values = self.agent.actor_critic.invoke(
-                    self.agent.session, landmark_observations, None, None, None, timer,  # does not work with goals!
+                    self.agent.session, observations, None, None, None, timer,  # does not work with goals!
                 )
 
-            assert len(values) == len(landmark_observations)
-            for i, node in enumerate(m.graph.nodes):
-                m.graph.nodes[node]['value_estimate'] = values[i]
+                assert len(values) == len(observations)
+                for landmark_hash, value in zip(stale_hashes[i:i + batch_size], values):
+                    self._value_estimates[landmark_hash] = value
+
+            self.value_estimates_computed += len(stale_observations)
+            self.value_estimates_reused += len(landmarks) - len(stale_observations)
 
-        log.info('Value estimates updated, took %s', t)
+            for m, node in landmarks:
+                m.graph.nodes[node]['value_estimate'] = self._value_estimates[m.get_hash(node)]
+
+        log.info('Value estimates updated for %d maps, took %s', len(maps), t)
 
     def _delete_old_maps(self, env_maps, maps):
         """Delete old persistent maps that aren't used anymore."""
@@ -772,6 +845,10 @@ class TmaxManager:
             else:
                 return
 
+    def _delete_all_old_maps(self):
+        self._delete_old_maps(self.current_dense_maps, self.dense_persistent_maps)
+        self._delete_old_maps(self.current_sparse_maps, self.sparse_persistent_maps)
+
     def _reset_episodic_memory(self, env_i):
         t = Timing()
         with t.timeit('reset_memory'):
@@ -817,7 +894,8 @@ class TmaxManager:
 
         with t.add_time('reset_mem'):
             # encourage the agent to get out of the explored region
-            self._reset_episodic_memory(env_i)
+            # not needed until the env switches to exploration, so can be delayed
+            self.scheduler.schedule(('reset_memory', env_i), partial(self._reset_episodic_memory, env_i))
 
         self.env_stage[env_i] = self.global_stage
 
@@ -827,8 +905,7 @@ class TmaxManager:
                 self._update_value_estimates(self.current_sparse_maps[env_i])
 
         with t.add_time('delete_old_maps'):
-            self._delete_old_maps(self.current_dense_maps, self.dense_persistent_maps)
-            self._delete_old_maps(self.current_sparse_maps, self.sparse_persistent_maps)
+            self.scheduler.schedule('delete_old_maps', self._delete_all_old_maps)
 
         self.episode_frames[env_i] = 0
 
@@ -853,9 +930,51 @@ class TmaxManager:
         assert self.locomotion_targets[env_i] is not None
         assert self.locomotion_final_targets[env_i] is not None
 
+    def _stage_changed_to_locomotion(self, env_steps):
+        self.global_stage = TmaxMode.LOCOMOTION
+        self.last_stage_change = env_steps
+        log.debug('Stage changed to Locomotion')
+
+        if self.params.locomotion_network_checkpoint is not None or self.params.naive_locomotion:
+            # we want to switch back to exploration right away
+            # locomotion stage not required, because locomotion network is already trained
+            self.stage_change_required = True
+
+    def _stage_change_to_locomotion_failed(self):
+        log.warning('Failed to switch stage to locomotion, environment not explored enough!')
+        # little hack to give us more time for exploration
+        self.last_stage_change += self.params.stage_duration // 5
+
+    def _finish_stage_transition(self, env_steps):
+        """Switch to the maps built in the background, this happens between two rollout steps."""
+        stage_transition, self._stage_transition = self._stage_transition, None
+        self.curiosity.distance_training_paused = False
+
+        try:
+            new_maps = stage_transition.result()
+        except Exception as exc:
+            log.exception('Could not build persistent maps in the background: %r', exc)
+            self._stage_change_to_locomotion_failed()
+            return
+
+        self._switch_persistent_maps(*new_maps)
+        self._stage_changed_to_locomotion(env_steps)
+
     def _update_stage(self, env_steps):
+        stall_start = time.time()
+        stage_changed = False
+
+        if self._stage_transition is not None:
+            if not self._stage_transition.done():
+                # new persistent maps are not ready yet, keep collecting experience
+                return
+
+            self._finish_stage_transition(env_steps)
+            stage_changed = True
+
         if env_steps - self.last_stage_change > self.params.stage_duration or self.stage_change_required:
             self.stage_change_required = False
+            stage_changed = True
 
             if self.global_stage == TmaxMode.LOCOMOTION:
                 self.global_stage = TmaxMode.EXPLORATION
@@ -868,27 +987,23 @@ class TmaxManager:
                     self.stage_change_required = True
             else:
                 success = self._prepare_persistent_map_for_locomotion()
-                if success:
-                    self.global_stage = TmaxMode.LOCOMOTION
-                    self.last_stage_change = env_steps
-                    log.debug('Stage changed to Locomotion')
-
-                    if self.params.locomotion_network_checkpoint is not None or self.params.naive_locomotion:
-                        # we want to switch back to exploration right away
-                        # locomotion stage not required, because locomotion network is already trained
-                        self.stage_change_required = True
-                else:
-                    log.warning('Failed to switch stage to locomotion, environment not explored enough!')
-                    # little hack to give us more time for exploration
-                    self.last_stage_change += self.params.stage_duration // 5
+                if not success:
+                    self._stage_change_to_locomotion_failed()
+                elif self._stage_transition is None:
+                    self._stage_changed_to_locomotion(env_steps)
+
+        if stage_changed:
+            self.stage_transition_stall = time.time() - stall_start
+            log.info('Stage transition blocked the rollout for %.3f seconds', self.stage_transition_stall)
 
         if self.stage_change_required:
             self._update_stage(env_steps)
 
-    def _update_locomotion(self, next_obs):
-        next_target, next_target_d = self.navigator.get_next_target(
-            self.current_dense_maps, next_obs, self.locomotion_final_targets, self.episode_frames,
-        )
+    def _update_locomotion(self, next_obs, timing):
+        with timing.add_time('navigator'):
+            next_target, next_target_d = self.navigator.get_next_target(
+                self.current_dense_maps, next_obs, self.locomotion_final_targets, self.episode_frames, timing,
+            )
 
         for env_i in range(self.num_envs):
             if self.mode[env_i] != TmaxMode.LOCOMOTION:
@@ -931,6 +1046,8 @@ class TmaxManager:
 
             if end_locomotion:
                 if exploration_stage:
+                    # episodic memory must be ready before we start exploring
+                    self.scheduler.run_now(('reset_memory', env_i))
                     self.mode[env_i] = TmaxMode.EXPLORATION
                     self.exploration_started[env_i] = self.episode_frames[env_i]
                     log.info('Switched mode to exploration for env %d at %d', env_i, self.exploration_started[env_i])
@@ -976,7 +1093,7 @@ class TmaxManager:
                 curiosity_bonus = self._update_curiosity(obs, next_obs, dones, infos)
 
         with timing.add_time('update_locomotion'):
-            self._update_locomotion(next_obs)
+            self._update_locomotion(next_obs, timing)
 
         with timing.add_time('new_episode'):
             new_ep_timing = Timing()
@@ -998,6 +1115,10 @@ class TmaxManager:
             #             self.random_mode[env_i] = True
             #             done_flags[env_i] = True  # for RL purposes this is the end of the episode
 
+        if len(self.scheduler) > 0:
+            with timing.add_time('scheduled_work'):
+                self.scheduler.step()
+
         self._update_stage(env_steps)
 
         # combine final rewards and done flags
@@ -1053,9 +1174,22 @@ class AgentTMAX(AgentLearner):
             self.max_exploration_trajectory = 1900  # should be less than exploration budget
             self.max_travel_per_stage = 1900
 
+            self.trajectory_scoring_threads = 1  # score exploration trajectories in parallel at the end of the stage
+
             self.locomotion_experience_replay = True
 
             self.stage_duration = 10000000
+            self.async_stage_transition = False  # build persistent maps for the next stage in a background thread
+            self.new_episode_time_budget = None  # seconds per step for delayed episode-boundary work (None - no delay)
+            self.value_estimates_batch = 512  # max landmarks per critic pass when updating value estimates
+
+            # >1: env observations are stacks of this many frames (see StackFramesWrapper), PPO buffer then stores
+            # every frame only once and stacked observations are rebuilt for every minibatch
+            self.dedup_stacked_frames = 0
+
+            # minibatches for actor, critic and locomotion training are prepared this many steps ahead in a background
+            # thread (0 - prepare every minibatch right before session.run)
+            self.train_prefetch_batches = 2
 
             self.locomotion_network_checkpoint = None
             self.persistent_map_checkpoint = None
@@ -1110,6 +1244,10 @@ class AgentTMAX(AgentLearner):
         self.curiosity = ECRMapModule(env, params)
         self.curiosity.distance_buffer = DistanceBuffer(params)
 
+        self.frame_stack_store = None
+        if self.params.dedup_stacked_frames > 1:
+            self.frame_stack_store = StackedFrameStore(self.params.dedup_stacked_frames)
+
         # reuse distance network from the curiosity module
         self.distance = self.curiosity.distance
 
@@ -1346,6 +1484,10 @@ class AgentTMAX(AgentLearner):
         super().initialize()
         self.curiosity.initialize(self.session)
 
+    def finalize(self):
+        self.tmax_mgr.finalize()
+        super().finalize()
+
     def initialize_variables(self):
         checkpoint_dir = model_dir(self.params.experiment_dir())
         try:
@@ -1428,6 +1570,15 @@ class AgentTMAX(AgentLearner):
         summary_obj.value.add(tag='tmax/global_stage', simple_value=tmax_mgr.global_stage)
         summary_obj.value.add(tag='tmax/avg_mode', simple_value=np.mean(tmax_mgr.mode))
         summary_obj.value.add(tag='tmax/avg_env_stage', simple_value=np.mean(tmax_mgr.env_stage))
+        summary_obj.value.add(tag='tmax/stage_transition_stall', simple_value=tmax_mgr.stage_transition_stall)
+        summary_obj.value.add(tag='tmax/scheduled_tasks_pending', simple_value=len(tmax_mgr.scheduler))
+        summary_obj.value.add(tag='tmax/scheduled_tasks_merged', simple_value=tmax_mgr.scheduler.num_merged)
+        summary_obj.value.add(tag='tmax/value_estimates_computed', simple_value=tmax_mgr.value_estimates_computed)
+        summary_obj.value.add(tag='tmax/value_estimates_reused', simple_value=tmax_mgr.value_estimates_reused)
+
+        navigator = tmax_mgr.navigator
+        summary_obj.value.add(tag='tmax/navigator_pairs_requested', simple_value=navigator.num_pairs_requested)
+        summary_obj.value.add(tag='tmax/navigator_pairs_evaluated', simple_value=navigator.num_pairs_evaluated)
 
         self._landmark_summaries(self.tmax_mgr.dense_persistent_maps[-1], env_steps)
 
@@ -1471,7 +1622,7 @@ class AgentTMAX(AgentLearner):
         sq_sz = 5  # size of square to indicate TmaxMode in gifs
 
         for trajectory in trajectory_buffer.complete_trajectories[:num_envs]:
-            img_array = numpy_all_the_way(trajectory.obs)[:, :, :, -3:]
+            img_array = trajectory.obs[:, :, :, -3:].copy()  # we draw on the frames, don't touch the trajectory
             for i in range(img_array.shape[0]):
                 if trajectory.is_random[i]:
                     color = [0, 0, 255]  # blue for random actions
@@ -1668,40 +1819,60 @@ class AgentTMAX(AgentLearner):
 
         return main_obs, goal_obs
 
-    def _train_actor(self, buffer, env_steps, objectives, actor_critic, train_actor, actor_step, actor_summaries):
+    def _store_observations(self, observations):
+        """With frame stack dedup PPO buffer holds observation ids instead of the observations."""
+        if self.frame_stack_store is None:
+            return observations
+        return self.frame_stack_store.add(observations)
+
+    def _gather_observations(self, obs):
+        if self.frame_stack_store is None:
+            return obs
+        return self.frame_stack_store[obs]
+
+    def _ppo_feed_dicts(self, buffer, actor_critic, placeholder_keys):
+        """Feed dicts for all minibatches of the PPO buffer, placeholder_keys maps placeholders to buffer keys."""
+        for start in range(0, len(buffer), self.params.batch_size):
+            end = start + self.params.batch_size
+
+            feed_dict = actor_critic.input_dict(
+                self._gather_observations(buffer.obs[start:end]), buffer.goals[start:end],
+                buffer.neighbors[start:end], buffer.num_neighbors[start:end],
+                buffer.timer[start:end],
+            )
+            for placeholder, key in placeholder_keys.items():
+                feed_dict[placeholder] = getattr(buffer, key)[start:end]
+
+            yield feed_dict
+
+    def _train_actor(
+            self, buffer, env_steps, objectives, actor_critic, train_actor, actor_step, actor_summaries, timing=None,
+    ):
         """Train actor for multiple epochs on all collected experience."""
         summary = None
         step = actor_step.eval(session=self.session)
         if len(buffer) <= 0:
             return step
 
+        placeholder_keys = {
+            self.ph_actions: 'actions', self.ph_old_action_probs: 'action_probs', self.ph_advantages: 'advantages',
+            self.ph_returns: 'returns', self.ph_masks: 'masks',
+        }
+
         for epoch in range(self.params.ppo_epochs):
             buffer.shuffle()
             sample_kl = []  # sample kl divergences for all mini batches in buffer
 
-            for i in range(0, len(buffer), self.params.batch_size):
+            feed_dicts = prefetch_batches(
+                self._ppo_feed_dicts(buffer, actor_critic, placeholder_keys),
+                self.params.train_prefetch_batches, timing, key_prefix='ppo_',
+            )
+
+            for feed_dict in feed_dicts:
                 with_summaries = self._should_write_summaries(step) and summary is None
                 summaries = [actor_summaries] if with_summaries else []
 
-                start, end = i, i + self.params.batch_size
-
-                policy_input = actor_critic.input_dict(
-                    buffer.obs[start:end], buffer.goals[start:end],
-                    buffer.neighbors[start:end], buffer.num_neighbors[start:end],
-                    buffer.timer[start:end],
-                )
-
-                result = self.session.run(
-                    [objectives.sample_kl, train_actor] + summaries,
-                    feed_dict={
-                        self.ph_actions: buffer.actions[start:end],
-                        self.ph_old_action_probs: buffer.action_probs[start:end],
-                        self.ph_advantages: buffer.advantages[start:end],
-                        self.ph_returns: buffer.returns[start:end],
-                        self.ph_masks: buffer.masks[start:end],
-                        **policy_input,
-                    }
-                )
+                result = self.session.run([objectives.sample_kl, train_actor] + summaries, feed_dict=feed_dict)
 
                 sample_kl.append(result[0])
 
@@ -1722,38 +1893,32 @@ class AgentTMAX(AgentLearner):
 
         return step
 
-    def _train_critic(self, buffer, env_steps, objectives, actor_critic, train_critic, critic_step, critic_summaries):
+    def _train_critic(
+            self, buffer, env_steps, objectives, actor_critic, train_critic, critic_step, critic_summaries, timing=None,
+    ):
         summary = None
         step = critic_step.eval(session=self.session)
 
         if len(buffer) <= 0:
             return
 
+        placeholder_keys = {self.ph_returns: 'returns', self.ph_masks: 'masks'}
+
         prev_loss = 1e10
         for epoch in range(self.params.ppo_epochs):
             losses = []
             buffer.shuffle()
 
-            for i in range(0, len(buffer), self.params.batch_size):
+            feed_dicts = prefetch_batches(
+                self._ppo_feed_dicts(buffer, actor_critic, placeholder_keys),
+                self.params.train_prefetch_batches, timing, key_prefix='ppo_',
+            )
+
+            for feed_dict in feed_dicts:
                 with_summaries = self._should_write_summaries(step) and summary is None
                 summaries = [critic_summaries] if with_summaries else []
 
-                start, end = i, i + self.params.batch_size
-
-                policy_input = actor_critic.input_dict(
-                    buffer.obs[start:end], buffer.goals[start:end],
-                    buffer.neighbors[start:end], buffer.num_neighbors[start:end],
-                    buffer.timer[start:end],
-                )
-
-                result = self.session.run(
-                    [objectives.critic_loss, train_critic] + summaries,
-                    feed_dict={
-                        self.ph_returns: buffer.returns[start:end],
-                        self.ph_masks: buffer.masks[start:end],
-                        **policy_input
-                    },
-                )
+                result = self.session.run([objectives.critic_loss, train_critic] + summaries, feed_dict=feed_dict)
 
                 step += 1
                 losses.append(result[0])
@@ -1788,44 +1953,43 @@ class AgentTMAX(AgentLearner):
         t = Timing()
 
         for epoch in range(num_epochs):
-            with t.timeit('shuffle'):
-                data.shuffle_data()
-            log.info('Shuffling locomotion data took %s', t)
-
             losses = []
 
-            obs_prev, obs_curr, obs_goal = data.buffer.obs_prev, data.buffer.obs_curr, data.buffer.obs_goal
-            actions = data.buffer.actions
+            feed_dicts = (
+                {
+                    locomotion.ph_obs_prev: batch.obs_prev,
+                    locomotion.ph_obs_curr: batch.obs_curr,
+                    locomotion.ph_obs_goal: batch.obs_goal,
+                    locomotion.ph_actions: batch.actions,
+                    locomotion.ph_is_training: True,
+                }
+                for batch in data.buffer.minibatches(batch_size)
+            )
 
-            for i in range(0, len(obs_curr) - 1, batch_size):
-                # noinspection PyProtectedMember
-                with_summaries = self._should_write_summaries(loco_step) and summary is None
-                summaries = [self.loco_summaries] if with_summaries else []
+            with t.timeit('epoch'):
+                for feed_dict in prefetch_batches(feed_dicts, self.params.train_prefetch_batches, t):
+                    # noinspection PyProtectedMember
+                    with_summaries = self._should_write_summaries(loco_step) and summary is None
+                    summaries = [self.loco_summaries] if with_summaries else []
 
-                start, end = i, i + batch_size
+                    objectives = [locomotion.loss, locomotion.train_loco]
 
-                objectives = [locomotion.loss, locomotion.train_loco]
+                    result = self.session.run(objectives + summaries, feed_dict=feed_dict)
 
-                result = self.session.run(
-                    objectives + summaries,
-                    feed_dict={
-                        locomotion.ph_obs_prev: obs_prev[start:end],
-                        locomotion.ph_obs_curr: obs_curr[start:end],
-                        locomotion.ph_obs_goal: obs_goal[start:end],
-                        locomotion.ph_actions: actions[start:end],
-                        locomotion.ph_is_training: True,
-                    }
-                )
+                    loco_step += 1
+                    # noinspection PyProtectedMember
+                    self._maybe_save(loco_step, env_steps)
 
-                loco_step += 1
-                # noinspection PyProtectedMember
-                self._maybe_save(loco_step, env_steps)
+                    losses.append(result[0])
 
-                losses.append(result[0])
+                    if with_summaries:
+                        summary = result[-1]
+                        self.summary_writer.add_summary(summary, global_step=env_steps)
 
-                if with_summaries:
-                    summary = result[-1]
-                    self.summary_writer.add_summary(summary, global_step=env_steps)
+            log.info(
+                'Locomotion epoch %d took %.3f s (total feed %.3f s, compute %.3f s)',
+                epoch + 1, t.epoch, t.feed, t.compute,
+            )
 
             # check loss improvement at the end of each epoch, early stop if necessary
             avg_loss = np.mean(losses)
@@ -1851,12 +2015,12 @@ class AgentTMAX(AgentLearner):
                         step = self._train_actor(
                             buffers[TmaxMode.EXPLORATION], env_steps,
                             self.objectives, self.actor_critic, self.train_actor, self.actor_step,
-                            self.actor_summaries,
+                            self.actor_summaries, timing,
                         )
                         self._train_critic(
                             buffers[TmaxMode.EXPLORATION], env_steps,
                             self.objectives, self.actor_critic, self.train_critic, self.critic_step,
-                            self.critic_summaries,
+                            self.critic_summaries, timing,
                         )
 
         if self.params.locomotion_network_checkpoint is None and not self.params.naive_locomotion:
@@ -1883,7 +2047,7 @@ class AgentTMAX(AgentLearner):
         obs_prev = observations
         infos = multi_env.info()
 
-        buffer = TmaxPPOBuffer()
+        buffer = TmaxPPOBuffer(self.params.rollout)
 
         # separate buffer for complete episode trajectories
         trajectory_buffer = TmaxTrajectoryBuffer(multi_env.num_envs)
@@ -1904,6 +2068,9 @@ class AgentTMAX(AgentLearner):
             batch_start = time.time()
             with timing.timeit('experience'):
                 buffer.reset()
+                if self.frame_stack_store is not None:
+                    self.frame_stack_store.clear()
+
                 for rollout_step in range(self.params.rollout):
                     with timing.add_time('policy'):
                         actions, action_probs, values, masks, policy_goals, modes, timer, is_random = self.policy_step(
@@ -1935,7 +2102,7 @@ class AgentTMAX(AgentLearner):
 
                     # add experience from all environments to the current buffer(s)
                     buffer.add(
-                        observations, policy_goals, actions, action_probs,
+                        self._store_observations(observations), policy_goals, actions, action_probs,
                         rewards, done_flags, values,
                         None, None, modes, masks, timer, is_random,
                     )
@@ -1951,11 +2118,17 @@ class AgentTMAX(AgentLearner):
 
                 # last step values are required for TD-return calculation
                 _, _, values, *_ = self.policy_step(obs_prev, observations, goals, None, None)
-                buffer.values.append(values)
+                buffer.add_last_values(values)
 
             # calculate discounted returns and GAE
             buffer.finalize_batch(self.params.gamma, self.params.gae_lambda)
 
+            if self.frame_stack_store is not None:
+                log.debug(
+                    'Rollout observations take %.1f MB, %.1f MB without frame stack dedup',
+                    self.frame_stack_store.nbytes() / 1e6, self.frame_stack_store.stacked_nbytes() / 1e6,
+                )
+
             if locomotion_buffer is not None:
                 locomotion_buffer.extract_data(trajectory_buffer.complete_trajectories)
 
@@ -65,11 +65,7 @@ def evaluate_locomotion_agent(agent, multi_env):
     navigator._ensure_paths_to_goal_calculated([m] * num_envs, final_goal_idx)
     path_lengths = [0] * num_envs
     for env_i in range(num_envs):
-        location, path_length = 0, 0
-        while location != final_goal_idx[env_i]:
-            location = navigator.paths[env_i][location]
-            path_length += 1
-        path_lengths[env_i] = path_length
+        path_lengths[env_i] = navigator.path_tables[env_i].path_length(0)
 
     frames = 0
     next_target, next_target_d = navigator.get_next_target(
@@ -94,7 +90,7 @@ def evaluate_locomotion_agent(agent, multi_env):
 
             with t.timeit('navigator'):
                 next_target, next_target_d = navigator.get_next_target(
-                    [m] * num_envs, observations, final_goal_idx, [frames] * num_envs,
+                    [m] * num_envs, observations, final_goal_idx, [frames] * num_envs, t,
                 )
 
             for env_i in range(num_envs):
@@ -12,7 +12,7 @@ from algorithms.utils.env_wrappers import reset_with_info
 from algorithms.tmax.agent_tmax import AgentTMAX
 from algorithms.tmax.tmax_utils import parse_args_tmax
 from algorithms.topological_maps.topological_map import TopologicalMap
-from algorithms.utils.trajectory import Trajectory
+from algorithms.utils.trajectory import TrajectoryWriter, new_trajectory_dir
 from utils.envs.atari import atari_utils
 from utils.envs.doom import doom_utils
 from utils.envs.envs import create_env
@@ -64,7 +64,8 @@ def record_trajectory(params, env_id):
 
     m = TopologicalMap(obs, directed_graph=False, initial_info=info, verbose=True)
 
-    trajectory = Trajectory(env_idx=-1)
+    # frames are written to disk as we go, so long recordings don't have to fit in RAM
+    trajectory = TrajectoryWriter(new_trajectory_dir(params.experiment_dir()), env_idx=-1)
     frame = 0
 
     t = Timing()
@@ -78,7 +79,7 @@ def record_trajectory(params, env_id):
             else:
                 action = 0
 
-            trajectory.add(obs, action, info)
+            trajectory.add(obs, actions=action, infos=info)
             m.add_landmark(obs, info, update_curr_landmark=True)
 
             env_obs, rew, done, info = env.step(action)
@@ -95,7 +96,9 @@ def record_trajectory(params, env_id):
     env.render()
     time.sleep(0.2)
 
-    trajectory_dir = trajectory.save(params.experiment_dir())
+    trajectory.close()
+    trajectory_dir = trajectory.trajectory_dir
+    log.info('Saved trajectory to %s', trajectory_dir)
     m.save_checkpoint(trajectory_dir, map_img=map_img, coord_limits=coord_limits, verbose=True)
 
     env.close()
@@ -9,7 +9,7 @@ from algorithms.utils.buffer import Buffer
 from algorithms.multi_env import MultiEnv
 from algorithms.tmax.agent_tmax import AgentTMAX
 from algorithms.tmax.tmax_utils import parse_args_tmax
-from algorithms.utils.trajectory import TrajectoryBuffer, Trajectory
+from algorithms.utils.trajectory import TrajectoryBuffer, open_trajectory, trajectory_dirs
 from utils.envs.envs import create_env
 from utils.timing import Timing
 from utils.utils import log
@@ -20,18 +20,17 @@ def generate_training_data(trajectories, params):
     with timing.timeit('trajectories'):
         close, far = params.close_threshold, params.far_threshold
 
-        trajectory_joined = Trajectory(0)
+        # frames are indexed as if trajectories were joined, but we don't copy them (they can be lazy on-disk readers)
+        episode_ends = np.cumsum([len(t) for t in trajectories])
+        total_len = int(episode_ends[-1]) if len(episode_ends) > 0 else 0
+        trajectory_idx = np.searchsorted(episode_ends, np.arange(total_len), side='right')
 
-        trajectory_idx = []
-        episode_ends = []
-        for i, t in enumerate(trajectories):
-            trajectory_joined.add_trajectory(t)
-            trajectory_idx.extend([i] * len(t))
-            episode_ends.append(len(trajectory_joined))
+        def obs(idx):
+            traj_idx = trajectory_idx[idx]
+            start = episode_ends[traj_idx] - len(trajectories[traj_idx])
+            return trajectories[traj_idx].obs[idx - start]
 
-        obs = trajectory_joined.obs
-
-        indices = list(range(len(trajectory_joined)))
+        indices = list(range(total_len))
         np.random.shuffle(indices)
 
         buffer = Buffer()
@@ -39,7 +38,7 @@ def generate_training_data(trajectories, params):
 
         for i in indices:
             # sample close observation pair
-            close_i = min(i + close, len(trajectory_joined))
+            close_i = min(i + close, total_len)
             first_idx = i
             second_idx = np.random.randint(i, close_i)
 
@@ -47,7 +46,7 @@ def generate_training_data(trajectories, params):
                 if params.distance_symmetric and random.random() < 0.5:
                     first_idx, second_idx = second_idx, first_idx
 
-                buffer.add(obs_first=obs[first_idx], obs_second=obs[second_idx], labels=0)
+                buffer.add(obs_first=obs(first_idx), obs_second=obs(second_idx), labels=0)
                 num_close += 1
 
             # sample far observation pair
@@ -57,7 +56,7 @@ def generate_training_data(trajectories, params):
                     break
 
             if random.random() < 0.3:
-                max_len = len(trajectory_joined)
+                max_len = total_len
             else:
                 max_len = next_episode_end
 
@@ -69,7 +68,7 @@ def generate_training_data(trajectories, params):
                 if params.distance_symmetric and random.random() < 0.5:
                     first_idx, second_idx = second_idx, first_idx
 
-                buffer.add(obs_first=obs[first_idx], obs_second=obs[second_idx], labels=1)
+                buffer.add(obs_first=obs(first_idx), obs_second=obs(second_idx), labels=1)
                 num_far += 1
 
     log.info(
@@ -145,6 +144,36 @@ def train_loop(agent, multi_env):
             log.info('Step %d, avg. fps %.1f, training steps %d, timing: %s', env_steps, avg_fps, step, t)
 
 
+def train_loop_offline(agent, trajectories):
+    """Trajectories are lazy on-disk readers, so the dataset does not have to fit in RAM."""
+    params = agent.params
+    step, env_steps = agent.session.run([agent.curiosity.distance.step, agent.total_env_steps])
+
+    t = Timing()
+
+    num_to_process = 20
+    num_test_data = 5000
+
+    test_trajectories, train_trajectories = trajectories[:num_to_process], trajectories[num_to_process:]
+    if len(train_trajectories) <= 0:
+        log.error('Need more than %d trajectories, found only %d', num_to_process, len(trajectories))
+        return
+
+    test_buffer = Buffer()
+    test_buffer.add_buff(generate_training_data(test_trajectories, params), max_to_add=num_test_data)
+
+    while True:
+        random.shuffle(train_trajectories)
+        for i in range(0, len(train_trajectories), num_to_process):
+            with t.timeit('data'):
+                buffer = generate_training_data(train_trajectories[i:i + num_to_process], params)
+            with t.timeit('train'):
+                step = agent.curiosity.distance.train(buffer, env_steps, agent)
+
+            agent.curiosity.distance.calc_test_error(test_buffer, env_steps, agent)
+            log.info('Training steps %d, timing: %s', step, t)
+
+
 def train_distance(params, env_id):
     def make_env_func():
         e = create_env(env_id)
@@ -153,6 +182,17 @@ def train_distance(params, env_id):
     agent = AgentTMAX(make_env_func, params)
     agent.initialize()
 
+    if params.distance_offline_experiment_dir is not None:
+        try:
+            trajectories = [open_trajectory(d) for d in trajectory_dirs(params.distance_offline_experiment_dir)]
+            log.info('Loaded %d trajectories, %d frames', len(trajectories), sum(len(t) for t in trajectories))
+            train_loop_offline(agent, trajectories)
+        except (Exception, KeyboardInterrupt, SystemExit):
+            log.exception('Interrupt...')
+        finally:
+            agent.finalize()
+        return 0
+
     multi_env = None
     try:
         multi_env = MultiEnv(
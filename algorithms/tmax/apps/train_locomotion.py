@@ -85,44 +85,38 @@ def train_locomotion_net(agent, data, params, env_steps):
     for epoch in range(num_epochs):
         log.info('Epoch %d...', epoch + 1)
 
-        with t.timeit('shuffle'):
-            data.shuffle_data()
-        log.info('Shuffling locomotion data took %s', t)
-
         losses = []
 
-        obs_prev, obs_curr, obs_goal = data.buffer.obs_prev, data.buffer.obs_curr, data.buffer.obs_goal
-        actions = data.buffer.actions
-
-        for i in range(0, len(obs_curr) - 1, batch_size):
-            # noinspection PyProtectedMember
-            with_summaries = agent._should_write_summaries(loco_step) and summary is None
-            summaries = [agent.loco_summaries] if with_summaries else []
-
-            start, end = i, i + batch_size
-
-            objectives = [locomotion.loss, locomotion.train_loco]
+        with t.timeit('epoch'):
+            for batch in data.buffer.minibatches(batch_size):
+                # noinspection PyProtectedMember
+                with_summaries = agent._should_write_summaries(loco_step) and summary is None
+                summaries = [agent.loco_summaries] if with_summaries else []
+
+                objectives = [locomotion.loss, locomotion.train_loco]
+
+                result = agent.session.run(
+                    objectives + summaries,
+                    feed_dict={
+                        locomotion.ph_obs_prev: batch.obs_prev,
+                        locomotion.ph_obs_curr: batch.obs_curr,
+                        locomotion.ph_obs_goal: batch.obs_goal,
+                        locomotion.ph_actions: batch.actions,
+                        locomotion.ph_is_training: True,
+                    }
+                )
 
-            result = agent.session.run(
-                objectives + summaries,
-                feed_dict={
-                    locomotion.ph_obs_prev: obs_prev[start:end],
-                    locomotion.ph_obs_curr: obs_curr[start:end],
-                    locomotion.ph_obs_goal: obs_goal[start:end],
-                    locomotion.ph_actions: actions[start:end],
-                    locomotion.ph_is_training: True,
-                }
-            )
+                loco_step += 1
+                # noinspection PyProtectedMember
+                agent._maybe_save(loco_step, env_steps)
 
-            loco_step += 1
-            # noinspection PyProtectedMember
-            agent._maybe_save(loco_step, env_steps)
+                losses.append(result[0])
 
-            losses.append(result[0])
+                if with_summaries:
+                    summary = result[-1]
+                    agent.summary_writer.add_summary(summary, global_step=env_steps)
 
-            if with_summaries:
-                summary = result[-1]
-                agent.summary_writer.add_summary(summary, global_step=env_steps)
+        log.info('Epoch %d took %.3f s', epoch + 1, t.epoch)
 
         # check loss improvement at the end of each epoch, early stop if necessary
         avg_loss = np.mean(losses)
@@ -1,6 +1,4 @@
 import copy
-import glob
-import pickle
 import sys
 from os.path import join
 
@@ -10,7 +8,7 @@ from algorithms.tmax.agent_tmax import AgentTMAX
 from algorithms.tmax.tmax_utils import parse_args_tmax
 from algorithms.topological_maps.map_builder import MapBuilder
 from algorithms.topological_maps.topological_map import TopologicalMap
-from algorithms.utils.trajectory import Trajectory
+from algorithms.utils.trajectory import Trajectory, open_trajectory, trajectory_dirs
 from utils.envs.envs import create_env
 from utils.envs.generate_env_map import generate_env_map
 from utils.utils import ensure_dir_exists, log
@@ -58,16 +56,12 @@ def trajectory_to_map(params, env_id):
     trajectories_dir = ensure_dir_exists(join(experiment_dir, '.trajectories'))
 
     if params.persistent_map_checkpoint is None:
-        prefix = 'traj_'
-        all_trajectories = glob.glob(f'{trajectories_dir}/{prefix}*')
-        all_trajectories.sort()
-
+        # frames are read from disk lazily, so we don't need all trajectories in RAM
         trajectories = []
-        for i, trajectory_dir in enumerate(all_trajectories):
-            with open(join(trajectory_dir, 'trajectory.pickle'), 'rb') as traj_file:
-                traj = Trajectory(i)
-                traj.__dict__.update(pickle.load(traj_file))
-                trajectories.append(traj)
+        for i, trajectory_dir in enumerate(trajectory_dirs(experiment_dir)):
+            traj = open_trajectory(trajectory_dir)
+            traj.env_idx = i
+            trajectories.append(traj)
     else:
         loaded_persistent_map = TopologicalMap.create_empty()
         loaded_persistent_map.maybe_load_checkpoint(params.persistent_map_checkpoint)
@@ -19,6 +19,8 @@ class LocomotionNetworkParams:
         self.locomotion_experience_replay_batch = 64
         self.locomotion_experience_replay_max_kl = 0.05
         self.locomotion_max_trajectory = 5  # max trajectory length to be utilized during training
+        # keep HER training data in memory-mapped files in this directory instead of RAM
+        self.locomotion_buffer_scratch_dir = None
 
         self.locomotion_encoder = 'resnet'
         self.locomotion_siamese = False
@@ -127,7 +129,13 @@ class LocomotionBuffer:
     def __init__(self, params):
         self.params = params
         self.batch_num = 0
-        self.buffer = Buffer()
+
+        # memory-mapped files are sparse, so we can reserve the whole capacity up front
+        scratch_dir = params.locomotion_buffer_scratch_dir
+        capacity = 0
+        if scratch_dir is not None:
+            capacity = params.locomotion_experience_replay_buffer + params.locomotion_max_trajectory + 1
+        self.buffer = Buffer(capacity=capacity, scratch_dir=scratch_dir)
         self._vis_dirs = deque([])
 
     def extract_data(self, trajectories):
@@ -1,9 +1,10 @@
-import random
-
 import numpy as np
 
+from algorithms.topological_maps.localization import LandmarkCache, distances_unique_pairs
+from algorithms.topological_maps.topological_map import hash_observation
 from algorithms.utils.algo_utils import EPS
-from utils.utils import min_with_idx, log, scale_to_range
+from utils.timing import Timing
+from utils.utils import log, scale_to_range
 
 
 def default_edge_weight(i1, i2, d):
@@ -14,18 +15,94 @@ def default_edge_weight(i1, i2, d):
     return 1
 
 
+# lower bound of default_edge_weight, allows get_path to use A* when landmarks have coordinates
+DEFAULT_MIN_EDGE_WEIGHT = 1
+
+
+class NextHopTable:
+    """
+    Next hop on the shortest path to the goal for every landmark of the map, -1 if not calculated yet.
+    Filled lazily as the agents move through the map, shared by all envs that navigate to the same goal.
+    """
+
+    def __init__(self, m, goal):
+        self.graph = m.graph  # table is valid only for this version of the map, see Navigator._path_table
+        self.num_landmarks = m.num_landmarks()
+        self.goal = goal
+
+        self.next_hop = np.full(max(m.graph.nodes) + 1, -1, dtype=np.int64)
+        self.next_hop[goal] = goal  # once we're already there let the path be trivial
+
+    def is_valid(self, m):
+        return self.graph is m.graph and self.num_landmarks == m.num_landmarks()
+
+    def ensure_path(self, m, from_idx, edge_weight, min_edge_weight=None):
+        if self.next_hop[from_idx] >= 0:
+            # shortest path from this landmark is already calculated
+            return
+
+        path = m.get_path(from_idx, self.goal, edge_weight=edge_weight, min_edge_weight=min_edge_weight)
+
+        if path is None or len(path) <= 0:
+            log.error('Nodes: %r', list(m.graph.nodes))
+            log.error('Path %r', path)
+            log.error('Current landmark: %d', from_idx)
+            log.error('Goal: %d', self.goal)
+
+        assert path is not None and len(path) > 0
+
+        curr_node = from_idx
+        assert path[0] == curr_node
+        for next_node in path[1:]:
+            if self.next_hop[curr_node] >= 0:
+                # next target for the rest of the path is already known
+                break
+
+            self.next_hop[curr_node] = next_node
+            curr_node = next_node
+
+        assert path[-1] == self.goal
+
+    def lookahead(self, from_idx, max_lookahead):
+        lookahead = [from_idx]
+
+        curr_node = from_idx
+        for i in range(max_lookahead):
+            next_node = int(self.next_hop[curr_node])
+            lookahead.append(next_node)
+            if curr_node == next_node:
+                # reached the end of the path
+                break
+
+            curr_node = next_node
+
+        return lookahead
+
+    def path_length(self, from_idx):
+        """Number of hops to the goal, path from from_idx should be calculated already."""
+        path_length, curr_node = 0, from_idx
+        while curr_node != self.goal:
+            curr_node = self.next_hop[curr_node]
+            path_length += 1
+        return path_length
+
+
 class Navigator:
     def __init__(self, agent):
         self.agent = agent
         self.params = agent.params
         self.distance_net = agent.distance
 
-        self.current_landmarks = [0] * self.params.num_envs
-        self.last_made_progress = [0] * self.params.num_envs
-
-        self.paths = [[] for _ in range(self.params.num_envs)]
+        # per-env navigation state
+        num_envs = self.params.num_envs
+        self.current_landmarks = np.zeros(num_envs, dtype=np.int64)
+        self.last_made_progress = np.zeros(num_envs, dtype=np.int64)
+        self.lost_localization_frames = np.zeros(num_envs, dtype=np.int64)
 
-        self.lost_localization_frames = [0] * self.params.num_envs
+        # path to the goal of every env, shared between envs with the same map and goal
+        self.path_tables = [None] * num_envs
+        self._path_tables = dict()
+        self.max_path_tables = 256
 
         # navigation parameters
         self.max_neighborhood_dist = 0.5
@@ -35,14 +112,29 @@ class Navigator:
         self.max_no_progress = 50
 
         self.edge_weight = default_edge_weight
+        self.min_edge_weight = DEFAULT_MIN_EDGE_WEIGHT
+
+        # number of (landmark, observation) pairs requested vs actually evaluated during the last step
+        self.num_pairs_requested = self.num_pairs_evaluated = 0
 
     def reset(self, env_i, m):
         self.current_landmarks[env_i] = 0  # assuming we always start from the same location
         self.last_made_progress[env_i] = 0
         self.lost_localization_frames[env_i] = 0
 
-        # reset shortest paths to the goal because we might have a new map or a new goal
-        self.paths[env_i] = [None] * m.num_landmarks()
+        # we might have a new map or a new goal, the table will be found in _ensure_paths_to_goal_calculated
+        self.path_tables[env_i] = None
+
+    def _path_table(self, m, goal):
+        key = (id(m), goal)
+        table = self._path_tables.get(key)
+        if table is None or not table.is_valid(m):
+            if len(self._path_tables) >= self.max_path_tables:
+                self._path_tables.clear()  # old maps and goals, no point in keeping them around
+
+            table = self._path_tables[key] = NextHopTable(m, goal)
+
+        return table
 
     def _ensure_paths_to_goal_calculated(self, maps, goals):
         for env_i in range(self.params.num_envs):
@@ -51,55 +143,22 @@ class Navigator:
             if m is None or goal is None:
                 continue
 
-            curr_landmark = self.current_landmarks[env_i]
-            if self.paths[env_i][curr_landmark] is not None:
-                # shortest path for this environment is already calculated
-                continue
-
-            path = m.get_path(curr_landmark, goal, edge_weight=self.edge_weight)
-
-            if path is None or len(path) <= 0:
-                log.error('Nodes: %r', list(m.graph.nodes))
-                log.error('Path %r', path)
-                log.error('Current landmark: %d', curr_landmark)
-                log.error('Goal: %d', goal)
-
-            assert path is not None and len(path) > 0
-
-            curr_node = curr_landmark
-            assert path[0] == curr_node
-            for next_node in path[1:]:
-                if self.paths[env_i][curr_node] is not None:
-                    # next target for the rest of the path is already known
-                    break
+            table = self.path_tables[env_i]
+            if table is None or table.goal != goal or not table.is_valid(m):
+                table = self.path_tables[env_i] = self._path_table(m, goal)
 
-                self.paths[env_i][curr_node] = next_node
-                curr_node = next_node
-
-            assert path[-1] == goal
-            self.paths[env_i][goal] = goal  # once we're already there let the path be trivial
+            table.ensure_path(m, self.current_landmarks[env_i], self.edge_weight, self.min_edge_weight)
 
     def _path_lookahead(self, env_i):
-        curr_landmark = self.current_landmarks[env_i]
-        lookahead = [curr_landmark]
-
-        curr_node = curr_landmark
-        for i in range(self.max_lookahead):
-            next_node = self.paths[env_i][curr_node]
-            lookahead.append(next_node)
-            if curr_node == next_node:
-                # reached the end of the path
-                break
-
-            curr_node = next_node
-
-        return lookahead
+        return self.path_tables[env_i].lookahead(self.current_landmarks[env_i], self.max_lookahead)
 
     def _localize_path_lookahead(self, maps, obs, goals):
         self._ensure_paths_to_goal_calculated(maps, goals)
 
         # create a batch of all neighborhood observations from all envs for fast processing on GPU
-        neighborhood_obs, neighborhood_hashes, current_obs = [], [], []
+        # envs usually share the same map, so landmark lookups and identical pairs are deduplicated
+        landmarks = LandmarkCache()
+        neighborhood_obs, neighborhood_hashes, current_obs, current_obs_hashes = [], [], [], []
         neighbor_indices = [[]] * len(maps)
         neighbor_diff = []
         for env_i, m in enumerate(maps):
@@ -113,18 +172,22 @@ class Navigator:
             # curr_landmark = self.current_landmarks[env_i]
             # neighbor_diff.extend([n - curr_landmark for n in neighbors])
             neighbor_diff.extend(np.arange(len(neighbors)))
-            neighborhood_obs.extend([m.get_observation(i) for i in neighbors])
-            neighborhood_hashes.extend([m.get_hash(i) for i in neighbors])
+            for i in neighbors:
+                landmark_obs, landmark_hash, _ = landmarks.get(m, i)
+                neighborhood_obs.append(landmark_obs)
+                neighborhood_hashes.append(landmark_hash)
             current_obs.extend([obs[env_i]] * len(neighbors))
+            current_obs_hashes.extend([hash_observation(obs[env_i])] * len(neighbors))
 
         assert len(neighborhood_obs) == len(current_obs)
         assert len(neighborhood_obs) == len(neighborhood_hashes)
 
-        distances = self.distance_net.distances_from_obs(
-            self.agent.session,
+        distances, num_unique_pairs = distances_unique_pairs(
+            self.agent.session, self.distance_net,
             obs_first=neighborhood_obs, obs_second=current_obs,
-            hashes_first=neighborhood_hashes, hashes_second=None,  # calculate curr obs hashes on the fly
+            hashes_first=neighborhood_hashes, hashes_second=current_obs_hashes,
         )
+        self.num_pairs_requested, self.num_pairs_evaluated = len(neighborhood_obs), num_unique_pairs
 
         c_frames = 0  # set to 0 to disable
         if c_frames != 0:  # mix of both num_frames_diff and distances
@@ -152,85 +215,82 @@ class Navigator:
 
         return neighbor_indices, lookahead_distances
 
-    def get_next_target(self, maps, obs, goals, episode_frames):
+    def get_next_target(self, maps, obs, goals, episode_frames, timing=None):
         """Returns indices of the next locomotion targets for all envs, or nones if we're lost."""
-        neighbors, distances = self._localize_path_lookahead(maps, obs, goals)
+        if timing is None:
+            timing = Timing()
 
         next_target = [None] * self.params.num_envs
         next_target_d = [None] * self.params.num_envs
 
-        for env_i, m in enumerate(maps):
-            if m is None or goals[env_i] is None:
-                continue
-
-            # log.info('Neighbors: %r', neighbors[env_i])
-            # log.info('Distances: %s', ', '.join([f'{d:.3f}' for d in distances[env_i]]))
-
-            distance = distances[env_i]
-            min_d, min_d_idx = min_with_idx(distance[:2])
-            closest_landmark = neighbors[env_i][min_d_idx]
-            prev_landmark = self.current_landmarks[env_i]
-
-            if min_d > self.max_neighborhood_dist:
-                self.lost_localization_frames[env_i] += 1
-                curr_landmark_on_the_path = 0
-            else:
-                self.lost_localization_frames[env_i] = 0
-
-                if min_d_idx == 0 and len(distance) > 1 and distance[1] < random.random() * 0.04:
-                    # current landmark (distance[0]) is the closest, but next landmark is also super close
-                    # set current landmark to be the next landmark on the path to make some progress
-                    min_d_idx = 1
-                    closest_landmark = neighbors[env_i][min_d_idx]
-
-                self.current_landmarks[env_i] = closest_landmark
-                curr_landmark_on_the_path = min_d_idx
-
-            if self.lost_localization_frames[env_i] > self.max_lost_localization:
-                continue
-
-            lookahead_path = neighbors[env_i][curr_landmark_on_the_path:]
-            distance = distance[curr_landmark_on_the_path:]
-
-            target_node = lookahead_path[0]
-            target_d = distance[0]
-            # confidently_reachable = np.random.random() * 0.05 + 0.01
-            # confidently_reachable = self.confidently_reachable
-
-            if len(maps) <= 1:
-                # debug
-                log.info('Curr landmark %d, path %r', self.current_landmarks[env_i], lookahead_path)
-                log.info('Distances %r', [f'{d:.3f}' for d in distance])
-
-            if len(lookahead_path) > 1 and distance[1] < self.max_neighborhood_dist:
-                if distance[1] < 2 * self.confidently_reachable or random.random() < 0.5:
-                    target_node = lookahead_path[1]
-                    target_d = distance[1]
-
-                # for i, node in enumerate(lookahead_path[2:3], start=2):
-                #     if distance[i] > confidently_reachable:
-                #         break
-                #     target_node = node
-                #     target_d = distance[i]
-            # elif len(lookahead_path) > 1 and distance[1] < self.max_neighborhood_dist:
-            #     if random.random() < 0.3:
-            #         target_node = lookahead_path[1]
-            #         target_d = distance[1]
-
-            # noinspection PyTypeChecker
-            next_target[env_i] = target_node
-            next_target_d[env_i] = target_d
-
-            if prev_landmark != self.current_landmarks[env_i]:
-                self.last_made_progress[env_i] = episode_frames[env_i]
-
-            since_last_progress = episode_frames[env_i] - self.last_made_progress[env_i]
-            if since_last_progress > self.max_no_progress:
-                log.warning(
-                    'Agent %d did not make any progress in %d frames, locomotion failed',
-                    env_i, since_last_progress,
-                )
-                next_target[env_i] = None
+        with timing.add_time('navigator_localize'):
+            neighbors, distances = self._localize_path_lookahead(maps, obs, goals)
+
+        envs = np.array([env_i for env_i, m in enumerate(maps) if m is not None and goals[env_i] is not None])
+        if len(envs) <= 0:
+            return next_target, next_target_d
+
+        with timing.add_time('navigator_targets'):
+            # lookahead paths and distances of all envs as [num_envs, max_lookahead + 1] arrays (padded)
+            lengths = np.array([len(neighbors[env_i]) for env_i in envs])
+            max_len = max(3, lengths.max())
+            lookahead = np.full([len(envs), max_len], -1, dtype=np.int64)
+            lookahead_d = np.full([len(envs), max_len], np.inf, dtype=np.float32)
+            for i, env_i in enumerate(envs):
+                lookahead[i, :lengths[i]] = neighbors[env_i]
+                lookahead_d[i, :lengths[i]] = distances[env_i]
+
+            rows = np.arange(len(envs))
+            prev_landmarks = self.current_landmarks[envs]
+            episode_frames = np.asarray(episode_frames)[envs]
+
+            # localize on the current or the next landmark on the path (first one in case of a tie)
+            closest_idx = (lookahead_d[:, 1] < lookahead_d[:, 0]).astype(np.int64)
+            min_d = lookahead_d[rows, closest_idx]
+            localized = min_d <= self.max_neighborhood_dist
+
+            # current landmark is the closest, but next landmark is also super close
+            # set current landmark to be the next landmark on the path to make some progress
+            next_is_close = lookahead_d[:, 1] < np.random.random(len(envs)) * 0.04
+            closest_idx[localized & (closest_idx == 0) & (lengths > 1) & next_is_close] = 1
+
+            self.lost_localization_frames[envs] = np.where(localized, 0, self.lost_localization_frames[envs] + 1)
+            self.current_landmarks[envs] = np.where(localized, lookahead[rows, closest_idx], prev_landmarks)
+            curr_landmark_on_the_path = np.where(localized, closest_idx, 0)
+
+            target_idx = curr_landmark_on_the_path
+            next_d = lookahead_d[rows, target_idx + 1]
+            next_reachable = (lengths - target_idx > 1) & (next_d < self.max_neighborhood_dist)
+            go_to_next = next_reachable & (
+                (next_d < 2 * self.confidently_reachable) | (np.random.random(len(envs)) < 0.5)
+            )
+            target_idx = np.where(go_to_next, target_idx + 1, target_idx)
+
+            not_lost = self.lost_localization_frames[envs] <= self.max_lost_localization
+            made_progress = not_lost & (prev_landmarks != self.current_landmarks[envs])
+            self.last_made_progress[envs] = np.where(made_progress, episode_frames, self.last_made_progress[envs])
+            since_last_progress = episode_frames - self.last_made_progress[envs]
+            no_progress = since_last_progress > self.max_no_progress
+
+            for i, env_i in enumerate(envs):
+                if not not_lost[i]:
+                    continue
+
+                if len(maps) <= 1:
+                    # debug
+                    on_path = curr_landmark_on_the_path[i]
+                    log.info('Curr landmark %d, path %r', self.current_landmarks[env_i], neighbors[env_i][on_path:])
+                    log.info('Distances %r', [f'{d:.3f}' for d in distances[env_i][on_path:]])
+
+                if no_progress[i]:
+                    log.warning(
+                        'Agent %d did not make any progress in %d frames, locomotion failed',
+                        env_i, since_last_progress[i],
+                    )
+                    continue
+
+                next_target[env_i] = int(lookahead[i, target_idx[i]])
+                next_target_d[env_i] = lookahead_d[i, target_idx[i]]
 
         return next_target, next_target_d
 
@@ -258,7 +318,7 @@ class NavigatorNaive(Navigator):
         self.next_action_to_take[env_i] = 0
         self.next_target[env_i] = 0
 
-    def get_next_target(self, maps, obs, goals, episode_frames):
+    def get_next_target(self, maps, obs, goals, episode_frames, timing=None):
         self._ensure_paths_to_goal_calculated(maps, goals)
 
         next_target = [None] * self.params.num_envs
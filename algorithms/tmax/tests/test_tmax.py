@@ -1,20 +1,28 @@
 import os
 import shutil
+import tempfile
 from os.path import join
 from unittest import TestCase
 
+import numpy as np
 import tensorflow as tf
 
 from algorithms.agent import TrainStatus
 from algorithms.tests.test_wrappers import TEST_ENV_NAME
-from algorithms.tmax.agent_tmax import AgentTMAX
+from algorithms.tmax.agent_tmax import AgentTMAX, TmaxPPOBuffer, TmaxManager
 from algorithms.tmax.enjoy_tmax import enjoy
 from algorithms.tmax.locomotion import LocomotionNetwork
-from algorithms.tmax.tmax_utils import parse_args_tmax
+from algorithms.tmax.navigator import Navigator
+from algorithms.tmax.tmax_utils import parse_args_tmax, BudgetedScheduler, TmaxMode
+from algorithms.tmax.tmax_utils import TmaxTrajectory, TmaxTrajectoryBuffer
 from algorithms.tmax.train_tmax import train
-from algorithms.utils.trajectory import TrajectoryBuffer
+from algorithms.topological_maps.tests.test_topological import FakeAgent
+from algorithms.topological_maps.topological_map import TopologicalMap
+from algorithms.utils.trajectory import Trajectory, TrajectoryBuffer, TrajectoryReader, TrajectoryWriter
+from algorithms.utils.trajectory import open_trajectory, trajectory_dirs
 from utils.envs.doom.doom_utils import make_doom_env, doom_env_by_name
-from utils.utils import experiments_dir, ensure_dir_exists
+from utils.timing import Timing
+from utils.utils import experiments_dir, ensure_dir_exists, log, AttrDict
 
 
 class TestTMAX(TestCase):
@@ -83,3 +91,326 @@ class TestTMAX(TestCase):
         num_envs = 10
         buffer = TrajectoryBuffer(num_envs)
         self.assertEqual(len(buffer.complete_trajectories), 0)
+
+        for step in range(50):
+            obs = np.full([num_envs, 4, 4, 3], step, dtype=np.uint8)
+            actions = np.arange(num_envs) + step
+            infos = [{'step': step} for _ in range(num_envs)]
+            dones = np.zeros(num_envs, dtype=bool)
+            dones[step % num_envs] = True
+            buffer.add(obs, actions, infos, dones)
+
+        self.assertEqual(len(buffer.complete_trajectories), 50)
+        self.assertEqual(buffer.obs_size()[0], 50 * num_envs)
+
+        trajectory = buffer.complete_trajectories[-1]
+        self.assertEqual(len(trajectory), num_envs)
+        self.assertEqual(list(trajectory.obs[:, 0, 0, 0]), list(range(40, 50)))
+        self.assertEqual(list(trajectory.actions), list(np.arange(40, 50) + trajectory.env_idx))
+        self.assertEqual(trajectory.infos[-1], {'step': 49})
+
+        trajectory.trim_at(3)
+        self.assertEqual(len(trajectory), 3)
+        self.assertEqual(trajectory.obs_nbytes(), 3 * 4 * 4 * 3)
+
+        restored = Trajectory.from_dict(trajectory.as_dict())
+        self.assertEqual(len(restored), 3)
+        self.assertTrue(np.array_equal(restored.obs, trajectory.obs))
+
+        # older pickles stored lists of frames
+        restored = Trajectory.from_dict(dict(env_idx=0, obs=list(trajectory.obs), actions=[1, 2, 3], infos=[{}] * 3))
+        self.assertEqual(list(restored.actions), [1, 2, 3])
+
+    def test_trajectory_storage(self):
+        trajectory_dir = join(tempfile.mkdtemp(), 'traj')
+        num_frames, chunk_size = 50, 16
+
+        writer = TrajectoryWriter(trajectory_dir, env_idx=3, chunk_size=chunk_size)
+        for i in range(num_frames - 10):
+            writer.add(np.full([4, 4, 3], i, dtype=np.uint8), actions=i, infos={'i': i})
+        self.assertEqual(len(TrajectoryReader(trajectory_dir)), 2 * chunk_size)  # complete chunks are readable
+
+        last_frames = range(num_frames - 10, num_frames)
+        writer.add_frames(
+            np.array(last_frames, dtype=np.uint8)[:, None, None, None] * np.ones([4, 4, 3], np.uint8),
+            actions=list(last_frames), infos=[{'i': i} for i in last_frames],
+        )
+        writer.close()
+
+        reader = open_trajectory(trajectory_dir)
+        self.assertIsInstance(reader, TrajectoryReader)
+        self.assertEqual(len(reader), num_frames)
+        self.assertEqual(reader.env_idx, 3)
+        self.assertEqual(reader.obs[37][0, 0, 0], 37)
+        self.assertEqual(reader.obs[-1][0, 0, 0], num_frames - 1)
+        self.assertEqual(list(reader.obs[10:20][:, 0, 0, 0]), list(range(10, 20)))
+        self.assertEqual(list(reader.frames([49, 0, 17])[:, 0, 0, 0]), [49, 0, 17])
+        self.assertEqual(list(reader.actions), list(range(num_frames)))
+        self.assertEqual(reader.infos[42], {'i': 42})
+        self.assertFalse(hasattr(reader, 'mode'))
+
+        trajectory = reader.load()
+        self.assertEqual(len(trajectory), num_frames)
+        self.assertEqual(list(trajectory.obs[:, 0, 0, 0]), list(range(num_frames)))
+
+        # save() writes the same format, TMAX columns survive the roundtrip
+        tmax_trajectory = TmaxTrajectory(0)
+        for i in range(20):
+            tmax_trajectory.add(
+                trajectory.obs[i], i, {}, mode=TmaxMode.EXPLORATION, stage=TmaxMode.EXPLORATION,
+                locomotion_target=None if i == 0 else i, intrinsic_reward=0.0, env_reward=1.0, is_random=i % 2 == 0,
+            )
+        experiment_dir = tempfile.mkdtemp()
+        saved_dir = tmax_trajectory.save(experiment_dir)
+        self.assertEqual(trajectory_dirs(experiment_dir), [saved_dir])
+
+        loaded = open_trajectory(saved_dir, TmaxTrajectory).load()
+        self.assertEqual(len(loaded), 20)
+        self.assertEqual(list(loaded.locomotion_target), [None] + list(range(1, 20)))
+        self.assertEqual(list(loaded.is_random), [i % 2 == 0 for i in range(20)])
+
+        # empty trajectory can be saved and loaded as well
+        empty_dir = Trajectory(1).save(experiment_dir)
+        empty = open_trajectory(empty_dir).load()
+        self.assertEqual(len(empty), 0)
+        self.assertEqual(empty.env_idx, 1)
+
+        shutil.rmtree(os.path.dirname(trajectory_dir))
+        shutil.rmtree(experiment_dir)
+
+    def test_tmax_trajectory(self):
+        num_envs = 3
+
+        class FakeTmaxManager:
+            mode = [TmaxMode.EXPLORATION, TmaxMode.LOCOMOTION, TmaxMode.EXPLORATION]
+            env_stage = [TmaxMode.EXPLORATION] * num_envs
+            locomotion_targets = [None, 5, None]
+            intrinsic_reward = [0.5] * num_envs
+
+        buffer = TmaxTrajectoryBuffer(num_envs)
+        for step in range(4):
+            buffer.add(
+                np.zeros([num_envs, 4, 4, 3], dtype=np.uint8), [0] * num_envs, [{}] * num_envs, [step == 3] * num_envs,
+                tmax_mgr=FakeTmaxManager, is_random=[False, True, False], env_rewards=[1.0] * num_envs,
+            )
+
+        self.assertEqual(len(buffer.complete_trajectories), num_envs)
+        trajectory = buffer.complete_trajectories[1]
+        self.assertEqual(len(trajectory), 4)
+        self.assertTrue(all(mode == TmaxMode.LOCOMOTION for mode in trajectory.mode))
+        self.assertEqual(list(trajectory.locomotion_target), [5] * 4)
+        self.assertTrue(np.all(trajectory.is_random))
+        self.assertEqual(buffer.complete_trajectories[0].locomotion_target[0], None)
+        self.assertAlmostEqual(float(trajectory.env_reward.sum()), 4.0)
+
+
+class TestTmaxPPOBuffer(TestCase):
+    def test_split_by_mode(self):
+        num_envs, rollout = 32, 16
+        rng = np.random.RandomState(0)
+
+        buffer = TmaxPPOBuffer(rollout)
+        buffer.reset()
+        for step in range(rollout):
+            buffer.add(
+                rng.randint(0, 255, [num_envs, 84, 84, 3], dtype=np.uint8), [None] * num_envs,
+                rng.randint(0, 8, num_envs), rng.rand(num_envs, 8), rng.rand(num_envs), [False] * num_envs,
+                rng.rand(num_envs), None, None,
+                rng.choice([TmaxMode.EXPLORATION, TmaxMode.LOCOMOTION], num_envs), rng.randint(0, 2, num_envs),
+                rng.rand(num_envs), rng.rand(num_envs) < 0.1,
+            )
+        buffer.add_last_values(rng.rand(num_envs))
+        buffer.finalize_batch(0.99, 0.95)
+
+        t = Timing()
+        with t.timeit('split'):
+            buffers = buffer.split_by_mode()
+
+        # reference implementation, one sample at a time
+        expected = {mode: {key: [] for key in buffer.data_keys} for mode in TmaxMode.all_modes()}
+        for i in range(len(buffer)):
+            if buffer.is_random[i] or buffer.masks[i] == 0:
+                continue
+            for key in buffer.data_keys:
+                x = getattr(buffer, key)
+                if x is not None and x.size > 0:
+                    expected[buffer.modes[i]][key].append(x[i])
+
+        self.assertEqual(len(buffers[TmaxMode.IDLE_EXPLORATION]), 0)
+        for mode in [TmaxMode.EXPLORATION, TmaxMode.LOCOMOTION]:
+            self.assertGreater(len(buffers[mode]), 0)
+            self.assertTrue(np.all(buffers[mode].modes == mode))
+            for key in buffer.data_keys:
+                self.assertTrue(np.array_equal(getattr(buffers[mode], key), np.asarray(expected[mode][key])), key)
+
+        log.debug('Timing: %s', t)
+
+
+class TestStageTransition(TestCase):
+    @staticmethod
+    def _manager():
+        agent = FakeAgent(AgentTMAX.Params('__test_stage_transition__'), num_envs=2, async_stage_transition=True)
+        agent.curiosity = AttrDict(dict(distance=agent.distance, distance_training_paused=False))
+
+        mgr = TmaxManager(agent)
+        mgr._save_map = lambda *args, **kwargs: None
+
+        landmarks = np.random.randint(0, 255, size=(3, 84, 84, 3), dtype=np.uint8)
+        m = TopologicalMap(landmarks[0], directed_graph=False)
+        for landmark in landmarks[1:]:
+            m.add_landmark(landmark, {}, update_curr_landmark=True)
+        mgr.sparse_persistent_maps.append(m)
+        mgr.dense_persistent_maps.append(m)
+        return mgr
+
+    @staticmethod
+    def _exploration_trajectory(num_frames):
+        trajectory = TmaxTrajectory(0)
+        for obs in np.random.randint(0, 255, size=(num_frames, 84, 84, 3), dtype=np.uint8):
+            trajectory.add(
+                obs, 0, {}, mode=TmaxMode.EXPLORATION, stage=TmaxMode.EXPLORATION, locomotion_target=None,
+                intrinsic_reward=0.0, env_reward=0.0, is_random=False,
+            )
+        return trajectory
+
+    def test_async_stage_transition(self):
+        mgr = self._manager()
+        shared_cache = mgr.curiosity.distance.obs_encoder.encoded_obs
+        mgr.exploration_trajectories.append((1.0, self._exploration_trajectory(70)))
+
+        self.assertTrue(mgr._prepare_persistent_map_for_locomotion())
+        self.assertIsNotNone(mgr._stage_transition)
+        self.assertTrue(mgr.curiosity.distance_training_paused)
+        mgr._stage_transition.result()
+
+        # background build uses its own embedding cache, not the one used by the rollout
+        self.assertIs(mgr.curiosity.distance.obs_encoder.encoded_obs, shared_cache)
+        self.assertEqual(len(shared_cache), 0)
+        self.assertEqual(len(mgr.exploration_trajectories), 1)  # not discarded until the maps are switched
+
+        mgr._finish_stage_transition(env_steps=100)
+        self.assertEqual(mgr.global_stage, TmaxMode.LOCOMOTION)
+        self.assertFalse(mgr.curiosity.distance_training_paused)
+        self.assertEqual(len(mgr.sparse_persistent_maps), 2)
+        new_map, old_map = mgr.sparse_persistent_maps[-1], mgr.sparse_persistent_maps[0]
+        self.assertGreater(new_map.num_landmarks(), old_map.num_landmarks())
+        self.assertEqual(len(mgr.exploration_trajectories), 0)
+
+        # if the build fails, trajectories can be used again
+        mgr.global_stage = TmaxMode.EXPLORATION
+        mgr.exploration_trajectories.append((1.0, self._exploration_trajectory(10)))
+
+        def failing_build(*args):
+            raise RuntimeError('build failed')
+
+        mgr._build_persistent_maps_for_locomotion = failing_build
+        self.assertTrue(mgr._prepare_persistent_map_for_locomotion())
+        mgr._finish_stage_transition(env_steps=200)
+
+        self.assertEqual(mgr.global_stage, TmaxMode.EXPLORATION)
+        self.assertFalse(mgr.curiosity.distance_training_paused)
+        self.assertEqual(len(mgr.sparse_persistent_maps), 2)
+        self.assertEqual(len(mgr.exploration_trajectories), 1)
+
+        mgr.finalize()
+        self.assertIsNone(mgr._stage_transition_executor)
+        shutil.rmtree(mgr.params.experiment_dir())
+
+
+class TestBudgetedScheduler(TestCase):
+    def test_scheduler(self):
+        executed = []
+
+        scheduler = BudgetedScheduler(time_budget=None)
+        scheduler.schedule('a', lambda: executed.append('a'))
+        self.assertEqual(executed, ['a'])  # no budget, executed right away
+
+        scheduler = BudgetedScheduler(time_budget=0.0)
+        for key in ['a', 'b', 'a', 'c']:
+            scheduler.schedule(key, lambda k=key: executed.append(k))
+
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual(scheduler.num_merged, 1)
+
+        scheduler.run_now('c')
+        self.assertEqual(executed, ['a', 'c'])
+
+        scheduler.step()  # budget is zero, so only one task per step
+        self.assertEqual(executed, ['a', 'c', 'a'])
+        scheduler.step()
+        self.assertEqual(executed, ['a', 'c', 'a', 'b'])
+        self.assertEqual(len(scheduler), 0)
+
+
+class TestNavigator(TestCase):
+    @staticmethod
+    def _navigator(num_envs):
+        return Navigator(FakeAgent(AgentTMAX.Params('__test_navigator__'), num_envs=num_envs))
+
+    @staticmethod
+    def _chain_map(num_landmarks):
+        def info(k):
+            return {'pos': {'agent_x': k * 100.0, 'agent_y': 0.0, 'agent_a': 0.0}}
+
+        landmarks = np.random.randint(0, 255, size=(num_landmarks, 84, 84, 3), dtype=np.uint8)
+        m = TopologicalMap(landmarks[0], directed_graph=False, initial_info=info(0))
+        for k in range(1, num_landmarks):
+            m.add_landmark(landmarks[k], info(k), update_curr_landmark=True)
+        return m, landmarks
+
+    def test_next_target(self):
+        num_envs, num_landmarks = 128, 20
+        navigator = self._navigator(num_envs)
+        m, landmarks = self._chain_map(num_landmarks)
+
+        maps = [m] * num_envs
+        goals = [num_landmarks - 1] * num_envs
+        goals[-1] = None  # this env is not in locomotion mode
+        for env_i in range(num_envs):
+            navigator.reset(env_i, m)
+
+        # every agent sees the next landmark on the path, so it should be localized there
+        obs = [landmarks[1]] * num_envs
+        timing = Timing()
+        next_target, next_target_d = navigator.get_next_target(maps, obs, goals, [1] * num_envs, timing)
+
+        self.assertIsNone(next_target[-1])
+        self.assertTrue(np.all(navigator.current_landmarks[:-1] == 1))
+        for env_i in range(num_envs - 1):
+            self.assertIn(next_target[env_i], [1, 2])
+        self.assertIn('navigator_targets', timing)
+
+        # agents that don't see anything familiar for a long time are lost
+        navigator.max_lost_localization = 0
+        obs = [np.zeros_like(landmarks[0])] * num_envs
+        navigator.max_neighborhood_dist = 0.0
+        next_target, _ = navigator.get_next_target(maps, obs, goals, [2] * num_envs)
+        self.assertTrue(all(t is None for t in next_target))
+
+    def test_shared_path_tables(self):
+        num_envs, num_landmarks = 8, 10
+        navigator = self._navigator(num_envs)
+        m, landmarks = self._chain_map(num_landmarks)
+
+        maps = [m] * num_envs
+        goals = [num_landmarks - 1] * (num_envs // 2) + [num_landmarks // 2] * (num_envs // 2)
+        for env_i in range(num_envs):
+            navigator.reset(env_i, m)
+
+        navigator.get_next_target(maps, [landmarks[0]] * num_envs, goals, [0] * num_envs)
+
+        # envs with the same map and goal share the same table
+        self.assertIs(navigator.path_tables[0], navigator.path_tables[num_envs // 2 - 1])
+        self.assertIsNot(navigator.path_tables[0], navigator.path_tables[-1])
+        self.assertEqual(navigator.path_tables[0].path_length(0), num_landmarks - 1)
+        self.assertEqual(navigator.path_tables[-1].path_length(0), num_landmarks // 2)
+
+        table = navigator.path_tables[0]
+        navigator.reset(0, m)
+        navigator.get_next_target(maps, [landmarks[0]] * num_envs, goals, [1] * num_envs)
+        self.assertIs(navigator.path_tables[0], table)
+
+        # new landmark in the map invalidates the table
+        m.add_landmark(np.zeros_like(landmarks[0]), {'pos': {'agent_x': 0, 'agent_y': 0, 'agent_a': 0}})
+        navigator.get_next_target(maps, [landmarks[0]] * num_envs, goals, [2] * num_envs)
+        self.assertIsNot(navigator.path_tables[0], table)
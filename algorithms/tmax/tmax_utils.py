@@ -1,3 +1,8 @@
+import time
+from collections import OrderedDict
+
+import numpy as np
+
 from algorithms.utils.arguments import parse_args
 from algorithms.utils.trajectory import Trajectory, TrajectoryBuffer
 
@@ -36,60 +41,86 @@ class TmaxMode:
 
 
 class TmaxTrajectory(Trajectory):
-    def __init__(self, env_idx):
-        super().__init__(env_idx)
-        self.mode = []
-        self.stage = []
-        self.locomotion_target = []
-        self.intrinsic_reward = []
-        self.env_reward = []
-        self.is_random = []
+    columns = Trajectory.columns + (
+        'mode', 'stage', 'locomotion_target', 'intrinsic_reward', 'env_reward', 'is_random',
+    )
+    column_dtypes = dict(
+        Trajectory.column_dtypes,
+        locomotion_target=object,  # can be None
+        intrinsic_reward=np.float32, env_reward=np.float32, is_random=bool,
+    )
 
     def add(self, obs, action, info, **kwargs):
-        super().add(obs, action, info, **kwargs)
-        self.mode.append(kwargs['mode'])
-        self.stage.append(kwargs['stage'])
-        self.locomotion_target.append(kwargs['locomotion_target'])
-        self.intrinsic_reward.append(kwargs['intrinsic_reward'])
-        self.env_reward.append(kwargs['env_reward'])
-        self.is_random.append(kwargs['is_random'])
-
-    def add_frame(self, tr, i):
-        self.add(
-            tr.obs[i], tr.actions[i], tr.infos[i],
-            mode=tr.mode[i], stage=tr.stage[i],
-            locomotion_target=tr.locomotion_target[i],
-            intrinsic_reward=tr.intrinsic_reward[i],
-            env_reward=tr.env_reward[i],
-            is_random=tr.is_random[i],
+        self._append(
+            obs=obs, actions=action, infos=info,
+            mode=kwargs['mode'],
+            stage=kwargs['stage'],
+            locomotion_target=kwargs['locomotion_target'],
+            intrinsic_reward=kwargs['intrinsic_reward'],
+            env_reward=kwargs['env_reward'],
+            is_random=kwargs['is_random'],
         )
 
 
 class TmaxTrajectoryBuffer(TrajectoryBuffer):
     """Store trajectories for multiple parallel environments."""
-    def __init__(self, num_envs):
-        super().__init__(num_envs)
-        self.current_trajectories = [TmaxTrajectory(env_idx) for env_idx in range(num_envs)]
-        self.complete_trajectories = []
+
+    trajectory_class = TmaxTrajectory
 
     def add(self, obs, actions, infos, dones, **kwargs):
         assert len(obs) == len(actions)
         tmax_mgr = kwargs['tmax_mgr']
-        is_random = kwargs['is_random']
-        env_rewards = kwargs['env_rewards']
-        for env_idx in range(len(obs)):
-            self.current_trajectories[env_idx].add(
-                obs[env_idx], actions[env_idx], infos[env_idx],
-                mode=tmax_mgr.mode[env_idx],
-                stage=tmax_mgr.env_stage[env_idx],
-                locomotion_target=tmax_mgr.locomotion_targets[env_idx],
-                intrinsic_reward=tmax_mgr.intrinsic_reward[env_idx],
-                is_random=is_random[env_idx],
-                env_reward=env_rewards[env_idx],
-            )
-
-            if dones[env_idx]:
-                # finalize the trajectory and put it into a separate buffer
-                self.complete_trajectories.append(self.current_trajectories[env_idx])
-                self.current_trajectories[env_idx] = TmaxTrajectory(env_idx)
+        self._add(
+            dones,
+            obs=obs, actions=actions, infos=infos,
+            mode=tmax_mgr.mode,
+            stage=tmax_mgr.env_stage,
+            locomotion_target=tmax_mgr.locomotion_targets,
+            intrinsic_reward=tmax_mgr.intrinsic_reward,
+            is_random=kwargs['is_random'],
+            env_reward=kwargs['env_rewards'],
+        )
+
+
+class BudgetedScheduler:
+    """
+    Expensive bookkeeping that does not have to happen right away (e.g. at the episode boundary).
+    Tasks are identified by keys: the same task scheduled multiple times before it runs is executed only once.
+    Every step we execute pending tasks in FIFO order until the time budget is exhausted (but at least one task,
+    so the queue always drains). With time_budget=None tasks are executed immediately.
+    """
 
+    def __init__(self, time_budget=None):
+        self.time_budget = time_budget
+        self._tasks = OrderedDict()
+
+        self.num_executed = self.num_merged = 0
+
+    def schedule(self, key, task):
+        if self.time_budget is None:
+            task()
+            self.num_executed += 1
+        elif key in self._tasks:
+            self.num_merged += 1
+        else:
+            self._tasks[key] = task
+
+    def run_now(self, key):
+        """Execute the task right away if it is pending (e.g. when its result is needed)."""
+        task = self._tasks.pop(key, None)
+        if task is not None:
+            task()
+            self.num_executed += 1
+
+    def step(self):
+        start = time.time()
+        while len(self._tasks) > 0:
+            _, task = self._tasks.popitem(last=False)
+            task()
+            self.num_executed += 1
+
+            if time.time() - start > self.time_budget:
+                break
+
+    def __len__(self):
+        return len(self._tasks)
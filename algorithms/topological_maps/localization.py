@@ -1,10 +1,79 @@
 import math
 
-from algorithms.topological_maps.topological_map import hash_observation
+from algorithms.topological_maps.topological_map import hash_observation, get_position
 from utils.timing import Timing
 from utils.utils import log, min_with_idx
 
 
+def distances_unique_pairs(
+        session, distance_net, obs_first, obs_second, hashes_first, hashes_second,
+        infos_first=None, infos_second=None, batch_size=None,
+):
+    """
+    Envs that share a map (or just have the same landmarks around them) often request the exact same
+    (landmark, observation) pair. Evaluate the distance network only once for every unique pair and scatter the
+    results back. Pairs are identified by observation hashes (and coordinates, if infos are provided, because
+    the oracle distance depends on them).
+    :return: list of distances (one per input pair) and the number of unique pairs actually evaluated
+    """
+    assert len(obs_first) == len(obs_second) == len(hashes_first) == len(hashes_second)
+    with_infos = infos_first is not None and infos_second is not None
+
+    unique_pairs = {}
+    unique_indices = []
+    inverse = [0] * len(obs_first)
+    for i in range(len(obs_first)):
+        key = (hashes_first[i], hashes_second[i])
+        if with_infos:
+            key += (get_position(infos_first[i]), get_position(infos_second[i]))
+
+        unique_idx = unique_pairs.get(key)
+        if unique_idx is None:
+            unique_idx = unique_pairs[key] = len(unique_indices)
+            unique_indices.append(i)
+        inverse[i] = unique_idx
+
+    if len(unique_indices) <= 0:
+        return [], 0
+
+    if batch_size is None:
+        batch_size = len(unique_indices)
+
+    unique_distances = []
+    for start in range(0, len(unique_indices), batch_size):
+        batch = unique_indices[start:start + batch_size]
+        distances_batch = distance_net.distances_from_obs(
+            session,
+            obs_first=[obs_first[i] for i in batch], obs_second=[obs_second[i] for i in batch],
+            hashes_first=[hashes_first[i] for i in batch], hashes_second=[hashes_second[i] for i in batch],
+            infos_first=[infos_first[i] for i in batch] if with_infos else None,
+            infos_second=[infos_second[i] for i in batch] if with_infos else None,
+        )
+        unique_distances.extend(distances_batch)
+
+    assert len(unique_distances) == len(unique_indices)
+    distances = [unique_distances[unique_idx] for unique_idx in inverse]
+    return distances, len(unique_indices)
+
+
+class LandmarkCache:
+    """
+    Per-call cache of landmark data. In TMAX many envs point to the exact same map object, so we look up the
+    observation, hash and info of each landmark only once per map.
+    """
+
+    def __init__(self):
+        self._landmarks = {}
+
+    def get(self, m, landmark_idx):
+        key = (id(m), landmark_idx)
+        landmark = self._landmarks.get(key)
+        if landmark is None:
+            landmark = m.get_observation(landmark_idx), m.get_hash(landmark_idx), m.get_info(landmark_idx)
+            self._landmarks[key] = landmark
+        return landmark
+
+
 class Localizer:
     def __init__(self, params, verbose=False):
         self._verbose = verbose
@@ -12,10 +81,14 @@ class Localizer:
         self.params = params
         self.new_landmark_threshold = self.params.new_landmark_threshold
         self.loop_closure_threshold = self.params.loop_closure_threshold
+        self.prefilter_radius = self.params.localization_prefilter_radius
 
         # noise-filtering parameter, how many frames we need to wait before we change localization
         self.localize_frames = 3
 
+        # number of (landmark, observation) pairs requested vs actually evaluated during the last call
+        self.num_pairs_requested = self.num_pairs_evaluated = 0
+
     def _log_verbose(self, s, *args):
         if self._verbose:
             log.debug(s, *args)
@@ -29,11 +102,35 @@ class Localizer:
                 neighbor_distance[neighbor_idx] = '{:.3f}'.format(distance[i])
             self._log_verbose('Env %d distance: %r', env_i, neighbor_distance)
 
+    def _non_neighbor_candidates(self, m, info, distance_net):
+        """
+        Non-neighbors of the current landmark that can potentially be close to the current observation.
+        If we know the coordinates, we use the spatial index of the map to avoid checking every landmark.
+        Oracle distance is monotonic in world distance, so for it the nearest landmark is all we need.
+        """
+        pos = get_position(info)
+        index = None if pos is None else m.spatial_index()
+        if index is None:
+            return m.curr_non_neighbors()
+
+        neighborhood = set(m.neighborhood())
+
+        if distance_net.uses_coordinates:
+            nearest, _ = index.nearest(pos, exclude=neighborhood)
+            return [] if nearest is None else [nearest]
+
+        if self.prefilter_radius is not None:
+            return [idx for idx in index.within(pos, self.prefilter_radius) if idx not in neighborhood]
+
+        return m.curr_non_neighbors()
+
     def localize(
             self,
             session, obs, info, maps, distance_net, frames=None, on_new_landmark=None, on_new_edge=None, timing=None,
     ):
         num_envs = len(obs)
+        self.num_pairs_requested = self.num_pairs_evaluated = 0
+
         closest_landmark_idx = [-1] * num_envs
         # closest distance to the landmark in the existing graph (excluding new landmarks)
         closest_landmark_dist = [math.inf] * num_envs
@@ -44,6 +141,9 @@ class Localizer:
         if timing is None:
             timing = Timing()
 
+        landmarks = LandmarkCache()
+        obs_hashes = [None if m is None else hash_observation(obs[env_i]) for env_i, m in enumerate(maps)]
+
         # create a batch of all neighborhood observations from all envs for fast processing on GPU
         neighborhood_obs, neighborhood_hashes, current_obs, current_obs_hashes = [], [], [], []
         neighborhood_infos, current_infos = [], []
@@ -55,11 +155,13 @@ class Localizer:
 
             neighbor_indices = m.neighborhood()
             neighborhood_sizes[env_i] = len(neighbor_indices)
-            neighborhood_obs.extend([m.get_observation(i) for i in neighbor_indices])
-            neighborhood_infos.extend([m.get_info(i) for i in neighbor_indices])
-            neighborhood_hashes.extend([m.get_hash(i) for i in neighbor_indices])
+            for i in neighbor_indices:
+                landmark_obs, landmark_hash, landmark_info = landmarks.get(m, i)
+                neighborhood_obs.append(landmark_obs)
+                neighborhood_hashes.append(landmark_hash)
+                neighborhood_infos.append(landmark_info)
             current_obs.extend([obs[env_i]] * len(neighbor_indices))
-            current_obs_hashes.extend([hash_observation(obs[env_i])] * len(neighbor_indices))
+            current_obs_hashes.extend([obs_hashes[env_i]] * len(neighbor_indices))
             current_infos.extend([info[env_i]] * len(neighbor_indices))
             total_num_neighbors += len(neighbor_indices)
 
@@ -69,14 +171,16 @@ class Localizer:
         assert len(neighborhood_infos) == len(current_infos)
 
         with timing.add_time('neighbor_dist'):
-            distances = distance_net.distances_from_obs(
-                session,
+            distances, num_unique_pairs = distances_unique_pairs(
+                session, distance_net,
                 obs_first=neighborhood_obs, obs_second=current_obs,
                 hashes_first=neighborhood_hashes, hashes_second=current_obs_hashes,
                 infos_first=neighborhood_infos, infos_second=current_infos,
             )
 
         assert len(distances) == total_num_neighbors
+        self.num_pairs_requested = total_num_neighbors
+        self.num_pairs_evaluated = num_unique_pairs
 
         new_landmark_candidates = []
 
@@ -139,13 +243,15 @@ class Localizer:
             if m is None:
                 continue
 
-            non_neighbor_indices = m.curr_non_neighbors()
+            non_neighbor_indices = self._non_neighbor_candidates(m, info[env_i], distance_net)
             non_neighborhoods[env_i] = non_neighbor_indices
-            non_neighborhood_obs.extend([m.get_observation(i) for i in non_neighbor_indices])
-            non_neighborhood_infos.extend([m.get_info(i) for i in non_neighbor_indices])
-            non_neighborhood_hashes.extend([m.get_hash(i) for i in non_neighbor_indices])
+            for i in non_neighbor_indices:
+                landmark_obs, landmark_hash, landmark_info = landmarks.get(m, i)
+                non_neighborhood_obs.append(landmark_obs)
+                non_neighborhood_hashes.append(landmark_hash)
+                non_neighborhood_infos.append(landmark_info)
             current_obs.extend([obs[env_i]] * len(non_neighbor_indices))
-            current_obs_hashes.extend([hash_observation(obs[env_i])] * len(non_neighbor_indices))
+            current_obs_hashes.extend([obs_hashes[env_i]] * len(non_neighbor_indices))
             current_infos.extend([info[env_i]] * len(non_neighbor_indices))
 
         assert len(non_neighborhood_obs) == len(current_obs)
@@ -153,18 +259,19 @@ class Localizer:
 
         with timing.add_time('non_neigh'):
             # calculate distance for all non-neighbors
-            distances = []
-            batch_size = 1024
-            for i in range(0, len(non_neighborhood_obs), batch_size):
-                start, end = i, i + batch_size
-
-                distances_batch = distance_net.distances_from_obs(
-                    session,
-                    obs_first=non_neighborhood_obs[start:end], obs_second=current_obs[start:end],
-                    hashes_first=non_neighborhood_hashes[start:end], hashes_second=current_obs_hashes[start:end],
-                    infos_first=non_neighborhood_infos[start:end], infos_second=current_infos[start:end],
-                )
-                distances.extend(distances_batch)
+            distances, num_unique_pairs = distances_unique_pairs(
+                session, distance_net,
+                obs_first=non_neighborhood_obs, obs_second=current_obs,
+                hashes_first=non_neighborhood_hashes, hashes_second=current_obs_hashes,
+                infos_first=non_neighborhood_infos, infos_second=current_infos,
+                batch_size=1024,
+            )
+
+        self.num_pairs_requested += len(non_neighborhood_obs)
+        self.num_pairs_evaluated += num_unique_pairs
+        self._log_verbose(
+            'Localization evaluated %d unique pairs out of %d', self.num_pairs_evaluated, self.num_pairs_requested,
+        )
 
         j = 0
         for env_i in new_landmark_candidates:
@@ -1,10 +1,10 @@
-import math
 import random
+import tempfile
 from functools import partial
 
 import numpy as np
 
-from algorithms.tmax.navigator import default_edge_weight
+from algorithms.tmax.navigator import default_edge_weight, DEFAULT_MIN_EDGE_WEIGHT
 from algorithms.tmax.tmax_utils import TmaxMode
 from algorithms.topological_maps.localization import Localizer
 from algorithms.topological_maps.topological_map import hash_observation
@@ -25,53 +25,132 @@ class MapBuilderParams:
         self.duplicate_neighborhood = 5
         self.duplicate_threshold = 0.05
 
+        self.pairwise_distances_tile = 64  # pairwise distances are calculated in tiles of [tile x tile] pairs
+        self.pairwise_distances_memmap_frames = None  # for longer trajectories store distances in a float16 memmap
+
 
 class MapBuilder:
-    def __init__(self, agent):
+    def __init__(self, agent, distance_net=None):
         self.agent = agent
-        self.distance_net = self.agent.distance
+        self.distance_net = self.agent.distance if distance_net is None else distance_net
         self.obs_encoder = self.distance_net.obs_encoder
 
         self.params = agent.params
 
+    def _allocate_pairwise_distances(self, num_embeddings):
+        shape = [num_embeddings, num_embeddings]
+
+        memmap_frames = self.params.pairwise_distances_memmap_frames
+        if memmap_frames is not None and num_embeddings > memmap_frames:
+            # anonymous temporary file, deleted automatically when the array is garbage collected
+            log.debug('Using float16 memmap for %d pairwise distances', num_embeddings ** 2)
+            return np.memmap(tempfile.TemporaryFile(), dtype=np.float16, mode='w+', shape=shape)
+
+        return np.empty(shape, np.float32)
+
     def _calc_pairwise_distances(self, obs_embeddings):
         num_embeddings = len(obs_embeddings)
+        obs_embeddings = np.asarray(obs_embeddings)
 
-        pairwise_distances = np.empty([num_embeddings, num_embeddings], np.float32)
+        pairwise_distances = self._allocate_pairwise_distances(num_embeddings)
+        tile = self.params.pairwise_distances_tile
 
-        for i in range(num_embeddings):
-            if i % 10 == 0:
-                log.debug('Pairwise distances for %05d...', i)
+        for row in range(0, num_embeddings, tile):
+            log.debug('Pairwise distances for %05d...', row)
 
-            curr_obs = [obs_embeddings[i]] * num_embeddings
-            d = self.distance_net.distances(self.agent.session, curr_obs, obs_embeddings)
-            pairwise_distances[i, :] = d
+            rows = obs_embeddings[row:row + tile]
+            for col in range(0, num_embeddings, tile):
+                cols = obs_embeddings[col:col + tile]
 
-        # induce symmetry
-        for i in range(num_embeddings):
-            for j in range(i + 1, num_embeddings):
-                d = (pairwise_distances[i][j] + pairwise_distances[j][i]) * 0.5
-                pairwise_distances[i][j] = pairwise_distances[j][i] = d
+                # every row of the tile paired with every column
+                first = np.repeat(rows, len(cols), axis=0)
+                second = np.tile(cols, (len(rows), 1))
+                d = self.distance_net.distances(self.agent.session, first, second)
+                pairwise_distances[row:row + tile, col:col + tile] = np.reshape(d, (len(rows), len(cols)))
+
+        # induce symmetry, tile by tile to avoid allocating another [N x N] array
+        for row in range(0, num_embeddings, tile):
+            for col in range(row, num_embeddings, tile):
+                upper = pairwise_distances[row:row + tile, col:col + tile]
+                lower = pairwise_distances[col:col + tile, row:row + tile]
+                d = (upper.astype(np.float32) + lower.T) * 0.5
+                pairwise_distances[row:row + tile, col:col + tile] = d
+                pairwise_distances[col:col + tile, row:row + tile] = d.T
 
         return pairwise_distances
 
     def _calc_embeddings(self, observations):
-        obs_hashes = [hash_observation(o) for o in observations]
-        self.obs_encoder.encode(self.agent.session, observations)
+        return self.distance_net.encode(self.agent.session, observations)
+
+    def _batched_distances(self, obs_first_encoded, obs_second_encoded):
+        batch_size = self.params.pairwise_distances_tile ** 2
+        distances = []
+        for i in range(0, len(obs_first_encoded), batch_size):
+            distances.extend(self.distance_net.distances(
+                self.agent.session, obs_first_encoded[i:i + batch_size], obs_second_encoded[i:i + batch_size],
+            ))
+        return np.asarray(distances, dtype=np.float32)
+
+    def _calc_band_distances(self, obs_embeddings, max_offset):
+        """
+        Symmetric distances only between frames that are at most max_offset apart.
+        band[i, max_offset + k] is the same as pairwise_distances[i][i + k], and NaN outside of the trajectory.
+        """
+        num_embeddings = len(obs_embeddings)
+        obs_embeddings = np.asarray(obs_embeddings)
+
+        band = np.full([num_embeddings, 2 * max_offset + 1], np.nan, np.float32)
+        for offset in range(min(max_offset, num_embeddings - 1) + 1):
+            earlier, later = obs_embeddings[:num_embeddings - offset], obs_embeddings[offset:]
+            d = (self._batched_distances(earlier, later) + self._batched_distances(later, earlier)) * 0.5
+            band[:num_embeddings - offset, max_offset + offset] = d
+            band[offset:, max_offset - offset] = d
+
+        return band
 
-        assert len(observations) == len(obs_hashes)
+    def _duplicate_frames(self, band, max_duplicate_dist, neighborhood):
+        """
+        is_duplicate[i, k] is True if frame i + k is close to frame i and their neighborhoods are also close.
+        Neighborhood of the pair (i, j) is all pairs (i, j + shift) and (i + shift, j) within the trajectory.
+        """
+        num_frames = len(band)
+        max_offset = (band.shape[1] - 1) // 2
+        threshold = self.params.duplicate_threshold
 
-        embeddings = [None] * len(observations)
-        for i in range(len(observations)):
-            obs_hash = obs_hashes[i]
-            embeddings[i] = self.obs_encoder.encoded_obs[obs_hash]
+        is_duplicate = np.zeros([num_frames, max_duplicate_dist + 1], dtype=bool)
+        shifts = np.arange(-neighborhood, neighborhood + 1)
 
-        return embeddings
+        for k in range(1, min(max_duplicate_dist, num_frames - 1) + 1):
+            i = np.arange(num_frames - k)
+            shifted_i, shifted_j = i[:, None] + shifts, i[:, None] + k + shifts
+            valid = (shifted_i >= 0) & (shifted_i < num_frames) & (shifted_j >= 0) & (shifted_j < num_frames)
+
+            # pairwise_distances[i][j + shift] and pairwise_distances[i + shift][j]
+            i_to_shifted_j = band[i[:, None], max_offset + k + shifts]
+            shifted_i_to_j = band[np.clip(shifted_i, 0, num_frames - 1), max_offset + k - shifts]
+
+            neighbor_dist = np.concatenate([
+                np.where(valid, i_to_shifted_j, np.nan), np.where(valid, shifted_i_to_j, np.nan),
+            ], axis=1)
+            neighbor_percentile = np.nanpercentile(neighbor_dist, 75, axis=1)
+
+            close = band[i, max_offset + k] <= threshold
+            is_duplicate[i, k] = close & (neighbor_percentile < threshold)
+
+        return is_duplicate
 
     def sparsify_trajectory(self, traj):
         obs = traj.obs
-        obs_embeddings = self._calc_embeddings(obs)
-        pairwise_distances = self._calc_pairwise_distances(obs_embeddings)
+        obs_hashes = [hash_observation(o) for o in obs]
+
+        max_duplicate_dist = self.params.max_duplicate_dist
+        is_duplicate = None
+        if max_duplicate_dist > 0:
+            # we only ever look at pairs of frames within the band around the diagonal
+            neighborhood = self.params.duplicate_neighborhood
+            obs_embeddings = self._calc_embeddings(obs)
+            band = self._calc_band_distances(obs_embeddings, max_duplicate_dist + neighborhood)
+            is_duplicate = self._duplicate_frames(band, max_duplicate_dist, neighborhood)
 
         to_delete = set()
 
@@ -83,30 +162,15 @@ class MapBuilder:
                 if j in to_delete:
                     continue
 
-                if np.array_equal(traj.obs[i], traj.obs[j]):
+                if obs_hashes[i] == obs_hashes[j]:
                     log.info('Frames %d and %d are exactly the same!', i, j)
                     to_delete.add(j)
                     continue
 
-                if j > i + self.params.max_duplicate_dist:
-                    break
-
-                d = pairwise_distances[i][j]
-                if d > self.params.duplicate_threshold:
+                if j > i + max_duplicate_dist:
                     break
 
-                neighbor_dist = []
-                for shift in range(-self.params.duplicate_neighborhood, self.params.duplicate_neighborhood + 1):
-                    shifted_i, shifted_j = i + shift, j + shift
-                    if shifted_i < 0 or shifted_i >= len(traj):
-                        continue
-                    if shifted_j < 0 or shifted_j >= len(traj):
-                        continue
-
-                    neighbor_dist.append(pairwise_distances[i][shifted_j])
-                    neighbor_dist.append(pairwise_distances[shifted_i][j])
-
-                if np.percentile(neighbor_dist, 75) < self.params.duplicate_threshold:
+                if is_duplicate[i, j - i]:
                     log.info('Duplicate landmark frames %d-%d', i, j)
                     to_delete.add(j)
                 else:
@@ -149,89 +213,64 @@ class MapBuilder:
         m.num_trajectories += 1
 
     def _shortcuts_distance(self, m, pairwise_distances, min_shortcut_dist, shortcut_window):
-        shortcut_candidates = []
-
         nodes = m.graph.nodes
-        for i, data in nodes.data():
-            if i % 10 == 0:
-                log.debug('Checking loop closures for %05d...', i)
+        num_landmarks = m.num_landmarks()
 
-            i_traj_idx = data.get('traj_idx', 0)
+        traj_idx = np.array([nodes[i].get('traj_idx', 0) for i in range(num_landmarks)])
 
-            for j in range(i, m.num_landmarks()):
-                j_traj_idx = nodes[j].get('traj_idx', 0)
+        # candidate pairs (i <= j) that are close according to the distance network
+        candidates_i, candidates_j = [], []
+        block = 1024  # rows at a time, so we never allocate [N x N] temporary arrays
+        for row in range(0, num_landmarks, block):
+            log.debug('Checking loop closures for %05d...', row)
+            close_i, close_j = np.nonzero(pairwise_distances[row:row + block] <= self.params.shortcut_dist_threshold)
+            close_i += row
+            upper = close_j >= close_i
+            candidates_i.append(close_i[upper])
+            candidates_j.append(close_j[upper])
 
-                if j - i < min_shortcut_dist and i_traj_idx == j_traj_idx:
-                    # skip trivial shorcuts (close in time and from the same trajectory)
-                    continue
+        i, j = np.concatenate(candidates_i), np.concatenate(candidates_j)
 
-                neighbors_dist = []
+        # skip trivial shortcuts (close in time and from the same trajectory)
+        trivial = (j - i < min_shortcut_dist) & (traj_idx[i] == traj_idx[j])
+        i, j = i[~trivial], j[~trivial]
 
-                d = pairwise_distances[i][j]
-                if d > self.params.shortcut_dist_threshold:
-                    continue
+        # skip pairs that already have an edge between them
+        no_edge = np.array([int(j_) not in m.graph[int(i_)] for i_, j_ in zip(i, j)], dtype=bool)
+        i, j = i[no_edge], j[no_edge]
 
-                if j in m.graph[i]:
-                    # there's already an edge between i and j
-                    continue
+        if len(i) <= 0:
+            return []
+
+        # check how aligned the landmark neighborhoods are
+        # neighborhoods are diagonal bands of the pairwise distance matrix: (i + shift, j + shift) for all shifts
+        shifts = np.arange(-shortcut_window, shortcut_window + 1)
+        shifted_i, shifted_j = i[:, None] + shifts, j[:, None] + shifts
+        valid = (shifted_i >= 0) & (shifted_i < num_landmarks) & (shifted_j >= 0) & (shifted_j < num_landmarks)
+        shifted_i, shifted_j = np.where(valid, shifted_i, 0), np.where(valid, shifted_j, 0)
+        valid &= (traj_idx[shifted_i] == traj_idx[i][:, None]) & (traj_idx[shifted_j] == traj_idx[j][:, None])
 
-                # check how aligned the landmark neighborhoods are
-                for shift in range(-shortcut_window, shortcut_window + 1):
-                    shifted_i, shifted_j = i + shift, j + shift
-                    if shifted_i < 0 or shifted_i >= m.num_landmarks():
-                        continue
-                    if shifted_j < 0 or shifted_j >= m.num_landmarks():
-                        continue
-
-                    shifted_i_traj_idx = nodes[shifted_i].get('traj_idx', 0)
-                    shifted_j_traj_idx = nodes[shifted_j].get('traj_idx', 0)
-                    if shifted_i_traj_idx != i_traj_idx or shifted_j_traj_idx != j_traj_idx:
-                        continue
-
-                    neighbors_dist.append(pairwise_distances[shifted_i][shifted_j])
-
-                # the more aligned neighborhoods are, the less risk there is for the shortcut to be noise
-                distance_percentile = np.percentile(neighbors_dist, 75)
-                shorcut_risk = distance_percentile  # closer to 0 = better
-
-                # calculate ground-truth distance (purely for diagnostic purposes)
-                xi = nodes[i]['info']['pos']['agent_x']
-                yi = nodes[i]['info']['pos']['agent_y']
-                xj = nodes[j]['info']['pos']['agent_x']
-                yj = nodes[j]['info']['pos']['agent_y']
-                gt_dist = math.sqrt((xi - xj) ** 2 + (yi - yj) ** 2)
-
-                # Visualize false loop closures for debugging
-                # if gt_dist > 50 and shorcut_risk < 0.1:
-                #     log.info('Showing neighborhoods for shortcut %d-%d', i, j)
-                #     import cv2
-                #     obs_t1, obs_t2 = [], []
-                #     for shift in range(-shortcut_window, shortcut_window + 1):
-                #         shifted_i, shifted_j = i + shift, j + shift
-                #         if shifted_i < 0 or shifted_i >= m.num_landmarks():
-                #             continue
-                #         if shifted_j < 0 or shifted_j >= m.num_landmarks():
-                #             continue
-                #
-                #         shifted_i_traj_idx = nodes[shifted_i].get('traj_idx', 0)
-                #         shifted_j_traj_idx = nodes[shifted_j].get('traj_idx', 0)
-                #         if shifted_i_traj_idx != i_traj_idx or shifted_j_traj_idx != j_traj_idx:
-                #             continue
-                #
-                #         obs_t1.append(nodes[shifted_i]['obs'])
-                #         obs_t2.append(nodes[shifted_j]['obs'])
-                #
-                #     assert len(obs_t1) == len(obs_t2)
-                #     for obs_i in range(len(obs_t1)):
-                #         log.warning('Dist: %.3f', neighbors_dist[obs_i])
-                #         cv2.imshow('t1', cv2.resize(cv2.cvtColor(obs_t1[obs_i], cv2.COLOR_RGB2BGR), (210, 210)))
-                #         cv2.imshow('t2', cv2.resize(cv2.cvtColor(obs_t2[obs_i], cv2.COLOR_RGB2BGR), (210, 210)))
-                #         cv2.waitKey()
-                #     cv2.waitKey()
-
-                shortcut = shorcut_risk, i, j, d, gt_dist
-                assert i < j
-                shortcut_candidates.append(shortcut)
+        neighbors_dist = np.asarray(pairwise_distances[shifted_i, shifted_j], dtype=np.float64)
+        neighbors_dist[~valid] = np.nan
+
+        # the more aligned neighborhoods are, the less risk there is for the shortcut to be noise
+        shortcut_risk = np.nanpercentile(neighbors_dist, 75, axis=1)  # closer to 0 = better
+
+        # calculate ground-truth distance (purely for diagnostic purposes)
+        def coords(indices):
+            return np.array([(nodes[k]['info']['pos']['agent_x'], nodes[k]['info']['pos']['agent_y']) for k in indices])
+
+        gt_dist = np.hypot(*(coords(i) - coords(j)).T)
+
+        # same order as iterating over the graph nodes
+        node_order = {node: order for order, node in enumerate(nodes)}
+        candidates = sorted(range(len(i)), key=lambda c: (node_order[i[c]], j[c]))
+
+        shortcut_candidates = []
+        for c in candidates:
+            assert i[c] < j[c]
+            shortcut = shortcut_risk[c], int(i[c]), int(j[c]), pairwise_distances[i[c]][j[c]], gt_dist[c]
+            shortcut_candidates.append(shortcut)
 
         return shortcut_candidates
 
@@ -385,7 +424,9 @@ class MapBuilder:
             frame_idx = node_data.get('frame_idx', 0)
 
             dense_map_landmark = dense_map.frame_to_node_idx[traj_idx][frame_idx]
-            path = dense_map.get_path(0, dense_map_landmark, edge_weight=default_edge_weight)
+            path = dense_map.get_path(
+                0, dense_map_landmark, edge_weight=default_edge_weight, min_edge_weight=DEFAULT_MIN_EDGE_WEIGHT,
+            )
             sparse_map.graph.nodes[landmark]['distance'] = len(path)
 
     @staticmethod
@@ -0,0 +1,112 @@
+import math
+from collections import defaultdict
+
+
+class SpatialIndex:
+    """
+    Uniform grid over 2D landmark coordinates.
+    Answers "landmarks within radius" and "nearest landmark" queries by looking only at the grid cells around the
+    query point, instead of scanning all landmarks in the map.
+    """
+
+    def __init__(self, cell_size=100.0):
+        self.cell_size = cell_size
+        self._cells = defaultdict(list)
+        self._num_points = 0
+
+        # bounding box of the occupied cells, to limit the search
+        self._min_cell = self._max_cell = None
+
+    @staticmethod
+    def from_graph(graph, cell_size=100.0):
+        """Build the index from the 'pos' attribute of graph nodes. Return None if some nodes have no coordinates."""
+        index = SpatialIndex(cell_size)
+        for node, pos in graph.nodes(data='pos'):
+            if pos is None:
+                return None
+            index.add(node, pos)
+        return index
+
+    def _cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def add(self, idx, pos):
+        x, y = pos
+        cell = self._cell(x, y)
+        self._cells[cell].append((idx, x, y))
+        self._num_points += 1
+
+        if self._min_cell is None:
+            self._min_cell = self._max_cell = cell
+        else:
+            self._min_cell = (min(self._min_cell[0], cell[0]), min(self._min_cell[1], cell[1]))
+            self._max_cell = (max(self._max_cell[0], cell[0]), max(self._max_cell[1], cell[1]))
+
+    def within(self, pos, radius):
+        """Indices of all points within the radius from pos."""
+        if self._num_points <= 0:
+            return []
+
+        x, y = pos
+        min_cx, min_cy = self._cell(x - radius, y - radius)
+        max_cx, max_cy = self._cell(x + radius, y + radius)
+        min_cx, min_cy = max(min_cx, self._min_cell[0]), max(min_cy, self._min_cell[1])
+        max_cx, max_cy = min(max_cx, self._max_cell[0]), min(max_cy, self._max_cell[1])
+
+        radius_sq = radius ** 2
+        result = []
+        for cx in range(min_cx, max_cx + 1):
+            for cy in range(min_cy, max_cy + 1):
+                for idx, px, py in self._cells.get((cx, cy), ()):
+                    if (px - x) ** 2 + (py - y) ** 2 <= radius_sq:
+                        result.append(idx)
+
+        return result
+
+    def _ring(self, cx, cy, ring):
+        """Cells at exactly the given Chebyshev distance from (cx, cy)."""
+        if ring == 0:
+            yield cx, cy
+            return
+
+        for dx in range(-ring, ring + 1):
+            yield cx + dx, cy - ring
+            yield cx + dx, cy + ring
+        for dy in range(-ring + 1, ring):
+            yield cx - ring, cy + dy
+            yield cx + ring, cy + dy
+
+    def nearest(self, pos, exclude=None):
+        """Index of the point closest to pos (ignoring indices in exclude) and the distance to it, or (None, inf)."""
+        if self._num_points <= 0:
+            return None, math.inf
+
+        x, y = pos
+        cx, cy = self._cell(x, y)
+
+        # we never need to look further than the farthest corner of the occupied region
+        max_ring = max(
+            abs(cx - self._min_cell[0]), abs(cx - self._max_cell[0]),
+            abs(cy - self._min_cell[1]), abs(cy - self._max_cell[1]),
+        )
+
+        best_idx, best_dist_sq = None, math.inf
+        for ring in range(max_ring + 1):
+            # all points in this ring are at least (ring - 1) cells away
+            min_ring_dist = max(0, ring - 1) * self.cell_size
+            if best_idx is not None and min_ring_dist ** 2 > best_dist_sq:
+                break
+
+            for cell in self._ring(cx, cy, ring):
+                for idx, px, py in self._cells.get(cell, ()):
+                    if exclude is not None and idx in exclude:
+                        continue
+
+                    dist_sq = (px - x) ** 2 + (py - y) ** 2
+                    if dist_sq < best_dist_sq:
+                        best_idx, best_dist_sq = idx, dist_sq
+
+        return best_idx, math.sqrt(best_dist_sq)
+
+    def __len__(self):
+        return self._num_points
@@ -9,14 +9,30 @@ import numpy as np
 import networkx as nx
 
 from algorithms.agent import AgentLearner
+from algorithms.distance.distance_backend import CosineDistanceBackend
 from algorithms.tests.test_wrappers import TEST_ENV_NAME
+from algorithms.topological_maps.localization import distances_unique_pairs, Localizer
+from algorithms.topological_maps.map_builder import MapBuilder, MapBuilderParams
+from algorithms.topological_maps.spatial_index import SpatialIndex
 from algorithms.topological_maps.topological_map import TopologicalMap, hash_observation
+from algorithms.utils.trajectory import Trajectory
 from utils.envs.doom.doom_utils import doom_env_by_name, make_doom_env
 from utils.graph import plot_graph
 from utils.timing import Timing
 from utils.utils import log, model_dir
 
 
+class FakeAgent:
+    """Just enough of the agent for MapBuilder, Navigator, etc. Distance backend does not need TF."""
+
+    def __init__(self, params, **param_values):
+        self.session = None
+        self.distance = CosineDistanceBackend()
+        self.params = params
+        for key, value in param_values.items():
+            setattr(self.params, key, value)
+
+
 class TestGraph(TestCase):
     def test_topological_graph(self):
         env = make_doom_env(doom_env_by_name(TEST_ENV_NAME))
@@ -295,3 +311,284 @@ class TestGraph(TestCase):
         self.assertEqual(m.num_landmarks(), 4)
 
         shutil.rmtree(params.experiment_dir())
+
+
+class TestLocalization(TestCase):
+    def test_unique_pairs(self):
+        class FakeDistance:
+            def __init__(self):
+                self.num_evaluated = 0
+
+            def distances_from_obs(self, session, obs_first, obs_second, **kwargs):
+                self.num_evaluated += len(obs_first)
+                return [float(o1 + o2) for o1, o2 in zip(obs_first, obs_second)]
+
+        obs_first = [1, 2, 1, 2, 3, 1]
+        obs_second = [10, 10, 10, 10, 10, 20]
+        hashes_first = [str(o) for o in obs_first]
+        hashes_second = [str(o) for o in obs_second]
+
+        distance_net = FakeDistance()
+        distances, num_unique = distances_unique_pairs(
+            None, distance_net, obs_first, obs_second, hashes_first, hashes_second, batch_size=2,
+        )
+
+        self.assertEqual(distances, [11.0, 12.0, 11.0, 12.0, 13.0, 21.0])
+        self.assertEqual(num_unique, 4)
+        self.assertEqual(distance_net.num_evaluated, 4)
+
+    def test_localize_numpy_backend(self):
+        """Localization without TF graph or session, e.g. for profiling on CPU-only machines."""
+        class Params:
+            new_landmark_threshold = 0.4
+            loop_closure_threshold = 0.2
+            localization_prefilter_radius = None
+
+        num_envs, num_steps = 4, 100
+        observations = np.random.randint(0, 255, size=(10, 84, 84, 3), dtype=np.uint8)
+        infos = [{'pos': {'agent_x': 100 * i, 'agent_y': 0, 'agent_a': 0}} for i in range(len(observations))]
+
+        distance_net = CosineDistanceBackend()
+        localizer = Localizer(Params())
+        maps = [TopologicalMap(observations[0], False, initial_info=infos[0]) for _ in range(num_envs)]
+
+        t = Timing()
+        with t.timeit('localize'):
+            for step in range(num_steps):
+                indices = np.random.randint(len(observations), size=num_envs)
+                obs, info = [observations[i] for i in indices], [infos[i] for i in indices]
+                distances = localizer.localize(None, obs, info, maps, distance_net, frames=[step] * num_envs)
+                self.assertEqual(len(distances), num_envs)
+
+        for m in maps:
+            self.assertGreater(m.num_landmarks(), 1)
+            self.assertLessEqual(m.num_landmarks(), len(observations))
+
+        log.debug('Timing: %s', t)
+
+
+class TestSpatialIndex(TestCase):
+    def test_queries(self):
+        rng = np.random.RandomState(0)
+        points = rng.uniform(-1000, 1000, size=(500, 2))
+
+        index = SpatialIndex(cell_size=100.0)
+        for i, p in enumerate(points):
+            index.add(i, p)
+        self.assertEqual(len(index), len(points))
+
+        for _ in range(50):
+            query = rng.uniform(-1500, 1500, size=2)
+            dist = np.linalg.norm(points - query, axis=1)
+
+            radius = rng.uniform(0, 400)
+            self.assertEqual(sorted(index.within(query, radius)), sorted(np.nonzero(dist <= radius)[0].tolist()))
+
+            exclude = set(np.argsort(dist)[:3].tolist())
+            dist[list(exclude)] = np.inf
+            nearest, nearest_dist = index.nearest(query, exclude=exclude)
+            self.assertEqual(nearest, int(np.argmin(dist)))
+            self.assertAlmostEqual(nearest_dist, dist.min())
+
+
+class TestAStar(TestCase):
+    @staticmethod
+    def _grid_map(num_landmarks, with_coordinates=True):
+        """Grid of landmarks with slightly jittered coordinates, every landmark connected to its 4 neighbors."""
+        side = int(math.sqrt(num_landmarks))
+        obs = np.zeros([4, 4, 3], dtype=np.uint8)
+
+        m = TopologicalMap(obs, directed_graph=False)
+        m.graph.clear()
+        for i in range(side * side):
+            pos = (i % side * 10 + random.random(), i // side * 10 + random.random()) if with_coordinates else None
+            m._add_new_node(obs, pos, 0, node_id=i)
+
+        for i in range(side * side):
+            if i % side < side - 1:
+                m.add_edge(i, i + 1)
+            if i + side < side * side:
+                m.add_edge(i, i + side)
+
+        return m
+
+    @staticmethod
+    def _edge_weight(i1, i2, d):
+        return 1 + (i1 + i2) % 3
+
+    def _path_weight(self, path):
+        return sum(self._edge_weight(i1, i2, None) for i1, i2 in zip(path[:-1], path[1:]))
+
+    def test_astar(self):
+        m = self._grid_map(400)
+        self.assertLess(m.max_edge_length(), 12)
+
+        for _ in range(20):
+            from_idx, to_idx = random.sample(list(m.graph.nodes), 2)
+            dijkstra = m.get_path(from_idx, to_idx, edge_weight=self._edge_weight)
+            astar = m.get_path(from_idx, to_idx, edge_weight=self._edge_weight, min_edge_weight=1)
+            self.assertEqual(astar[0], from_idx)
+            self.assertEqual(astar[-1], to_idx)
+            self.assertEqual(self._path_weight(astar), self._path_weight(dijkstra))
+
+        # max edge length is updated when we add new edges
+        m.add_edge(0, 399)
+        self.assertGreater(m.max_edge_length(), 250)
+        self.assertEqual(m.get_path(0, 399, edge_weight=self._edge_weight, min_edge_weight=1), [0, 399])
+
+        # no coordinates, fall back to Dijkstra
+        m = self._grid_map(100, with_coordinates=False)
+        self.assertIsNone(m.max_edge_length())
+        path = m.get_path(0, 99, edge_weight=self._edge_weight, min_edge_weight=1)
+        self.assertEqual(self._path_weight(path), self._path_weight(m.get_path(0, 99, edge_weight=self._edge_weight)))
+
+    def test_astar_performance(self):
+        def edge_weight(i1, i2, d):
+            return 1  # like forward edges in navigator's default_edge_weight
+
+        for num_landmarks in [1000, 10000, 50000]:
+            m = self._grid_map(num_landmarks)
+            m.max_edge_length()
+            queries = [random.sample(list(m.graph.nodes), 2) for _ in range(10)]
+
+            t = Timing()
+            with t.timeit('dijkstra'):
+                dijkstra = [m.get_path(i1, i2, edge_weight=edge_weight) for i1, i2 in queries]
+            with t.timeit('astar'):
+                astar = [m.get_path(i1, i2, edge_weight=edge_weight, min_edge_weight=1) for i1, i2 in queries]
+
+            for p1, p2 in zip(dijkstra, astar):
+                self.assertEqual(len(p1), len(p2))
+            log.debug('10 paths in map with %d landmarks: %s', num_landmarks, t)
+
+
+class TestMapBuilder(TestCase):
+    @staticmethod
+    def _map_builder(**params):
+        return MapBuilder(FakeAgent(MapBuilderParams(), **params))
+
+    def test_pairwise_distances(self):
+        map_builder = self._map_builder(pairwise_distances_tile=7)
+        observations = np.random.randint(0, 255, size=(30, 84, 84, 3), dtype=np.uint8)
+        embeddings = map_builder._calc_embeddings(observations)
+
+        expected = np.empty([len(embeddings), len(embeddings)], np.float32)
+        for i in range(len(embeddings)):
+            expected[i, :] = map_builder.distance_net.distances(None, [embeddings[i]] * len(embeddings), embeddings)
+        expected = (expected + expected.T) * 0.5
+
+        pairwise_distances = map_builder._calc_pairwise_distances(embeddings)
+        self.assertTrue(np.allclose(pairwise_distances, expected, atol=1e-6))
+        self.assertTrue(np.array_equal(pairwise_distances, pairwise_distances.T))
+
+        map_builder.params.pairwise_distances_memmap_frames = 10
+        pairwise_distances = map_builder._calc_pairwise_distances(embeddings)
+        self.assertEqual(pairwise_distances.dtype, np.float16)
+        self.assertTrue(np.allclose(pairwise_distances, expected, atol=1e-3))
+
+    @staticmethod
+    def _random_map(num_landmarks, num_trajectories):
+        def info(k):
+            return {'pos': {'agent_x': random.random() * 1000, 'agent_y': random.random() * 1000, 'agent_a': 0}}
+
+        m = TopologicalMap(np.zeros([4, 4, 3], dtype=np.uint8), directed_graph=False, initial_info=info(0))
+        for k in range(1, num_landmarks):
+            m.add_landmark(np.full([4, 4, 3], k % 256, dtype=np.uint8), info(k), update_curr_landmark=True)
+
+        for k in m.graph.nodes:
+            m.graph.nodes[k]['info'] = info(k)
+            m.graph.nodes[k]['traj_idx'] = k * num_trajectories // num_landmarks
+
+        return m
+
+    def test_shortcuts_distance(self):
+        map_builder = self._map_builder(shortcut_dist_threshold=0.05)
+        min_shortcut_dist, shortcut_window = 5, 10
+
+        m = self._random_map(300, 3)
+        num_landmarks = m.num_landmarks()
+        pairwise_distances = np.random.uniform(0, 1, size=(num_landmarks, num_landmarks)).astype(np.float32)
+        pairwise_distances = (pairwise_distances + pairwise_distances.T) * 0.5
+
+        # straightforward implementation to compare against
+        expected = []
+        nodes = m.graph.nodes
+        for i in range(num_landmarks):
+            i_traj_idx = nodes[i]['traj_idx']
+            for j in range(i, num_landmarks):
+                j_traj_idx = nodes[j]['traj_idx']
+                if j - i < min_shortcut_dist and i_traj_idx == j_traj_idx:
+                    continue
+                if pairwise_distances[i][j] > map_builder.params.shortcut_dist_threshold or j in m.graph[i]:
+                    continue
+
+                neighbors_dist = []
+                for shift in range(-shortcut_window, shortcut_window + 1):
+                    shifted_i, shifted_j = i + shift, j + shift
+                    if not (0 <= shifted_i < num_landmarks and 0 <= shifted_j < num_landmarks):
+                        continue
+                    if nodes[shifted_i]['traj_idx'] != i_traj_idx or nodes[shifted_j]['traj_idx'] != j_traj_idx:
+                        continue
+                    neighbors_dist.append(pairwise_distances[shifted_i][shifted_j])
+
+                expected.append((np.percentile(neighbors_dist, 75), i, j))
+
+        t = Timing()
+        with t.timeit('shortcuts'):
+            shortcuts = map_builder._shortcuts_distance(m, pairwise_distances, min_shortcut_dist, shortcut_window)
+
+        self.assertGreater(len(expected), 0)
+        self.assertEqual([s[1:3] for s in shortcuts], [e[1:] for e in expected])
+        self.assertTrue(np.allclose([s[0] for s in shortcuts], [e[0] for e in expected]))
+        log.debug('Timing: %s', t)
+
+    def test_sparsify_trajectory(self):
+        map_builder = self._map_builder(max_duplicate_dist=5, duplicate_neighborhood=3, duplicate_threshold=0.1)
+        params = map_builder.params
+
+        # segments of similar frames with some exact repeats
+        traj = Trajectory(0)
+        for segment in range(20):
+            base = np.random.randint(0, 255, size=(84, 84, 3)).astype(np.int16)
+            for k in range(np.random.randint(1, 8)):
+                noise = np.random.randint(-20, 20, size=base.shape)
+                frame = np.clip(base + noise * (segment % 3), 0, 255).astype(np.uint8)
+                for _ in range(np.random.randint(1, 3)):
+                    traj.add(frame, len(traj), {})
+
+        # straightforward implementation to compare against
+        pairwise_distances = map_builder._calc_pairwise_distances(map_builder._calc_embeddings(traj.obs))
+        to_delete = set()
+        for i in range(len(traj)):
+            if i in to_delete:
+                continue
+            for j in range(i + 1, len(traj)):
+                if j in to_delete:
+                    continue
+                if np.array_equal(traj.obs[i], traj.obs[j]):
+                    to_delete.add(j)
+                    continue
+                if j > i + params.max_duplicate_dist or pairwise_distances[i][j] > params.duplicate_threshold:
+                    break
+
+                neighbor_dist = []
+                for shift in range(-params.duplicate_neighborhood, params.duplicate_neighborhood + 1):
+                    shifted_i, shifted_j = i + shift, j + shift
+                    if 0 <= shifted_i < len(traj) and 0 <= shifted_j < len(traj):
+                        neighbor_dist.append(pairwise_distances[i][shifted_j])
+                        neighbor_dist.append(pairwise_distances[shifted_i][j])
+
+                if np.percentile(neighbor_dist, 75) < params.duplicate_threshold:
+                    to_delete.add(j)
+                else:
+                    break
+
+        expected = [i for i in range(len(traj)) if i not in to_delete]
+
+        t = Timing()
+        with t.timeit('sparsify'):
+            sparse_traj = map_builder.sparsify_trajectory(traj)
+
+        self.assertLess(len(expected), len(traj))
+        self.assertEqual(list(sparse_traj.actions), expected)
+        log.debug('Timing: %s', t)
@@ -1,4 +1,6 @@
 import glob
+import heapq
+import itertools
 import math
 import os
 import pickle as pkl
@@ -16,6 +18,7 @@ from matplotlib import pyplot as plt
 
 import networkx as nx
 
+from algorithms.topological_maps.spatial_index import SpatialIndex
 from algorithms.utils.algo_utils import EPS
 from utils.graph import visualize_graph_tensorboard, plot_graph
 from utils.timing import Timing
@@ -67,6 +70,11 @@ class TopologicalMap:
         # index map from frame index in a trajectory to node index in the resulting map
         self.frame_to_node_idx = dict()
 
+        # (graph, num_landmarks, index) - lazily built grid over landmark coordinates, see spatial_index()
+        self._spatial_index = None
+        # (graph, num_landmarks, max length) - upper bound on the length of any edge (-1 if no coordinates)
+        self._max_edge_length = None
+
         self.reset(initial_obs, initial_info)
 
     @staticmethod
@@ -84,6 +92,12 @@ class TopologicalMap:
 
         assert new_landmark_idx not in self.graph.nodes
 
+        index = self._cached_spatial_index()
+        max_edge_length = self._cached_max_edge_length()
+
+        if isinstance(obs, np.ndarray) and obs.base is not None:
+            obs = obs.copy()  # frames of columnar trajectories are views, don't keep the whole trajectory alive
+
         hash_ = hash_observation(obs)
         self.graph.add_node(
             new_landmark_idx,
@@ -91,14 +105,80 @@ class TopologicalMap:
             value_estimate=value_estimate, num_samples=num_samples, path=(new_landmark_idx,),
         )
 
+        if index is not None and pos is not None:
+            # keep the spatial index up to date instead of rebuilding it from scratch
+            index.add(new_landmark_idx, pos)
+            self._spatial_index = (self.graph, self.num_landmarks(), index)
+
+        if max_edge_length is not None and max_edge_length >= 0 and pos is not None:
+            # new node has no edges yet, so the bound is still valid
+            self._max_edge_length = (self.graph, self.num_landmarks(), max_edge_length)
+
         return new_landmark_idx
 
+    def _cached_spatial_index(self):
+        cached = getattr(self, '_spatial_index', None)  # maps loaded from older checkpoints don't have it
+        if cached is None:
+            return None
+
+        graph, num_landmarks, index = cached
+        if graph is not self.graph or num_landmarks != self.num_landmarks():
+            return None
+        return index
+
+    def spatial_index(self):
+        """
+        Grid index over landmark coordinates, to quickly find landmarks close to the given position.
+        Built lazily and kept up to date when new landmarks are added. None if landmarks don't have coordinates.
+        """
+        index = self._cached_spatial_index()
+        if index is None:
+            cached = getattr(self, '_spatial_index', None)
+            if cached is not None and cached[0] is self.graph and cached[1] == self.num_landmarks():
+                return None  # we already know there are no coordinates in this map
+
+            index = SpatialIndex.from_graph(self.graph)
+            self._spatial_index = (self.graph, self.num_landmarks(), index)
+
+        return index
+
+    def _cached_max_edge_length(self):
+        cached = getattr(self, '_max_edge_length', None)  # maps loaded from older checkpoints don't have it
+        if cached is None:
+            return None
+
+        graph, num_landmarks, max_length = cached
+        if graph is not self.graph or num_landmarks != self.num_landmarks():
+            return None
+        return max_length
+
+    def max_edge_length(self):
+        """
+        Max distance between the coordinates of two adjacent landmarks, used to build A* heuristic in get_path.
+        Built lazily and kept up to date when edges are added through add_edge. None if there are no coordinates.
+        """
+        max_length = self._cached_max_edge_length()
+        if max_length is None:
+            max_length = 0.0
+            if any(pos is None for _, pos in self.graph.nodes(data='pos')):
+                max_length = -1.0
+            else:
+                for i1, i2 in self.graph.edges:
+                    pos1, pos2 = self.graph.nodes[i1]['pos'], self.graph.nodes[i2]['pos']
+                    max_length = max(max_length, math.hypot(pos1[0] - pos2[0], pos1[1] - pos2[1]))
+
+            self._max_edge_length = (self.graph, self.num_landmarks(), max_length)
+
+        return None if max_length < 0 else max_length
+
     def _node_set_path(self, idx):
         self.graph.nodes[idx]['path'] = tuple(self.path_so_far)
 
     def reset(self, obs, info=None):
         """Create the graph with only one vertex."""
         self.graph.clear()
+        self._spatial_index = None
+        self._max_edge_length = None
 
         self.curr_landmark_idx = self._add_new_node(obs=obs, pos=get_position(info), angle=get_angle(info))
         assert self.curr_landmark_idx == 0
@@ -219,6 +299,13 @@ class TopologicalMap:
                 loop_closure=loop_closure,
             )
 
+        max_length = self._cached_max_edge_length()
+        if max_length is not None and max_length >= 0:
+            # both nodes have coordinates, otherwise the cached value would be -1
+            pos1, pos2 = self.graph.nodes[i1]['pos'], self.graph.nodes[i2]['pos']
+            length = math.hypot(pos1[0] - pos2[0], pos1[1] - pos2[1])
+            self._max_edge_length = (self.graph, self.num_landmarks(), max(max_length, length))
+
     def _remove_edge(self, i1, i2):
         if i2 in self.graph[i1]:
             self.graph.remove_edge(i1, i2)
@@ -239,6 +326,8 @@ class TopologicalMap:
 
         assert len(remove_vertices) < self.num_landmarks()
         self.graph.remove_nodes_from(remove_vertices)
+        self._spatial_index = None
+        self._max_edge_length = None
 
     def num_edges(self):
         """Helper function for summaries."""
@@ -263,15 +352,74 @@ class TopologicalMap:
         success_prob = min(max_probability, success_prob)
         return -math.log(success_prob)  # weight of the edge is neg. log probability of traversal success
 
-    def get_path(self, from_idx, to_idx, edge_weight=None):
+    def get_path(self, from_idx, to_idx, edge_weight=None, min_edge_weight=None):
+        """
+        Shortest path from from_idx to to_idx.
+        If lower bound on the edge weights is known (min_edge_weight) and landmarks have coordinates we use A*,
+        otherwise fall back to Dijkstra.
+        """
         if edge_weight is None:
             edge_weight = self.edge_weight
 
+        if min_edge_weight is not None and min_edge_weight > 0:
+            max_edge_length = self.max_edge_length()
+            if max_edge_length is not None and max_edge_length > 0:
+                return self._astar_path(from_idx, to_idx, edge_weight, min_edge_weight / max_edge_length)
+
         try:
             return nx.dijkstra_path(self.graph, from_idx, to_idx, weight=edge_weight)
         except nx.exception.NetworkXNoPath:
             return None
 
+    def _astar_path(self, from_idx, to_idx, edge_weight, weight_per_unit):
+        """
+        Any path to the goal needs at least (distance / max_edge_length) edges, every edge costs at least
+        min_edge_weight, so weight_per_unit * distance is a consistent heuristic and A* finds the shortest path.
+        """
+        nodes = self.graph.nodes
+        goal_x, goal_y = nodes[to_idx]['pos']
+
+        def heuristic(idx):
+            x, y = nodes[idx]['pos']
+            return weight_per_unit * math.hypot(x - goal_x, y - goal_y)
+
+        # among nodes with equal estimates prefer the ones closer to the goal, counter makes sure we never compare nodes
+        counter = itertools.count()
+        h = heuristic(from_idx)
+        queue = [(h, h, next(counter), from_idx)]
+        distances = {from_idx: 0.0}
+        parents = {from_idx: None}
+        explored = set()
+
+        while len(queue) > 0:
+            _, _, _, node = heapq.heappop(queue)
+            if node == to_idx:
+                path = [node]
+                while parents[path[-1]] is not None:
+                    path.append(parents[path[-1]])
+                return path[::-1]
+
+            if node in explored:
+                continue
+            explored.add(node)
+
+            for adj_node, edge_data in self.graph.adj[node].items():
+                if adj_node in explored:
+                    continue
+
+                weight = edge_weight(node, adj_node, edge_data)
+                if weight is None:
+                    continue  # same as in networkx, None weight means hidden edge
+
+                distance = distances[node] + weight
+                if distance < distances.get(adj_node, math.inf):
+                    distances[adj_node] = distance
+                    parents[adj_node] = node
+                    h = heuristic(adj_node)
+                    heapq.heappush(queue, (distance + h, h, next(counter), adj_node))
+
+        return None
+
     def path_lengths(self, from_idx):
         return nx.shortest_path_length(self.graph, from_idx, weight=self.edge_weight)
 
@@ -1,7 +1,12 @@
+import math
+
 import numpy as np
 
 EPS = 1e-8
 
+# see calculate_discounted_sum
+DISCOUNTED_SUM_LOOP_MIN_ENVS = 160
+
 
 class RunningMeanStd(object):
     """
@@ -83,21 +88,63 @@ def extract_key(list_of_dicts, key):
     return extract_keys(list_of_dicts, key)[0]
 
 
-def calculate_discounted_sum(x, dones, discount, x_last=None):
+def _discounted_sum_block(x, dones, discount, cumulative):
+    """
+    Discounted sum for a block of steps without a python loop, cumulative is the value right after the block.
+    Inside an episode segment sum_j discount^(j-i) * x[j] is a difference of two suffix sums of x[j] * discount^j,
+    so the whole block is just a couple of cumsums.
+    """
+    num_steps = len(x)
+    steps = np.arange(num_steps).reshape((num_steps, ) + (1, ) * (x.ndim - 1))
+    weights = np.power(float(discount), steps)
+
+    # last step of the episode segment that every step belongs to (first done at or after the step)
+    done_steps = np.where(dones, steps, num_steps)
+    segment_end = np.minimum.accumulate(done_steps[::-1], axis=0)[::-1]
+
+    suffix_sums = np.zeros((num_steps + 1, ) + x.shape[1:])
+    suffix_sums[:num_steps] = np.cumsum((weights * x)[::-1], axis=0)[::-1]
+    segment_next = np.minimum(segment_end + 1, num_steps)
+    discounted_sum = (suffix_sums[:num_steps] - np.take_along_axis(suffix_sums, segment_next, axis=0)) / weights
+
+    # steps with no episode termination until the end of the block get the discounted value after the block
+    discounted_sum += (segment_end == num_steps) * np.power(float(discount), num_steps - steps) * cumulative
+    return discounted_sum
+
+
+def calculate_discounted_sum(x, dones, discount, x_last=None, block_size=256):
     """
     Computing cumulative sum (of something) for the trajectory, taking episode termination into consideration.
+    Vectorized over time within blocks of steps, blocks are processed back to front (see _discounted_sum_block).
+    Block size is limited so that discount^block_size does not underflow.
+    For very wide batches (lots of envs) the plain loop over steps is just as fast, so we use it instead.
     :param x: ndarray of shape [num_steps, num_envs]
     :param dones: ndarray of shape [num_steps, num_envs]
     :param discount: float in range [0,1]
     :param x_last: iterable of shape [num_envs], value at the end of trajectory. None interpreted as zero(s).
     """
-    x_last = np.zeros_like(x[0]) if x_last is None else np.array(x_last, dtype=np.float32)
+    x, dones = np.asarray(x), np.asarray(dones, dtype=bool)
+    x_last = np.zeros_like(x[0]) if x_last is None else np.array(x_last, dtype=x.dtype)
     cumulative = x_last
 
+    if discount <= 0:
+        block_size = 1
+    elif discount < 1:
+        block_size = max(1, min(block_size, int(math.log(1e-100) / math.log(discount))))
+
     discounted_sum = np.zeros_like(x)
-    for i in reversed(range(len(x))):
-        cumulative = x[i] + discount * cumulative * (1 - dones[i])
-        discounted_sum[i] = cumulative
+    if x[0].size >= DISCOUNTED_SUM_LOOP_MIN_ENVS:
+        # with this many envs every step of the plain loop is already well vectorized, scan does not pay off
+        for i in reversed(range(len(x))):
+            cumulative = x[i] + discount * cumulative * (1 - dones[i])
+            discounted_sum[i] = cumulative
+        return discounted_sum
+
+    for end in range(len(x), 0, -block_size):
+        start = max(0, end - block_size)
+        block = _discounted_sum_block(x[start:end], dones[start:end], discount, cumulative)
+        discounted_sum[start:end] = block
+        cumulative = block[0]
     return discounted_sum
 
 
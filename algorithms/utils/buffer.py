@@ -1,14 +1,71 @@
+import os
+import shutil
+import tempfile
+import weakref
+
 import numpy as np
 
+from utils.utils import AttrDict, ensure_dir_exists
+
+
+def make_scratch_dir(owner, scratch_dir):
+    """Private temporary directory inside scratch_dir, removed when owner is garbage collected."""
+    if scratch_dir is None:
+        return None
+
+    tmp_dir = tempfile.mkdtemp(prefix='buffer_', dir=ensure_dir_exists(scratch_dir))
+    weakref.finalize(owner, shutil.rmtree, tmp_dir, True)
+    return tmp_dir
+
+
+def allocate_array(shape, dtype, scratch_dir=None):
+    """
+    Uninitialized array, memory-mapped to a file in scratch_dir if provided.
+    Pages of the file are allocated lazily, so large capacity can be reserved up front without using any RAM.
+    """
+    dtype = np.dtype(dtype)
+    if scratch_dir is None or dtype.hasobject:
+        return np.empty(shape, dtype=dtype)
+
+    fd, filename = tempfile.mkstemp(suffix='.dat', dir=scratch_dir)
+    os.close(fd)
+    return np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+
+def resize_array(arr, new_len):
+    """Resize along the first axis, keeping the data. Memory-mapped arrays are copied into a new file."""
+    if not isinstance(arr, np.memmap):
+        arr.resize((new_len, ) + arr.shape[1:], refcheck=False)
+        return arr
+
+    new_arr = allocate_array((new_len, ) + arr.shape[1:], arr.dtype, os.path.dirname(arr.filename))
+    num_to_copy = min(len(arr), new_len)
+    new_arr[:num_to_copy] = arr[:num_to_copy]
+    os.remove(arr.filename)
+    return new_arr
+
 
 class Buffer:
-    """Generic experience buffer class."""
-    def __init__(self):
+    """
+    Generic experience buffer class.
+    Capacity can be reserved up front, and arrays can be backed by memory-mapped files in scratch_dir instead of RAM,
+    which is useful for very large buffers on memory-constrained machines.
+    """
+    def __init__(self, capacity=0, scratch_dir=None):
         self._data = {}
 
         # assuming all buffers have the exact same size
         self._size = self._capacity = 0
 
+        self._initial_capacity = capacity
+        self._scratch_dir = make_scratch_dir(self, scratch_dir)
+
+    def _allocate(self, value, size):
+        """Array for the new key, large enough for size elements, with dtype and shape of elements of value."""
+        np_arr = np.asarray(value)
+        capacity = max(size, self._capacity, self._initial_capacity)
+        return allocate_array((capacity, ) + np_arr.shape[1:], np_arr.dtype, self._scratch_dir)
+
     def _ensure_enough_space(self, space_required):
         assert len(self._data) >= 1  # we need to have some elements already, to determine required memory
         assert self._size <= self._capacity
@@ -20,7 +77,7 @@ class Buffer:
         capacity_delta = max(self._capacity // 10, 10)  # ensure exponentially low number of reallocs
         capacity_delta = max(capacity_delta, self._size + space_required - self._capacity)
         for key in self._data.keys():
-            self._data[key].resize((self._capacity + capacity_delta, ) + self._data[key].shape[1:], refcheck=False)
+            self._data[key] = resize_array(self._data[key], self._capacity + capacity_delta)
         self._capacity += capacity_delta
 
         assert self._capacity >= self._size + space_required
@@ -31,9 +88,8 @@ class Buffer:
 
         for key, value in kwargs.items():
             if key not in self._data:
-                np_arr = np.asarray([value])
-                self._data[key] = np.empty_like(np_arr)
-                new_size = self._capacity = 1
+                self._data[key] = self._allocate([value], 1)
+                new_size, self._capacity = 1, len(self._data[key])
             else:
                 self._ensure_enough_space(1)
                 new_size = self._size + 1
@@ -52,9 +108,8 @@ class Buffer:
                 continue
 
             if key not in self._data:
-                np_arr = np.asarray(value[:size])
-                self._data[key] = np.empty_like(np_arr)
-                new_size = self._capacity = size
+                self._data[key] = self._allocate(value[:size], size)
+                new_size, self._capacity = size, len(self._data[key])
             else:
                 self._ensure_enough_space(size)
                 new_size = self._size + size
@@ -100,6 +155,31 @@ class Buffer:
 
         return None
 
+    def _gather(self, indices, keys=None):
+        if keys is None:
+            keys = self._data.keys()
+        return AttrDict({key: self._data[key][indices] for key in keys})
+
+    def minibatches(self, batch_size, keys=None, shuffle=True):
+        """
+        Iterate over the buffer in minibatches (AttrDicts from key to array), in random order if shuffle is True.
+        Unlike shuffle_data the data itself never moves, every batch is gathered with fancy indexing.
+        Trailing batch of size 1 is skipped, same as in the training loops that used shuffle_data.
+        """
+        if shuffle:
+            indices = np.random.permutation(self._size)
+        else:
+            indices = np.arange(self._size)
+
+        for start in range(0, self._size - 1, batch_size):
+            # order within the batch does not matter, and sorted indices make the gather more cache-friendly
+            yield self._gather(np.sort(indices[start:start + batch_size]), keys)
+
+    def sample(self, num_samples, keys=None):
+        """Random batch (with replacement) as AttrDict from key to array."""
+        assert self._size > 0
+        return self._gather(np.random.randint(0, self._size, num_samples), keys)
+
     def trim_at(self, new_size):
         """Discard some data from the end of the buffer, but keep the capacity."""
         if new_size >= self._size:
@@ -123,3 +203,231 @@ class Buffer:
 
     def nbytes(self):
         return sum(v.nbytes for v in self._data.values())
+
+
+class FrameStore:
+    """
+    Observations that are referenced by index from other buffers (e.g. PairBuffer), so every frame is stored once.
+    Frames are reference-counted, slots of the frames that are no longer referenced are reused.
+    """
+
+    def __init__(self, capacity=0, scratch_dir=None):
+        self.frames = None
+        self.refcount = np.zeros(capacity, dtype=np.int32)
+        self._free = np.zeros(0, dtype=np.int32)  # stack of unused slots
+        self._size = 0  # number of slots ever used, slots after that are not allocated yet
+
+        self._scratch_dir = make_scratch_dir(self, scratch_dir)
+
+    def _ensure_enough_space(self, space_required, frames):
+        capacity = len(self.refcount)
+        if self.frames is not None and capacity >= self._size + space_required:
+            return
+
+        if self.frames is None:
+            # first frames, now we know the shape and can allocate the capacity reserved up front
+            new_capacity = max(capacity, self._size + space_required, 10)
+            self.frames = allocate_array((new_capacity, ) + frames.shape[1:], frames.dtype, self._scratch_dir)
+        else:
+            new_capacity = capacity + max(capacity // 10, 10, self._size + space_required - capacity)
+            self.frames = resize_array(self.frames, new_capacity)
+
+        self.refcount.resize(new_capacity, refcheck=False)
+
+    def add(self, frames):
+        """Store frames with refcount 0, returns their indices. Caller is supposed to incref them right away."""
+        frames = np.asarray(frames)
+        num_frames = len(frames)
+
+        num_reused = min(num_frames, len(self._free))
+        indices = np.empty(num_frames, dtype=np.int32)
+        indices[:num_reused] = self._free[len(self._free) - num_reused:]
+        self._free = self._free[:len(self._free) - num_reused]
+
+        num_new = num_frames - num_reused
+        self._ensure_enough_space(num_new, frames)
+        indices[num_reused:] = np.arange(self._size, self._size + num_new, dtype=np.int32)
+        self._size += num_new
+
+        self.frames[indices] = frames
+        self.refcount[indices] = 0
+        return indices
+
+    def incref(self, indices):
+        np.add.at(self.refcount, indices, 1)
+
+    def decref(self, indices):
+        np.add.at(self.refcount, indices, -1)
+        unique = np.unique(indices)
+        released = unique[self.refcount[unique] <= 0]
+        self._free = np.concatenate([self._free, released.astype(np.int32)])
+
+    def clear(self):
+        self.refcount[:] = 0
+        self._free = np.zeros(0, dtype=np.int32)
+        self._size = 0
+
+    def num_frames(self):
+        """Number of frames that are currently referenced."""
+        return self._size - len(self._free)
+
+    def __getitem__(self, indices):
+        return self.frames[indices]
+
+    def nbytes(self):
+        return 0 if self.frames is None else self.frames.nbytes
+
+
+class PairBuffer(Buffer):
+    """
+    Pairs of observations with labels, stored as int32 (first, second, labels) indices into a shared FrameStore.
+    Observations are gathered only when a batch is requested (see minibatches), under keys obs_first and obs_second.
+    """
+
+    def __init__(self, capacity=0, scratch_dir=None):
+        super().__init__(capacity, scratch_dir)
+        self.frame_store = FrameStore(capacity, scratch_dir)
+
+    def add_pairs(self, obs, first, second, labels):
+        """Add pairs of observations obs[first[i]], obs[second[i]], every referenced frame is stored only once."""
+        if len(first) <= 0:
+            return
+
+        frames, inverse = np.unique(np.concatenate([first, second]), return_inverse=True)
+        stored = self.frame_store.add([obs[i] for i in frames])
+        stored = stored[inverse]
+        self.frame_store.incref(stored)
+
+        self.add_many(
+            first=stored[:len(first)], second=stored[len(first):], labels=np.asarray(labels, dtype=np.int32),
+        )
+
+    def _gather(self, indices, keys=None):
+        if keys is None:
+            keys = ['obs_first', 'obs_second', 'labels']
+
+        batch = AttrDict()
+        for key in keys:
+            if key == 'obs_first':
+                batch[key] = self.frame_store[self._data['first'][indices]]
+            elif key == 'obs_second':
+                batch[key] = self.frame_store[self._data['second'][indices]]
+            else:
+                batch[key] = self._data[key][indices]
+        return batch
+
+    def trim_at(self, new_size):
+        if new_size >= self._size:
+            return
+
+        self.frame_store.decref(self._data['first'][new_size:self._size])
+        self.frame_store.decref(self._data['second'][new_size:self._size])
+        super().trim_at(new_size)
+
+    def clear(self):
+        super().trim_at(0)
+        self.frame_store.clear()
+
+    def __getattr__(self, key):
+        if key in ('obs_first', 'obs_second'):
+            # materializes all observations, use minibatches() for training
+            column = 'first' if key == 'obs_first' else 'second'
+            return self.frame_store[self._data[column][:self._size]] if self._size > 0 else np.empty(0)
+        return super().__getattr__(key)
+
+    def nbytes(self):
+        return super().nbytes() + self.frame_store.nbytes()
+
+
+class StackedFrameStore:
+    """
+    With StackFramesWrapper every observation repeats stack_past - 1 frames of the previous observation of the env.
+    We store every raw frame once (frames are the equal parts of the last axis of the stacked observation) and
+    represent observations by int32 ids, stacked observations are rebuilt from frame indices on gather.
+    """
+
+    def __init__(self, stack_past):
+        self.stack_past = stack_past
+        self.frames = None
+        self.stacks = np.zeros((0, stack_past), dtype=np.int32)  # frame indices of every observation
+        self._num_frames = self._num_obs = 0
+        self._prev_obs = None  # id of the previous observation of every env, to detect shared frames
+
+    def _split(self, obs):
+        """[num_obs, ..., stack_past * c] -> [num_obs, stack_past, ..., c]"""
+        frame_channels = obs.shape[-1] // self.stack_past
+        obs = obs.reshape(obs.shape[:-1] + (self.stack_past, frame_channels))
+        return np.moveaxis(obs, -2, 1)
+
+    def _append_frames(self, frames):
+        if self.frames is None:
+            self.frames = np.empty((max(len(frames), 10), ) + frames.shape[1:], dtype=frames.dtype)
+        elif self._num_frames + len(frames) > len(self.frames):
+            self.frames = resize_array(self.frames, max(2 * len(self.frames), self._num_frames + len(frames)))
+
+        indices = np.arange(self._num_frames, self._num_frames + len(frames), dtype=np.int32)
+        self.frames[indices] = frames
+        self._num_frames += len(frames)
+        return indices
+
+    def _append_stacks(self, stacks):
+        if self._num_obs + len(stacks) > len(self.stacks):
+            self.stacks = resize_array(self.stacks, max(2 * len(self.stacks), self._num_obs + len(stacks), 10))
+
+        ids = np.arange(self._num_obs, self._num_obs + len(stacks), dtype=np.int32)
+        self.stacks[ids] = stacks
+        self._num_obs += len(stacks)
+        return ids
+
+    def add(self, obs):
+        """Observations from all envs for a single step, returns their ids."""
+        frames = self._split(np.asarray(obs))
+        num_envs = len(frames)
+        stacks = np.empty((num_envs, self.stack_past), dtype=np.int32)
+
+        continued = np.zeros(num_envs, dtype=bool)
+        if self._prev_obs is not None and len(self._prev_obs) == num_envs and self.stack_past > 1:
+            # most of the time all frames except the newest one are already in the store
+            prev_stacks = self.stacks[self._prev_obs]
+            shared = self.frames[prev_stacks[:, 1:]]
+            continued = np.all((shared == frames[:, :-1]).reshape((num_envs, -1)), axis=1)
+
+            stacks[continued, :-1] = prev_stacks[continued, 1:]
+            stacks[continued, -1] = self._append_frames(frames[continued, -1])
+
+        for env_idx in np.nonzero(~continued)[0]:
+            # e.g. episode start: the stack is the first frame repeated, we don't store duplicates
+            for i in range(self.stack_past):
+                if i > 0 and np.array_equal(frames[env_idx, i], frames[env_idx, i - 1]):
+                    stacks[env_idx, i] = stacks[env_idx, i - 1]
+                else:
+                    stacks[env_idx, i] = self._append_frames(frames[env_idx, i:i + 1])[0]
+
+        self._prev_obs = self._append_stacks(stacks)
+        return self._prev_obs
+
+    def __getitem__(self, ids):
+        frames = self.frames[self.stacks[ids]]  # [num_obs, stack_past, ..., c]
+        frames = np.moveaxis(frames, 1, -2)
+        return frames.reshape(frames.shape[:-2] + (-1, ))
+
+    def __len__(self):
+        return self._num_obs
+
+    def num_frames(self):
+        return self._num_frames
+
+    def clear(self):
+        self._num_frames = self._num_obs = 0
+        self._prev_obs = None
+
+    def nbytes(self):
+        if self.frames is None:
+            return 0
+        return self._num_frames * self.frames[0].nbytes + self._num_obs * self.stacks[0].nbytes
+
+    def stacked_nbytes(self):
+        """Memory that the same observations would take without deduplication."""
+        if self.frames is None:
+            return 0
+        return self._num_obs * self.stack_past * self.frames[0].nbytes
@@ -0,0 +1,102 @@
+import threading
+import time
+from queue import Queue, Empty, Full
+
+from utils.timing import Timing
+
+_END = object()
+
+
+class _ProducerError:
+    def __init__(self, exception):
+        self.exception = exception
+
+
+def prefetch_batches(batches, num_prefetch=2, timing=None, key_prefix=''):
+    """
+    Iterate over batches (e.g. feed dicts for session.run) while the next num_prefetch batches are gathered and
+    converted in a background thread. Numpy fancy indexing and copying release the GIL, so preparation of the
+    next batch runs in parallel with the current training step.
+    If timing is passed, it accumulates (keys are prefixed with key_prefix):
+        'feed' - time the training loop waited for the batch (preparation that was not hidden behind compute),
+        'compute' - time the training loop spent on a batch before asking for the next one,
+        'prepare' - time spent preparing batches (in the background thread).
+    :param batches: iterable (usually a generator) of batches, it is consumed in the background thread
+    :param num_prefetch: max number of batches prepared ahead of time, 0 - no background thread
+    """
+    if timing is None:
+        timing = Timing()
+
+    feed_key, compute_key, prepare_key = (key_prefix + key for key in ('feed', 'compute', 'prepare'))
+    for key in (feed_key, compute_key, prepare_key):
+        timing.setdefault(key, 0.0)
+
+    def add_time(key, start):
+        timing[key] += time.time() - start
+
+    if num_prefetch <= 0:
+        it = iter(batches)
+        while True:
+            feed_start = time.time()
+            batch = next(it, _END)
+            add_time(feed_key, feed_start)
+            add_time(prepare_key, feed_start)
+
+            if batch is _END:
+                break
+
+            compute_start = time.time()
+            yield batch
+            add_time(compute_key, compute_start)
+        return
+
+    queue = Queue(maxsize=num_prefetch)
+    stop = threading.Event()
+
+    def producer():
+        try:
+            it = iter(batches)
+            while not stop.is_set():
+                prepare_start = time.time()
+                batch = next(it, _END)
+                add_time(prepare_key, prepare_start)
+
+                while not stop.is_set():
+                    try:
+                        queue.put(batch, timeout=0.1)
+                        break
+                    except Full:
+                        pass
+
+                if batch is _END:
+                    break
+        except Exception as exc:
+            queue.put(_ProducerError(exc))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            feed_start = time.time()
+            batch = queue.get()
+            add_time(feed_key, feed_start)
+
+            if batch is _END:
+                break
+            if isinstance(batch, _ProducerError):
+                raise batch.exception
+
+            compute_start = time.time()
+            yield batch
+            add_time(compute_key, compute_start)
+    finally:
+        # training loop can stop early, producer should not block forever on a full queue
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Empty:
+                pass
+        thread.join()
+
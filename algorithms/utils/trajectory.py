@@ -1,37 +1,102 @@
 import datetime
+import glob
+import json
+import os
 import pickle
 from os.path import join
 
+import numpy as np
+
 from utils.utils import ensure_dir_exists, log
 
 
+def _allocate_column(value, capacity, dtype=None, leading_dims=()):
+    """
+    Array for the column with the given example value. Unless dtype is provided, it is inferred from the value,
+    python objects (e.g. info dicts) go into object arrays.
+    """
+    if dtype is object or value is None or isinstance(value, dict):
+        return np.empty(leading_dims + (capacity, ), dtype=object)
+
+    value = np.asarray(value)
+    return np.empty(leading_dims + (capacity, ) + value.shape, dtype=value.dtype if dtype is None else dtype)
+
+
 class Trajectory:
+    """
+    Columnar storage: every per-frame attribute (obs, actions, infos, ...) is a numpy array that grows geometrically.
+    Attributes are zero-copy views of the first len(self) elements, trim_at just changes the length.
+    """
+
+    columns = ('obs', 'actions', 'infos')
+    column_dtypes = dict(infos=object)  # dtypes of all other columns are inferred from the first frame
+
     def __init__(self, env_idx):
-        self.obs = []
-        self.actions = []
-        self.infos = []
         self.env_idx = env_idx
+        self._columns = dict()
+        self._len = 0
+
+    def __getattr__(self, key):
+        columns = self.__dict__.get('_columns', dict())
+        if key in columns:
+            return columns[key][:self._len]
+        if key in type(self).columns:
+            return np.empty(0)
+        raise AttributeError(key)
+
+    def _ensure_enough_space(self, values, space_required, dtypes=None):
+        required = self._len + space_required
+        for key, value in values.items():
+            column = self._columns.get(key)
+            if column is not None and len(column) >= required:
+                continue
+
+            dtype = self.column_dtypes.get(key, None if dtypes is None else dtypes.get(key))
+            capacity = max(required, 16) if column is None else max(required, 2 * len(column))
+            new_column = _allocate_column(value, capacity, dtype)
+            if column is not None:
+                # new array instead of in-place resize: views into the old one (e.g. landmarks in maps) stay valid
+                new_column[:self._len] = column[:self._len]
+            self._columns[key] = new_column
+
+    def _append(self, **values):
+        self._ensure_enough_space(values, 1)
+        for key, value in values.items():
+            self._columns[key][self._len] = value
+        self._len += 1
+
+    def _extend(self, **values):
+        num_frames = len(next(iter(values.values()))) if values else 0
+        if num_frames <= 0:
+            return
+
+        # e.g. locomotion targets that are None in the first frame only
+        dtypes = {key: object for key, value in values.items() if getattr(value, 'dtype', None) == object}
+        self._ensure_enough_space({key: value[0] for key, value in values.items()}, num_frames, dtypes)
+        for key, value in values.items():
+            column = self._columns[key]
+            if column.dtype.hasobject:
+                # numpy would try to broadcast sequences, so we assign python objects one by one
+                for i in range(num_frames):
+                    column[self._len + i] = value[i]
+            else:
+                column[self._len:self._len + num_frames] = value
+        self._len += num_frames
 
     def add(self, obs, action, info, **kwargs):
-        self.obs.append(obs)
-        self.actions.append(action)
-        self.infos.append(info)
+        self._append(obs=obs, actions=action, infos=info)
 
     def add_frame(self, tr, i):
-        self.add(tr.obs[i], tr.actions[i], tr.infos[i])
+        self._append(**{key: getattr(tr, key)[i] for key in self.columns})
 
     def add_trajectory(self, tr):
-        self.obs.extend(tr.obs)
-        self.actions.extend(tr.actions)
-        self.infos.extend(tr.infos)
+        self._extend(**{key: getattr(tr, key) for key in self.columns})
 
     def trim_at(self, idx):
-        for key, value in self.__dict__.items():
-            if isinstance(value, (list, tuple)):
-                self.__dict__[key] = value[:idx]
+        self._len = max(0, min(self._len, idx))
 
     def __len__(self):
-        return len(self.obs)
+        return self._len
 
     def obs_nbytes(self):
         if len(self) == 0:
@@ -39,46 +104,349 @@ class Trajectory:
         obs_size = self.obs[0].nbytes
         return len(self) * obs_size
 
-    def save(self, experiment_dir):
-        trajectories_dir = ensure_dir_exists(join(experiment_dir, '.trajectories'))
+    def as_dict(self):
+        d = dict(env_idx=self.env_idx)
+        d.update({key: getattr(self, key) for key in self._columns})
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        Restore from the dict of columns (also works with older pickles that stored lists of frames).
+        Columns not declared in the class (e.g. TMAX modes loaded into a plain Trajectory) are kept as well.
+        """
+        trajectory = cls(d.get('env_idx', -1))
+        trajectory._extend(**{key: np.asarray(value) for key, value in d.items() if key != 'env_idx'})
+        return trajectory
 
-        timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
-        trajectory_dir = ensure_dir_exists(join(trajectories_dir, f'traj_{timestamp}'))
+    def save(self, experiment_dir):
+        trajectory_dir = new_trajectory_dir(experiment_dir)
         log.info('Saving trajectory to %s...', trajectory_dir)
 
-        with open(join(trajectory_dir, 'trajectory.pickle'), 'wb') as traj_file:
-            pickle.dump(self.__dict__, traj_file)
+        writer = TrajectoryWriter(trajectory_dir, self.env_idx)
+        if len(self) > 0:
+            columns = self.as_dict()
+            del columns['env_idx']
+            writer.add_frames(**columns)
+        writer.close()
 
         return trajectory_dir
 
 
+class TrajectoryArena:
+    """
+    Trajectories that are currently being collected in all envs, as [num_envs, capacity, ...] arrays.
+    Data of the whole step for all envs is appended with a single assignment per column.
+    """
+
+    def __init__(self, num_envs, column_dtypes=None):
+        self.num_envs = num_envs
+        self.column_dtypes = dict() if column_dtypes is None else column_dtypes
+        self.lengths = np.zeros(num_envs, dtype=np.int64)
+        self._columns = dict()
+        self._env_indices = np.arange(num_envs)
+
+    def _ensure_enough_space(self, values):
+        required = self.lengths.max() + 1
+        for key, value in values.items():
+            column = self._columns.get(key)
+            if column is not None and column.shape[1] >= required:
+                continue
+
+            capacity = max(required, 16) if column is None else max(required, 2 * column.shape[1])
+            new_column = _allocate_column(
+                value[0], capacity, self.column_dtypes.get(key), leading_dims=(self.num_envs, ),
+            )
+            if column is not None:
+                new_column[:, :column.shape[1]] = column
+            self._columns[key] = new_column
+
+    def append(self, **values):
+        """Every value is a sequence with data for all envs."""
+        self._ensure_enough_space(values)
+        for key, value in values.items():
+            column = self._columns[key]
+            if column.dtype.hasobject:
+                for env_idx in range(self.num_envs):
+                    column[env_idx, self.lengths[env_idx]] = value[env_idx]
+            else:
+                column[self._env_indices, self.lengths] = value
+        self.lengths += 1
+
+    def pop(self, env_idx, trajectory):
+        """Move the data collected in env env_idx into the (empty) trajectory object."""
+        length = self.lengths[env_idx]
+        trajectory._extend(**{key: column[env_idx, :length] for key, column in self._columns.items()})
+        self.lengths[env_idx] = 0
+        return trajectory
+
+    def obs_nbytes(self):
+        if 'obs' not in self._columns:
+            return 0
+        obs = self._columns['obs']
+        return self.lengths.sum() * obs[0, 0].nbytes
+
+
 class TrajectoryBuffer:
     """Store trajectories for multiple parallel environments."""
 
+    trajectory_class = Trajectory
+
     def __init__(self, num_envs):
-        self.current_trajectories = [Trajectory(env_idx) for env_idx in range(num_envs)]
+        self.num_envs = num_envs
+        self.current_trajectories = TrajectoryArena(num_envs, self.trajectory_class.column_dtypes)
         self.complete_trajectories = []
 
     def reset_trajectories(self):
         """Discard old trajectories and start collecting new ones."""
         self.complete_trajectories = []
 
+    def _add(self, dones, **values):
+        self.current_trajectories.append(**values)
+
+        for env_idx in np.nonzero(dones)[0]:
+            # finalize the trajectory and put it into a separate buffer
+            trajectory = self.current_trajectories.pop(env_idx, self.trajectory_class(env_idx))
+            self.complete_trajectories.append(trajectory)
+
     def add(self, obs, actions, infos, dones):
         assert len(obs) == len(actions)
-        for env_idx in range(len(obs)):
-            self.current_trajectories[env_idx].add(obs[env_idx], actions[env_idx], infos[env_idx])
-
-            if dones[env_idx]:
-                # finalize the trajectory and put it into a separate buffer
-                self.complete_trajectories.append(self.current_trajectories[env_idx])
-                self.current_trajectories[env_idx] = Trajectory(env_idx)
+        self._add(dones, obs=obs, actions=actions, infos=infos)
 
     def obs_size(self):
-        total_len = total_nbytes = 0
-        for traj_buffer in [self.current_trajectories, self.complete_trajectories]:
-            for traj in traj_buffer:
-                total_len += len(traj)
-                total_nbytes += traj.obs_nbytes()
+        total_len = int(self.current_trajectories.lengths.sum())
+        total_nbytes = self.current_trajectories.obs_nbytes()
+        for traj in self.complete_trajectories:
+            total_len += len(traj)
+            total_nbytes += traj.obs_nbytes()
 
         return total_len, total_nbytes
 
+
+def new_trajectory_dir(experiment_dir):
+    trajectories_dir = ensure_dir_exists(join(experiment_dir, '.trajectories'))
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    return ensure_dir_exists(join(trajectories_dir, f'traj_{timestamp}'))
+
+
+def trajectory_dirs(experiment_dir):
+    """Directories of all trajectories saved in the experiment, in chronological order."""
+    return sorted(glob.glob(join(experiment_dir, '.trajectories', 'traj_*')))
+
+
+class TrajectoryWriter:
+    """
+    Append-only on-disk trajectory format that can be written while the trajectory is being collected.
+    Observations go into chunks of chunk_size frames (.npy files, written through np.memmap), all other columns
+    of the chunk are pickled as soon as the chunk is full. Header is rewritten after every chunk, so the frames
+    written so far can be read even if the process dies before close().
+    """
+
+    header_filename = 'trajectory.json'
+    format_version = 1
+
+    def __init__(self, trajectory_dir, env_idx=-1, chunk_size=256):
+        self.trajectory_dir = ensure_dir_exists(trajectory_dir)
+        self.env_idx = env_idx
+        self.chunk_size = chunk_size
+
+        self.num_frames = 0  # frames in complete chunks
+        self.num_chunks = 0
+        self.obs_shape = self.obs_dtype = None
+
+        self._obs_chunk = None
+        self._chunk_columns = dict()
+        self._chunk_len = 0
+
+    @staticmethod
+    def obs_filename(chunk_idx):
+        return f'obs_{chunk_idx:05d}.npy'
+
+    @staticmethod
+    def columns_filename(chunk_idx):
+        return f'columns_{chunk_idx:05d}.pickle'
+
+    def _start_chunk(self, obs):
+        if self.obs_shape is None:
+            self.obs_shape, self.obs_dtype = obs.shape, obs.dtype
+
+        self._obs_chunk = np.lib.format.open_memmap(
+            join(self.trajectory_dir, self.obs_filename(self.num_chunks)),
+            mode='w+', dtype=self.obs_dtype, shape=(self.chunk_size, ) + tuple(self.obs_shape),
+        )
+        self._chunk_columns = dict()
+        self._chunk_len = 0
+
+    def add(self, obs, **columns):
+        """Add a single frame, obs plus values of all other columns (e.g. actions=action, infos=info)."""
+        self.add_frames(np.asarray(obs)[None], **{key: [value] for key, value in columns.items()})
+
+    def add_frames(self, obs, **columns):
+        """Add a sequence of frames, every column is a sequence of the same length as obs."""
+        obs = np.asarray(obs)
+        start = 0
+        while start < len(obs):
+            if self._obs_chunk is None:
+                self._start_chunk(obs[0])
+
+            end = min(len(obs), start + self.chunk_size - self._chunk_len)
+            self._obs_chunk[self._chunk_len:self._chunk_len + end - start] = obs[start:end]
+            for key, value in columns.items():
+                self._chunk_columns.setdefault(key, []).extend(value[start:end])
+
+            self._chunk_len += end - start
+            if self._chunk_len >= self.chunk_size:
+                self._finish_chunk()
+            start = end
+
+    def _finish_chunk(self):
+        if self._obs_chunk is None:
+            return
+
+        self._obs_chunk.flush()
+        with open(join(self.trajectory_dir, self.columns_filename(self.num_chunks)), 'wb') as columns_file:
+            pickle.dump(self._chunk_columns, columns_file)
+
+        self.num_frames += self._chunk_len
+        self.num_chunks += 1
+        self._obs_chunk = None
+        self._write_header()
+
+    def _write_header(self):
+        header = dict(
+            version=self.format_version, env_idx=int(self.env_idx),
+            num_frames=self.num_frames, num_chunks=self.num_chunks, chunk_size=self.chunk_size,
+        )
+        # write and rename, so readers never see a half-written header
+        tmp_filename = join(self.trajectory_dir, self.header_filename + '.tmp')
+        with open(tmp_filename, 'w') as header_file:
+            json.dump(header, header_file)
+        os.replace(tmp_filename, join(self.trajectory_dir, self.header_filename))
+
+    def close(self):
+        """Write the last (partial) chunk."""
+        self._finish_chunk()
+        if self.num_chunks <= 0:
+            self._write_header()
+
+
+class ChunkedFrames:
+    """Sequence-like access to the observations of a saved trajectory, frames are read from disk lazily."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __iter__(self):
+        for _, obs in self.reader.iter_chunks():
+            yield from obs
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(idx)
+            chunk_size = self.reader.chunk_size
+            return self.reader.obs_chunk(idx // chunk_size)[idx % chunk_size]
+
+        return self.reader.frames(np.arange(len(self))[idx])
+
+
+class TrajectoryReader:
+    """
+    Read trajectory saved by TrajectoryWriter without loading it into RAM.
+    Observation chunks are memory-mapped on first access, all other columns are small and are loaded as a whole.
+    Duck-types Trajectory for read-only code (len(t), t.obs[i], t.infos[i], ...), use load() to get a Trajectory.
+    """
+
+    def __init__(self, trajectory_dir, trajectory_class=Trajectory):
+        self.trajectory_dir = trajectory_dir
+        self.trajectory_class = trajectory_class
+
+        with open(join(trajectory_dir, TrajectoryWriter.header_filename)) as header_file:
+            header = json.load(header_file)
+
+        self.env_idx = header['env_idx']
+        self.chunk_size = header['chunk_size']
+        self.num_chunks = header['num_chunks']
+        self._len = header['num_frames']
+
+        self._obs_chunks = [None] * self.num_chunks
+        self._columns = None
+
+    @staticmethod
+    def is_trajectory_dir(trajectory_dir):
+        return os.path.isfile(join(trajectory_dir, TrajectoryWriter.header_filename))
+
+    def __len__(self):
+        return self._len
+
+    def obs_chunk(self, chunk_idx):
+        if self._obs_chunks[chunk_idx] is None:
+            filename = join(self.trajectory_dir, TrajectoryWriter.obs_filename(chunk_idx))
+            obs = np.load(filename, mmap_mode='r')
+            self._obs_chunks[chunk_idx] = obs[:min(self.chunk_size, self._len - chunk_idx * self.chunk_size)]
+        return self._obs_chunks[chunk_idx]
+
+    def iter_chunks(self):
+        """Stream the observations, yields (index of the first frame, frames of the chunk)."""
+        for chunk_idx in range(self.num_chunks):
+            yield chunk_idx * self.chunk_size, self.obs_chunk(chunk_idx)
+
+    def frames(self, indices):
+        """Gather observations with the given indices into a new array."""
+        indices = np.asarray(indices, dtype=np.int64)
+        frames = None
+        chunk_indices = indices // self.chunk_size
+        for chunk_idx in np.unique(chunk_indices):
+            chunk = self.obs_chunk(chunk_idx)
+            if frames is None:
+                frames = np.empty((len(indices), ) + chunk.shape[1:], dtype=chunk.dtype)
+            in_chunk = chunk_indices == chunk_idx
+            frames[in_chunk] = chunk[indices[in_chunk] % self.chunk_size]
+
+        if frames is None:
+            frames = np.empty(0)
+        return frames
+
+    @property
+    def obs(self):
+        return ChunkedFrames(self)
+
+    def _load_columns(self):
+        if self._columns is None:
+            columns = dict()
+            for chunk_idx in range(self.num_chunks):
+                with open(join(self.trajectory_dir, TrajectoryWriter.columns_filename(chunk_idx)), 'rb') as f:
+                    for key, value in pickle.load(f).items():
+                        columns.setdefault(key, []).extend(value)
+            self._columns = self.trajectory_class.from_dict(columns)
+        return self._columns
+
+    def __getattr__(self, key):
+        if key.startswith('_'):
+            raise AttributeError(key)
+        return getattr(self._load_columns(), key)
+
+    def obs_nbytes(self):
+        if len(self) == 0:
+            return 0
+        return len(self) * self.obs_chunk(0)[0].nbytes
+
+    def load(self):
+        """Whole trajectory in memory."""
+        columns = self._load_columns().as_dict()
+        columns.update(env_idx=self.env_idx, obs=self.obs[:])
+        return self.trajectory_class.from_dict(columns)
+
+
+def open_trajectory(trajectory_dir, trajectory_class=Trajectory):
+    """Lazy reader for the chunked format, trajectories saved as a single pickle are loaded into memory."""
+    if TrajectoryReader.is_trajectory_dir(trajectory_dir):
+        return TrajectoryReader(trajectory_dir, trajectory_class)
+
+    with open(join(trajectory_dir, 'trajectory.pickle'), 'rb') as traj_file:
+        return trajectory_class.from_dict(pickle.load(traj_file))